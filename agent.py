@@ -1,26 +1,247 @@
 #!/usr/bin/python
 
 import argparse
+import base64
+import collections
 import datetime
+import hashlib
+import heapq
+import json
 import os
+import re
+import signal
 import subprocess
 import sys
 import tempfile
 import threading
+import time
 import uuid
 import zmq
 
+import labels
+import profiling
+import recorder
+import spawner
+import transport
+
+monotonic = getattr(time, "monotonic", time.time)
+
+
+def _convert_field(value):
+    for type_ in (int, float):
+        try:
+            return type_(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+class OutputFilter(object):
+    OPTIONS = ("include", "exclude", "extract", "head_lines", "tail_lines")
+
+    def __init__(self, include=None, exclude=None, extract=None,
+                 head_lines=None, tail_lines=None):
+        self.include = re.compile(include) if include else None
+        self.exclude = re.compile(exclude) if exclude else None
+        self.extract = re.compile(extract) if extract else None
+        self.head_lines = None if head_lines is None else int(head_lines)
+        self.tail_lines = None if tail_lines is None else int(tail_lines)
+
+    @classmethod
+    def from_request(cls, req):
+        options = dict((key, req[key]) for key in cls.OPTIONS if key in req)
+        if not options:
+            return None
+        return cls(**options)
+
+    def apply(self, text):
+        lines = []
+        fields = None if self.extract is None else {}
+        for line in text.splitlines(True):
+            # Extraction sees every line, the filters only shape the text.
+            if self.extract is not None:
+                match = self.extract.search(line)
+                if match is not None:
+                    # The last matching line wins.
+                    for key, value in match.groupdict().items():
+                        fields[key] = _convert_field(value)
+            if self.include is not None and not self.include.search(line):
+                continue
+            if self.exclude is not None and self.exclude.search(line):
+                continue
+            lines.append(line)
+
+        if self.head_lines is not None or self.tail_lines is not None:
+            head = lines[:self.head_lines or 0]
+            tail = lines[len(head):]
+            tail = tail[len(tail) - min(self.tail_lines or 0, len(tail)):]
+            lines = head + tail
+
+        return "".join(lines), fields
+
+
+class OutputCapture(object):
+    CHUNK_SIZE = 65536
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+
+    @property
+    def truncated(self):
+        return self.limit is not None and self.size > self.limit
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is None:
+            self.head += data
+            return
+
+        head_limit = self.limit - self.limit // 2
+        if len(self.head) < head_limit:
+            room = head_limit - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+
+        if data:
+            tail_limit = self.limit // 2
+            self.tail += data
+            if len(self.tail) > tail_limit:
+                del self.tail[:len(self.tail) - tail_limit]
+
+    def consume(self, pipe):
+        fd = pipe.fileno()
+        try:
+            while True:
+                data = os.read(fd, self.CHUNK_SIZE)
+                if not data:
+                    break
+                self.write(data)
+        finally:
+            pipe.close()
+
+    def fill_response(self, resp, name, output_filter=None):
+        if self.limit is None:
+            if self.size:
+                parts = [(name, self.head)]
+            else:
+                parts = []
+        else:
+            resp["%s_size" % name] = self.size
+            resp["%s_truncated" % name] = self.truncated
+            if self.truncated:
+                parts = [(name, self.head), ("%s_tail" % name, self.tail)]
+            else:
+                parts = [(name, self.head + self.tail)]
+
+        for key, data in parts:
+            text = data.decode("utf-8", "replace")
+            if output_filter is not None:
+                text, fields = output_filter.apply(text)
+                if fields is not None:
+                    resp.setdefault("%s_fields" % name, {}).update(fields)
+            resp[key] = text
+
+
 class CommandExecutor(object):
-    def __init__(self, req, resp, agent_id=None):
+    KILL_AFTER = 5.0
+    # Sleep until this close to start_at, then spin.
+    SPIN_TIME = 0.002
+
+    def __init__(self, req, resp, agent_id=None, capture_limit=None,
+                 spawn_client=None, clock_offset=0.0):
         self.req = req
         self.resp = resp
         self.thread = req.get("thread")
+        self.timeout = req.get("time_limit")
+        if self.timeout is not None:
+            self.timeout = float(self.timeout)
+        self.kill_after = float(req.get("kill_after", self.KILL_AFTER))
+        self.timed_out = False
+        self.exited = threading.Event()
         self.agent_id = agent_id
+        self.capture_limit = req.get("capture_limit", capture_limit)
+        self.output_filter = OutputFilter.from_request(req)
+        self.clock_offset = clock_offset
+        self.spawn_client = spawn_client
         self.stdout_fh = self.stderr_fh = None
         self.child_stdout_fh = self.child_stderr_fh = None
+        self.start_time = None
+        self.usage = None
 
     def _thread_target(self, process):
-        self.exit_code = process.wait()
+        self.exit_code = self._wait(process)
+
+    def _get_usage(self, rusage, io_counters):
+        max_rss_kb = rusage.ru_maxrss
+        if sys.platform == "darwin":
+            max_rss_kb //= 1024
+
+        usage = {
+            "wall_time": monotonic() - self.start_time,
+            "user_time": rusage.ru_utime,
+            "system_time": rusage.ru_stime,
+            "max_rss_kb": max_rss_kb,
+            "minor_faults": rusage.ru_minflt,
+            "major_faults": rusage.ru_majflt,
+            "voluntary_switches": rusage.ru_nvcsw,
+            "involuntary_switches": rusage.ru_nivcsw,
+            "block_input": rusage.ru_inblock,
+            "block_output": rusage.ru_oublock,
+        }
+        usage.update(io_counters)
+        return usage
+
+    @classmethod
+    def _wait4(cls, process):
+        # Wait without reaping first, so that /proc/<pid>/io of the
+        # zombie is still there to be read.
+        io_counters = {}
+        if hasattr(os, "waitid"):
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            io_counters = spawner.read_proc_io(process.pid)
+
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = spawner.get_returncode(status)
+        return process.returncode, rusage, io_counters
+
+    def _wait(self, process):
+        if isinstance(process, spawner.SpawnedProcess):
+            returncode, rusage, io_counters = process.wait_usage()
+        else:
+            returncode, rusage, io_counters = self._wait4(process)
+
+        self.usage = self._get_usage(rusage, io_counters)
+        self.exited.set()
+        return returncode
+
+    @classmethod
+    def _sleep_until(cls, deadline):
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                return
+            if left > cls.SPIN_TIME:
+                time.sleep(left - cls.SPIN_TIME)
+
+    @classmethod
+    def _killpg(cls, process, signum):
+        try:
+            os.killpg(process.pid, signum)
+        except OSError:
+            # The whole group is gone already.
+            pass
+
+    def _watch(self, process):
+        if self.exited.wait(self.timeout):
+            return
+
+        self.timed_out = True
+        self._killpg(process, signal.SIGTERM)
+        if not self.exited.wait(self.kill_after):
+            self._killpg(process, signal.SIGKILL)
 
     @classmethod
     def _get_redirection(cls, config, thread=False, is_stderr=False):
@@ -44,6 +265,29 @@ class CommandExecutor(object):
 
         return stdout_fh, stderr_fh
 
+    def _communicate(self, process):
+        limit = self.capture_limit
+        if limit is not None:
+            limit = int(limit)
+        captures = []
+        readers = []
+        for pipe in (process.stdout, process.stderr):
+            if pipe is None:
+                captures.append(None)
+                continue
+            capture = OutputCapture(limit)
+            reader = threading.Thread(target=capture.consume, args=(pipe,))
+            reader.daemon = True
+            reader.start()
+            captures.append(capture)
+            readers.append(reader)
+
+        for reader in readers:
+            reader.join()
+
+        return captures
+
+    @profiling.timed("CommandExecutor.run")
     def run(self):
         req = self.req
         resp = self.resp
@@ -52,17 +296,44 @@ class CommandExecutor(object):
 
         env = req.get("env")
         if env and "AGENT_ID" in env and self.agent_id is not None:
-            env["AGENT_ID"] = self.agent_id
+            env = dict(env, AGENT_ID=self.agent_id)
 
-        process = subprocess.Popen(
-            req["path"], stdout=stdout_fh, stderr=stderr_fh,
-            env=env
-        )
+        # With a timeout the child gets its own process group, so that
+        # everything it started can be killed along with it.
+        new_session = self.timeout is not None
+
+        start_at = req.get("start_at")
+        if start_at is not None:
+            # start_at is in master time, our clock is ahead of it by
+            # clock_offset.
+            start_at = float(start_at) + self.clock_offset
+            self._sleep_until(start_at)
+
+        self.start_time = monotonic()
+        if self.spawn_client is not None:
+            process = self.spawn_client.spawn(
+                req["path"], stdout=stdout_fh, stderr=stderr_fh, env=env,
+                new_session=new_session)
+        else:
+            process = subprocess.Popen(
+                req["path"], stdout=stdout_fh, stderr=stderr_fh,
+                env=env, start_new_session=new_session
+            )
         stdout = stderr = None
+        if start_at is not None:
+            resp["start_skew"] = time.time() - start_at
+
+        if self.timeout is not None:
+            watchdog = threading.Thread(target=self._watch, args=(process,))
+            watchdog.daemon = True
+            watchdog.start()
 
         if not self.thread:
-            stdout, stderr = process.communicate()
-            resp["exit_code"] = process.wait()
+            stdout, stderr = self._communicate(process)
+            resp["exit_code"] = self._wait(process)
+            resp["usage"] = self.usage
+            if self.timeout is not None:
+                resp["timed_out"] = self.timed_out
         else:
 
             if stdout_fh not in (subprocess.PIPE, subprocess.STDOUT):
@@ -76,12 +347,12 @@ class CommandExecutor(object):
                 target=self._thread_target, args=(process,))
             self.thread.start()
 
-        if stdout:
-            resp["stdout"] = stdout.decode("utf-8")
+        if stdout is not None:
+            stdout.fill_response(resp, "stdout", self.output_filter)
         elif hasattr(stdout_fh, "name"):
             resp["stdout_fh"] = stdout_fh.name
-        if stderr:
-            resp["stderr"] = stderr.decode("utf-8")
+        if stderr is not None:
+            stderr.fill_response(resp, "stderr", self.output_filter)
         elif hasattr(stderr_fh, "name"):
             resp["stderr_fh"] = stderr_fh.name
         return resp
@@ -93,65 +364,570 @@ class CommandExecutor(object):
                 fh.close()
 
 
+def script_hash(script):
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+class ScriptCache(object):
+    DEFAULT_PATH = os.path.join(tempfile.gettempdir(),
+                                "rally-agent-scripts-%d" % os.getuid())
+    DEFAULT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path=None, max_size=None):
+        self.path = path or self.DEFAULT_PATH
+        self.max_size = max_size or self.DEFAULT_SIZE
+
+    def _check_dir(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        # Scripts found here are run, nobody else may have put them there.
+        stat = os.lstat(self.path)
+        if (os.path.islink(self.path) or stat.st_uid != os.getuid() or
+                stat.st_mode & 0o022):
+            raise ValueError("Script cache '%s' must be a directory owned "
+                             "and only writable by this user." % self.path)
+
+    def _get_path(self, digest):
+        if len(digest) != 64 or digest.strip("0123456789abcdef"):
+            raise ValueError("Invalid script hash '%s'." % digest)
+        return os.path.join(self.path, digest)
+
+    def get(self, digest):
+        path = self._get_path(digest)
+        self._check_dir()
+        try:
+            with open(path, "rb") as fh:
+                actual = hashlib.sha256(fh.read()).hexdigest()
+            # Bump mtime, it is what eviction is ordered by.
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        if actual != digest:
+            os.unlink(path)
+            return None
+        return path
+
+    def put(self, script, digest=None):
+        actual = script_hash(script)
+        if digest is not None and digest != actual:
+            raise ValueError("Script hash mismatch: got '%s', expected '%s'."
+                             % (actual, digest))
+
+        path = self._get_path(actual)
+        self._check_dir()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(script.encode("utf-8"))
+        os.chmod(tmp_path, 0o700)
+        os.rename(tmp_path, path)
+
+        self.evict(keep=path)
+        return actual
+
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class FileTransfer(object):
+    HASH_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, dest, size, chunk_size, sha256):
+        self.dest = dest
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256
+        self.chunks = (size + chunk_size - 1) // chunk_size
+        self.received = bytearray(self.chunks)
+        self.complete = False
+        self.fh = None
+        self.last_used = monotonic()
+
+        if os.path.exists(dest) and self._hash_file(dest) == sha256:
+            self.received = bytearray(b"\x01" * self.chunks)
+            self.complete = True
+            return
+
+        fd, self.part_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(dest)),
+            prefix=os.path.basename(dest) + ".", suffix=".part")
+        self.fh = os.fdopen(fd, "wb+")
+        self.fh.truncate(size)
+
+    @classmethod
+    def _hash_file(cls, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(cls.HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def write_chunk(self, index, data, sha256):
+        self.last_used = monotonic()
+        if self.complete or self.received[index]:
+            return
+        if hashlib.sha256(data).hexdigest() != sha256:
+            raise ValueError("Chunk %d hash mismatch." % index)
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(data) != expected:
+            raise ValueError("Chunk %d size mismatch: got %d, expected %d."
+                             % (index, len(data), expected))
+
+        self.fh.seek(index * self.chunk_size)
+        self.fh.write(data)
+        self.received[index] = 1
+
+    def missing(self):
+        ranges = []
+        start = None
+        for index, received in enumerate(self.received):
+            if not received and start is None:
+                start = index
+            elif received and start is not None:
+                ranges.append([start, index])
+                start = None
+        if start is not None:
+            ranges.append([start, self.chunks])
+        return ranges
+
+    def finish(self):
+        self.last_used = monotonic()
+        if self.complete or not all(self.received):
+            return self.complete
+
+        self.fh.close()
+        if self._hash_file(self.part_path) != self.sha256:
+            # Every chunk matched but the file did not, start over.
+            self.received = bytearray(self.chunks)
+            self.fh = open(self.part_path, "r+b")
+            raise ValueError("File hash mismatch for '%s'." % self.dest)
+
+        os.rename(self.part_path, self.dest)
+        self.fh = None
+        self.complete = True
+        return True
+
+    def abort(self):
+        if self.fh is None:
+            return
+        self.fh.close()
+        self.fh = None
+        os.unlink(self.part_path)
+
+
+class Outbox(object):
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, path, retry_interval=5.0, rate=100.0):
+        self.path = path
+        self.retry_interval = retry_interval
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = monotonic()
+        self.next_seq = 0
+        self.acked_since_compact = 0
+        # Unacknowledged responses by seq and a heap of (due time, seq)
+        # with exactly one entry for each of them.
+        self.pending = {}
+        self.schedule = []
+
+        self._load()
+        self.fh = open(self.path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb+") as fh:
+            data = fh.read()
+            # Cut off a torn write at the end of the log, so that the next
+            # entry is not appended to it.
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                fh.truncate(end)
+
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+            if "resp" in entry:
+                seq = entry["resp"]["outbox_seq"]
+                self.pending[seq] = entry["resp"]
+                self.next_seq = max(self.next_seq, seq + 1)
+            elif "ack" in entry:
+                for seq in entry["ack"]:
+                    self.pending.pop(seq, None)
+            elif "next_seq" in entry:
+                self.next_seq = max(self.next_seq, entry["next_seq"])
+
+        for seq in sorted(self.pending):
+            self.reschedule(seq)
+
+    def _write(self, entry):
+        self.fh.write(json.dumps(entry) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def append(self, resp):
+        resp["outbox_seq"] = seq = self.next_seq
+        self.next_seq += 1
+        self._write({"resp": resp})
+        self.pending[seq] = resp
+        self.reschedule(seq)
+        return resp
+
+    def reschedule(self, seq, delay=0):
+        heapq.heappush(self.schedule, (monotonic() + delay, seq))
+
+    def ack(self, seqs):
+        seqs = [seq for seq in seqs if self.pending.pop(seq, None)]
+        if not seqs:
+            return
+
+        self._write({"ack": seqs})
+        self.acked_since_compact += len(seqs)
+        if (not self.pending or
+                self.acked_since_compact >= self.COMPACT_THRESHOLD):
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(json.dumps({"next_seq": self.next_seq}) + "\n")
+            for seq in sorted(self.pending):
+                fh.write(json.dumps({"resp": self.pending[seq]}) + "\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp_path, self.path)
+
+        self.fh.close()
+        self.fh = open(self.path, "a")
+        self.acked_since_compact = 0
+        if not self.pending:
+            self.schedule = []
+
+    def get_due(self):
+        now = monotonic()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+        due = []
+        while (self.schedule and self.tokens >= 1 and
+               self.schedule[0][0] <= now):
+            _, seq = heapq.heappop(self.schedule)
+            if seq in self.pending:
+                due.append(self.pending[seq])
+                self.tokens -= 1
+        return due
+
+
+class RequestCache(object):
+    DEFAULT_SIZE = 1000
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.DEFAULT_SIZE
+        # Request ID to its response, None while it is being handled.
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def begin(self, req_id):
+        with self.lock:
+            if req_id in self.responses:
+                return False, self.responses[req_id]
+            self.responses[req_id] = None
+            while len(self.responses) > self.max_size:
+                self.responses.popitem(last=False)
+            return True, None
+
+    def finish(self, req_id, resp):
+        with self.lock:
+            if req_id in self.responses:
+                self.responses[req_id] = resp
+
+
+def parse_target(target):
+    if not target:
+        return None
+    if not isinstance(target, list):
+        target = target.split(",")
+    return set(target)
+
+
+def parse_selector(selector):
+    if not selector:
+        return None
+    return labels.Selector(selector)
+
+
+TEMPLATE_RE = re.compile(r"\{\{|\}\}|\{([a-z_]+)(?::([^{}]*))?\}")
+
+
+def expand_template(text, params, agent_labels):
+    # {agent_id}, {index}, {count} and {label:NAME}, {{ and }} escape.
+    def replace(match):
+        if match.group(0) in ("{{", "}}"):
+            return match.group(0)[0]
+        name, arg = match.groups()
+        if name == "label" and arg in agent_labels:
+            return str(agent_labels[arg])
+        if name in params and arg is None:
+            return str(params[name])
+        raise ValueError("Cannot expand '%s' in template '%s'." % (
+            match.group(0), text))
+    return TEMPLATE_RE.sub(replace, text)
+
+
+class SequenceTracker(object):
+    MAX_NACK = 100
+
+    def __init__(self):
+        self.expected = None
+
+    def receive(self, request):
+        seq = request.get("seq")
+        if seq is None or "replay_to" in request:
+            return []
+        if self.expected is None or seq < self.expected:
+            # First request seen, or the master has restarted.
+            self.expected = seq + 1
+            return []
+
+        missing = list(range(max(self.expected, seq - self.MAX_NACK), seq))
+        self.expected = seq + 1
+        return missing
+
+
+def send_delivery(push_socket, message):
+    try:
+        push_socket.send_json(message, zmq.NOBLOCK)
+    except zmq.Again:
+        # The master retransmits unacknowledged requests anyway.
+        pass
+
+
+def record_socket(socket, flight_recorder, event):
+    if flight_recorder is None:
+        return socket
+    return recorder.RecordingSocket(socket, flight_recorder, event)
+
+
+class LockedSocket(object):
+    def __init__(self, socket):
+        self.socket = socket
+        self.lock = threading.Lock()
+
+    def send_json(self, *args, **kwargs):
+        with self.lock:
+            return self.socket.send_json(*args, **kwargs)
+
+
 class Agent(object):
-    def __init__(self, subscribe_url, push_url, agent_id=None):
+    OUTBOX_POLL_INTERVAL = 100
+    TRANSFER_EXPIRE = 600
+
+    def __init__(self, subscribe_url, push_url, agent_id=None,
+                 capture_limit=None, script_cache=None, outbox=None,
+                 transport_profile=None, subscribe_socket=None,
+                 push_socket=None, spawn_client=None, labels=None,
+                 request_cache_size=None, profiler=None, recorder=None):
         if agent_id is None:
             agent_id = str(uuid.uuid4())
         self.agent_id = agent_id
+        self.transport_profile = (transport_profile or
+                                  transport.TransportProfile())
+        self.capture_limit = capture_limit
+        self.script_cache = script_cache or ScriptCache()
+        self.outbox = outbox
+        self.spawn_client = spawn_client
         self.executor = None
+        self.transfers = {}
+        self.clock_offset = 0.0
+        self.labels = labels or {}
+        self.sequence = SequenceTracker()
+        self.requests = RequestCache(request_cache_size)
+        self.profiler = profiler
+        self.recorder = recorder
 
-        self.subscribe_socket = self.init_subscribe_zmq(subscribe_url)
-        self.push_socket = self.init_push_zmq(push_url)
+        self.subscribe_socket = (subscribe_socket or
+                                 self.init_subscribe_zmq(subscribe_url))
+        self.push_socket = push_socket or self.init_push_zmq(push_url)
 
     def init_subscribe_zmq(self, subscribe_url):
-        subscribe_context = zmq.Context()
-        subscribe_socket = subscribe_context.socket(zmq.SUB)
+        subscribe_socket = self.transport_profile.socket(zmq.SUB)
         subscribe_socket.connect(subscribe_url)
-        subscribe_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+        transport.subscribe(subscribe_socket, [self.agent_id])
 
-        return subscribe_socket
+        return record_socket(subscribe_socket, self.recorder, "receive")
 
     def init_push_zmq(self, push_url):
-        push_context = zmq.Context()
-        push_socket = push_context.socket(zmq.PUSH)
+        push_socket = self.transport_profile.socket(zmq.PUSH)
         push_socket.connect(push_url)
 
-        return push_socket
+        return record_socket(push_socket, self.recorder, "send")
 
     def recv_request(self):
         request = self.subscribe_socket.recv_json()
-        target = request.get("target")
-        if target:
-            if not isinstance(target, list):
-                target = target.split(",")
-            if self.agent_id not in target:
-                return
+        missing = self.sequence.receive(request)
+        if missing:
+            send_delivery(self.push_socket,
+                          {"agents": [self.agent_id], "nack": missing})
+        if not self.is_target(request):
+            return
 
+        if "seq" in request:
+            send_delivery(self.push_socket, {"agents": [self.agent_id],
+                                             "ack_seq": request["seq"]})
         return request
 
+    def is_target(self, request):
+        replay_to = request.get("replay_to")
+        if replay_to is not None and self.agent_id not in replay_to:
+            return False
+        targets = parse_target(request.get("target"))
+        if targets is not None and self.agent_id not in targets:
+            return False
+        try:
+            selector = parse_selector(request.get("selector"))
+        except ValueError:
+            # The master validates selectors, nothing to answer to anyway.
+            return False
+        return selector is None or selector.matches(self.labels)
+
     def do_default(sef, req, resp):
         raise ValueError(
             "Action '%s' unknown." % req.get("action", "unspecified"))
 
+    def send(self, resp):
+        if self.outbox is None:
+            self.push_socket.send_json(resp)
+            return
+
+        self.outbox.append(resp)
+        self.flush_outbox()
+
+    def flush_outbox(self):
+        due = self.outbox.get_due()
+        for i, resp in enumerate(due):
+            try:
+                self.push_socket.send_json(resp, zmq.NOBLOCK)
+            except zmq.Again:
+                # Nobody to send to, try again with the next loop.
+                for resp in due[i:]:
+                    self.outbox.reschedule(resp["outbox_seq"])
+                break
+            self.outbox.reschedule(resp["outbox_seq"],
+                                   self.outbox.retry_interval)
+
+    @profiling.timed("Agent.loop")
     def loop(self):
+        if self.profiler is not None:
+            self.profiler.poll()
+        if self.outbox is not None:
+            self.flush_outbox()
+            if not self.subscribe_socket.poll(self.OUTBOX_POLL_INTERVAL):
+                return
+
         req = self.recv_request()
-        if req is None:
+        if req is None or not self.accept_request(req):
             return
+        self.handle_request(req)
+
+    def accept_request(self, req):
+        new, resp = self.requests.begin(req["req"])
+        if new:
+            return True
+
+        if req.get("noreply"):
+            return False
+        if resp is None:
+            # Advisory only, so not kept in the outbox.
+            send_delivery(self.push_socket, {
+                "req": req["req"], "agent": self.agent_id,
+                "in_progress": True})
+        elif self.outbox is None:
+            self.send(resp)
+        # Otherwise the outbox resends the response until it is acked.
+        return False
+
+    def handle_request(self, req):
+        if self.transfers:
+            self.expire_transfers()
+
         resp = {
             "req": req["req"],
             "agent": self.agent_id
         }
-        handler = getattr(self, "do_%s" % req.get("action", "default"),
-                          self.do_default)
+        name = "do_%s" % req.get("action", "default")
+        handler = getattr(self, name, None)
+        if handler is None:
+            name, handler = "do_default", self.do_default
         try:
-            new_resp = handler(req, resp)
+            with profiling.counters.timed("Agent.%s" % name):
+                new_resp = handler(req, resp)
             if new_resp: resp = new_resp
         except Exception as e:
             resp["error"] = str(e)
-        self.push_socket.send_json(resp)
+        self.requests.finish(req["req"], resp)
+        if not req.get("noreply"):
+            self.send(resp)
+
+    def do_outbox_ack(self, req, resp):
+        seqs = req["acks"].get(self.agent_id)
+        if seqs and self.outbox is not None:
+            self.outbox.ack(seqs)
 
     def do_ping(self, req, resp):
+        # Receive and send timestamps for the master's clock offset and
+        # round-trip estimate.
+        resp["recv_time"] = time.time()
         resp["time"] = datetime.datetime.utcnow().isoformat()
+        if self.labels:
+            resp["labels"] = self.labels
+        resp["send_time"] = time.time()
+
+    def do_profile(self, req, resp):
+        if self.profiler is None:
+            raise ValueError("Profiling is off, start with --profile.")
+        if req.get("seconds") is not None:
+            self.profiler.start(req["seconds"])
+        resp.update(self.profiler.get_result())
+        resp["counters"] = profiling.counters.snapshot()
+
+    def do_events(self, req, resp):
+        if self.recorder is None:
+            raise ValueError("Event recording is off, see --events-size.")
+        # "req" is the ID of this very request, events_req filters by ID.
+        resp.update(self.recorder.dump(
+            req=req.get("events_req"),
+            **dict((key, req[key]) for key in
+                   ("event", "agent", "since", "limit") if key in req)))
+
+    def do_clock(self, req, resp):
+        offset = req["offsets"].get(self.agent_id)
+        if offset is not None:
+            self.clock_offset = offset
 
     def do_tail(self, req, resp):
         if not self.executor or not (
@@ -160,10 +936,17 @@ class Agent(object):
             raise ValueError("No executor or pipes.")
 
         size = int(req.get("size", -1))
-        if self.executor.stdout_fh:
-            resp["stdout"] = self.executor.stdout_fh.read(size).decode("utf-8")
-        if self.executor.stderr_fh:
-            resp["stderr"] = self.executor.stderr_fh.read(size).decode("utf-8")
+        output_filter = OutputFilter.from_request(req)
+        for name in ("stdout", "stderr"):
+            fh = getattr(self.executor, "%s_fh" % name)
+            if not fh:
+                continue
+            text = fh.read(size).decode("utf-8")
+            if output_filter is not None:
+                text, fields = output_filter.apply(text)
+                if fields is not None:
+                    resp["%s_fields" % name] = fields
+            resp[name] = text
 
     def do_check(self, req, resp):
         if not self.executor or not self.executor.thread:
@@ -172,19 +955,242 @@ class Agent(object):
         if req.get("wait") or req.get("clear"):
             self.executor.thread.join()
         resp["exit_code"] = getattr(self.executor, "exit_code", None)
+        resp["usage"] = self.executor.usage
+        if self.executor.timeout is not None:
+            resp["timed_out"] = self.executor.timed_out
         if req.get("clear"):
             self.executor.clear()
             self.executor = None
 
+    def expand_request(self, req):
+        if not req.get("template"):
+            return req
+
+        # Shards are the target list, or all the agents the master knows to
+        # match the selector.
+        shards = sorted(parse_target(req.get("shards") or req.get("target"))
+                        or [])
+        params = {"agent_id": self.agent_id, "count": len(shards)}
+        if self.agent_id in shards:
+            params["index"] = shards.index(self.agent_id)
+
+        def expand(text):
+            return expand_template(text, params, self.labels)
+
+        # Copied, agents of a group share the request.
+        req = dict(req)
+        path = req.get("path")
+        if isinstance(path, list):
+            req["path"] = [expand(arg) for arg in path]
+        elif path is not None:
+            req["path"] = expand(path)
+        if req.get("env"):
+            req["env"] = dict((key, expand(value))
+                              for key, value in req["env"].items())
+        return req
+
     def do_command(self, req, resp):
         if self.executor and self.executor.thread:
             raise ValueError("A command is already being executed.")
 
-        executor = CommandExecutor(req, resp, self.agent_id)
+        req = self.expand_request(req)
+
+        executor = CommandExecutor(req, resp, self.agent_id,
+                                   capture_limit=self.capture_limit,
+                                   spawn_client=self.spawn_client,
+                                   clock_offset=self.clock_offset)
         if executor.thread:
             self.executor = executor
         return executor.run()
 
+    def do_file_status(self, req, resp):
+        transfer = self.transfers.get(req["file_id"])
+        if transfer is None:
+            transfer = self.transfers[req["file_id"]] = FileTransfer(
+                req["dest"], int(req["size"]), int(req["chunk_size"]),
+                req["sha256"])
+
+        resp["file_id"] = req["file_id"]
+        resp["complete"] = transfer.finish()
+        resp["missing"] = transfer.missing()
+        if resp["complete"]:
+            # Late status requests find the file in place and are cheap.
+            del self.transfers[req["file_id"]]
+
+    def expire_transfers(self):
+        deadline = monotonic() - self.TRANSFER_EXPIRE
+        for file_id, transfer in list(self.transfers.items()):
+            if transfer.last_used < deadline:
+                del self.transfers[file_id]
+                transfer.abort()
+
+    def do_file_chunk(self, req, resp):
+        transfer = self.transfers.get(req["file_id"])
+        if transfer is None:
+            raise ValueError("Unknown file transfer '%s'." % req["file_id"])
+
+        transfer.write_chunk(int(req["index"]),
+                             base64.b64decode(req["data"]), req["sha256"])
+
+    def do_put_script(self, req, resp):
+        resp["hash"] = self.script_cache.put(req["script"], req.get("hash"))
+
+    def do_run_cached(self, req, resp):
+        digest = req["hash"]
+        if "script" in req:
+            self.script_cache.put(req.pop("script"), digest)
+
+        path = self.script_cache.get(digest)
+        if path is None:
+            resp["cache_miss"] = digest
+            raise ValueError("Script '%s' is not cached." % digest)
+
+        args = req.get("args", [])
+        if not isinstance(args, list):
+            args = [args]
+        req["path"] = [path] + [str(arg) for arg in args]
+
+        return self.do_command(req, resp)
+
+
+class AgentGroup(object):
+    POLL_INTERVAL = 100
+
+    def __init__(self, subscribe_url, push_url, agent_ids,
+                 transport_profile=None, outbox_factory=None, **kwargs):
+        self.transport_profile = (transport_profile or
+                                  transport.TransportProfile())
+
+        subscribe_socket = self.transport_profile.socket(zmq.SUB)
+        subscribe_socket.connect(subscribe_url)
+        transport.subscribe(subscribe_socket, agent_ids)
+        self.subscribe_socket = record_socket(
+            subscribe_socket, kwargs.get("recorder"), "receive")
+
+        push_socket = self.transport_profile.socket(zmq.PUSH)
+        push_socket.connect(push_url)
+        self.push_socket = LockedSocket(record_socket(
+            push_socket, kwargs.get("recorder"), "send"))
+
+        self.agents = collections.OrderedDict()
+        for agent_id in agent_ids:
+            outbox = outbox_factory(agent_id) if outbox_factory else None
+            self.agents[agent_id] = Agent(
+                subscribe_url, push_url, agent_id, outbox=outbox,
+                transport_profile=self.transport_profile,
+                subscribe_socket=self.subscribe_socket,
+                push_socket=self.push_socket, **kwargs)
+
+        # Requests waiting for a busy agent. An agent is busy while it has
+        # an entry here, and exactly one worker thread runs for it then.
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.sequence = SequenceTracker()
+
+    def get_targets(self, request):
+        targets = parse_target(request.get("target"))
+        replay_to = request.get("replay_to")
+        if replay_to is not None:
+            targets = set(replay_to) & (targets or set(replay_to))
+        if targets is None:
+            agents = list(self.agents.values())
+        else:
+            agents = [self.agents[agent_id] for agent_id in targets
+                      if agent_id in self.agents]
+
+        try:
+            selector = parse_selector(request.get("selector"))
+        except ValueError:
+            return []
+        if selector is None:
+            return agents
+        return [agent for agent in agents if selector.matches(agent.labels)]
+
+    def dispatch(self, agent, request):
+        # Checked here rather than by the worker, so that a duplicate of a
+        # request still running is answered right away.
+        if not agent.accept_request(request):
+            return
+        # Handlers change the request in place, each agent gets its own.
+        request = dict(request)
+        if isinstance(request.get("env"), dict):
+            request["env"] = dict(request["env"])
+        with self.lock:
+            queue = self.queues.get(agent.agent_id)
+            if queue is not None:
+                queue.append(request)
+                return
+            self.queues[agent.agent_id] = collections.deque([request])
+
+        self._start_worker(agent)
+
+    def _start_worker(self, agent):
+        worker = threading.Thread(target=self._work, args=(agent,))
+        worker.daemon = True
+        worker.start()
+
+    def _work(self, agent):
+        while True:
+            with self.lock:
+                queue = self.queues[agent.agent_id]
+                if not queue:
+                    del self.queues[agent.agent_id]
+                    return
+                request = queue.popleft()
+            agent.handle_request(request)
+
+    def flush_outboxes(self):
+        for agent in self.agents.values():
+            if agent.outbox is None:
+                continue
+            with self.lock:
+                if agent.agent_id in self.queues:
+                    # Its worker owns the outbox for now.
+                    continue
+                # Keep the agent busy while flushing, requests dispatched
+                # meanwhile are queued for a worker started afterwards.
+                self.queues[agent.agent_id] = collections.deque()
+            try:
+                agent.flush_outbox()
+            finally:
+                self._resume(agent)
+
+    def _resume(self, agent):
+        with self.lock:
+            if not self.queues[agent.agent_id]:
+                del self.queues[agent.agent_id]
+                return
+        self._start_worker(agent)
+
+    def loop(self):
+        self.flush_outboxes()
+        if not self.subscribe_socket.poll(self.POLL_INTERVAL):
+            return
+
+        request = self.subscribe_socket.recv_json()
+        missing = self.sequence.receive(request)
+        if missing:
+            send_delivery(self.push_socket,
+                          {"agents": list(self.agents), "nack": missing})
+
+        targets = self.get_targets(request)
+        if targets and "seq" in request:
+            send_delivery(self.push_socket, {
+                "agents": [agent.agent_id for agent in targets],
+                "ack_seq": request["seq"]})
+        for agent in targets:
+            self.dispatch(agent, request)
+
+
+def get_agent_ids(agent_id, count):
+    if agent_id is None:
+        return [str(uuid.uuid4()) for i in range(count)]
+    if "{index}" not in agent_id:
+        if count == 1:
+            return [agent_id]
+        agent_id += "-{index}"
+    return [agent_id.format(index=index) for index in range(count)]
+
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(description="Run a ZMQ agent")
@@ -196,13 +1202,86 @@ def parse_args(args=None):
         "--push-url", help="ZMQ Push bind URL",
         default="tcp://localhost:1235")
     parser.add_argument(
-        "--agent-id", help="ZMQ agent ID")
+        "--agent-id",
+        help="ZMQ agent ID, with --count a pattern where {index} is "
+             "replaced by the agent number")
+    parser.add_argument(
+        "--label", action="append", default=[], type=labels.parse_label,
+        help="Label of the agent as key=value, matched by request "
+             "selectors; may be repeated")
+    parser.add_argument(
+        "--count", type=int, default=1,
+        help="Number of agents to run in this process, sharing its ZMQ "
+             "context and sockets")
+    parser.add_argument(
+        "--capture-limit", type=int,
+        help="Maximum number of bytes of synchronous command output to keep "
+             "per stream (head and tail halves), unlimited by default")
+    parser.add_argument(
+        "--script-cache-dir", default=ScriptCache.DEFAULT_PATH,
+        help="Directory to keep scripts sent with put_script in")
+    parser.add_argument(
+        "--script-cache-size", type=int, default=ScriptCache.DEFAULT_SIZE,
+        help="Maximum total size of the script cache in bytes")
+    parser.add_argument(
+        "--spawn-server", action="store_true",
+        help="Start commands from a small process forked at startup "
+             "instead of the agent process itself")
+    parser.add_argument(
+        "--outbox",
+        help="Keep responses in this append-only log until the master "
+             "acknowledges them, resending the unacknowledged ones; "
+             "{id} is replaced by the agent ID")
+    parser.add_argument(
+        "--outbox-retry", type=float, default=5.0,
+        help="Seconds to wait for an acknowledgement before resending")
+    parser.add_argument(
+        "--outbox-rate", type=float, default=100.0,
+        help="Maximum number of outbox responses sent per second")
+    parser.add_argument(
+        "--events-size", type=int, default=0,
+        help="Number of recent message events to keep for the events "
+             "action, off by default")
+    profiling.Profiler.add_arguments(parser)
+    parser.add_argument(
+        "--request-cache-size", type=int, default=RequestCache.DEFAULT_SIZE,
+        help="Number of recent request IDs to keep responses for, "
+             "duplicates of these are answered without running again")
+    transport.TransportProfile.add_arguments(parser)
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+    return args
 
 def main(args=None):
     args = parse_args(args)
-    agent = Agent(args.subscribe_url, args.push_url, args.agent_id)
+    # Fork the spawn server first, while the process is still small.
+    spawn_client = spawner.SpawnClient() if args.spawn_server else None
+
+    def outbox_factory(agent_id):
+        if args.outbox:
+            return Outbox(args.outbox.format(id=agent_id),
+                          args.outbox_retry, args.outbox_rate)
+
+    kwargs = dict(
+        capture_limit=args.capture_limit,
+        spawn_client=spawn_client,
+        labels=dict(args.label),
+        request_cache_size=args.request_cache_size,
+        profiler=profiling.Profiler.from_args(args),
+        recorder=(recorder.FlightRecorder(args.events_size)
+                  if args.events_size > 0 else None),
+        script_cache=ScriptCache(args.script_cache_dir,
+                                 args.script_cache_size),
+        transport_profile=transport.TransportProfile.from_args(args))
+    agent_ids = get_agent_ids(args.agent_id, args.count)
+    if len(agent_ids) == 1:
+        agent = Agent(args.subscribe_url, args.push_url, agent_ids[0],
+                      outbox=outbox_factory(agent_ids[0]), **kwargs)
+    else:
+        agent = AgentGroup(args.subscribe_url, args.push_url, agent_ids,
+                           outbox_factory=outbox_factory, **kwargs)
     while True:
         agent.loop()
 
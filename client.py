@@ -0,0 +1,303 @@
+#!/usr/bin/python
+
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import json
+import time
+import uuid
+
+import requests
+import requests.adapters
+
+
+class MasterAgentError(Exception):
+    pass
+
+
+def encode_fields(fields):
+    data = {}
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if key == "env" and isinstance(value, dict):
+            value = ["%s=%s" % item for item in sorted(value.items())]
+        # The master JSON-decodes every form field it can.
+        data[key] = json.dumps(value)
+    return data
+
+
+def script_hash(script):
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+class Client(object):
+    POOL_SIZE = 16
+    # Milliseconds each /poll of a stream waits for more responses.
+    STREAM_INTERVAL = 100
+    # Milliseconds each /jobs/<job> request of wait_job waits for.
+    JOB_WAIT = 1000
+    JOB_RESULTS_LIMIT = 1000
+
+    def __init__(self, url, pool_size=None, session=None):
+        self.url = url.rstrip("/")
+        self.session = session or requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size or self.POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Scripts the master has been sent, so that later runs only send
+        # their hashes.
+        self.scripts = set()
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _call(self, method, path, params=None, data=None):
+        resp = self.session.request(
+            method, self.url + path,
+            params=dict((key, value) for key, value in (params or {}).items()
+                        if value is not None),
+            data=data)
+        try:
+            result = resp.json()
+        except ValueError:
+            raise MasterAgentError("%s %s failed with HTTP status %d." % (
+                method, path, resp.status_code))
+        if resp.status_code != 200:
+            raise MasterAgentError(result.get("error", resp.status_code))
+        return result
+
+    def request(self, action, targets=None, selector=None, timeout=None,
+                agents=None, req_id=None, config=None, **fields):
+        if targets is not None:
+            fields["target"] = list(targets)
+        fields.update(selector=selector, req=req_id)
+        params = dict(config or {}, timeout=timeout, agents=agents)
+        return self._call("POST", "/" + action, params,
+                          encode_fields(fields))
+
+    def ping(self, targets=None, **kwargs):
+        return self.request("ping", targets, **kwargs)
+
+    def command(self, path, targets=None, env=None, thread=False,
+                **kwargs):
+        # With thread agents answer once started, see check and tail.
+        return self.request("command", targets, path=list(path), env=env,
+                            thread=thread or None, **kwargs)
+
+    def check(self, targets=None, **kwargs):
+        return self.request("check", targets, **kwargs)
+
+    def tail(self, targets=None, **kwargs):
+        return self.request("tail", targets, **kwargs)
+
+    def agents(self, selector=None):
+        return self._call("GET", "/agents", {"selector": selector})["agents"]
+
+    def poll(self, req_id=None, timeout=None, agents=None):
+        return self._call("GET", "/poll", {"req": req_id, "timeout": timeout,
+                                           "agents": agents})
+
+    def missed(self, timeout=None, delete=False, **filters):
+        # filters are req, agent, min_age, max_age, cursor and limit.
+        return self.missed_page(timeout, delete, **filters)["missed"]
+
+    def missed_page(self, timeout=None, delete=False, **filters):
+        return self._call("DELETE" if delete else "GET", "/missed",
+                          dict(filters, timeout=timeout))
+
+    def iter_missed(self, timeout=None, delete=False, **filters):
+        while True:
+            page = self.missed_page(timeout, delete, **filters)
+            for resps in page["missed"].values():
+                for resp in resps:
+                    yield resp
+            if page["next"] is None:
+                return
+            filters["cursor"] = page["next"]
+
+    def output(self, ref, first=None, last=None):
+        # ref is a spooled output reference such as resp["stdout_ref"],
+        # first and last select an inclusive byte range of it.
+        headers = {}
+        if first is not None or last is not None:
+            headers["Range"] = "bytes=%s-%s" % (
+                "" if first is None else first, "" if last is None else last)
+        resp = self.session.request("GET", self.url + ref, headers=headers)
+        if resp.status_code not in (200, 206):
+            raise MasterAgentError("GET %s failed with HTTP status %d." % (
+                ref, resp.status_code))
+        return resp.content
+
+    def submit_job(self, tasks, targets=None, selector=None, retries=None,
+                   task_timeout=None, action=None):
+        # tasks are dicts of request fields, e.g. {"path": [...]}.
+        fields = {"tasks": tasks, "selector": selector, "action": action}
+        if targets is not None:
+            fields["target"] = list(targets)
+        return self._call("POST", "/jobs",
+                          {"retries": retries, "task_timeout": task_timeout},
+                          encode_fields(fields))["job"]
+
+    def job(self, job_id, wait=None):
+        return self._call("GET", "/jobs/%s" % job_id, {"wait": wait})
+
+    def job_results(self, job_id, state=None, cursor=None, limit=None):
+        return self._call("GET", "/jobs/%s/results" % job_id,
+                          {"state": state, "cursor": cursor, "limit": limit})
+
+    def cancel_job(self, job_id):
+        return self._call("DELETE", "/jobs/%s" % job_id)
+
+    def wait_job(self, job_id, timeout=None):
+        # Waiting clients keep the master dispatching, see /jobs.
+        deadline = time.time() + timeout / 1000. if timeout else None
+        while True:
+            wait = self.JOB_WAIT
+            if deadline is not None:
+                wait = min(wait, max(0, (deadline - time.time()) * 1000))
+            progress = self.job(job_id, wait)
+            if progress["state"] == "finished" or (
+                    deadline is not None and time.time() >= deadline):
+                return progress
+
+    def iter_job_results(self, job_id, state=None):
+        cursor = None
+        while True:
+            page = self.job_results(job_id, state, cursor,
+                                    self.JOB_RESULTS_LIMIT)
+            for result in page["results"]:
+                yield result
+            if page["next"] is None:
+                return
+            cursor = page["next"]
+
+    def submit(self, action, targets=None, **kwargs):
+        # Returns at once, the responses are then collected by ID.
+        req_id = str(uuid.uuid4())
+        self.request(action, targets, timeout=0, req_id=req_id, **kwargs)
+        return req_id
+
+    def collect(self, req_id, timeout=1000, agents=None):
+        return list(self.iter_responses(req_id, timeout, agents))
+
+    def iter_responses(self, req_id, timeout=1000, agents=None):
+        deadline = time.time() + timeout / 1000.
+        received = 0
+        while agents is None or received < agents:
+            left = (deadline - time.time()) * 1000
+            if left <= 0:
+                return
+            responses = self.poll(
+                req_id, min(left, self.STREAM_INTERVAL),
+                None if agents is None else agents - received)
+            received += len(responses)
+            for resp in responses:
+                yield resp
+
+    def stream(self, action, targets=None, timeout=1000, agents=None,
+               **kwargs):
+        if agents is None and targets is not None:
+            agents = len(targets)
+        req_id = self.submit(action, targets, **kwargs)
+        return self.iter_responses(req_id, timeout, agents)
+
+    def batch(self, calls, timeout=1000):
+        # Every request is out before any response is waited for, the
+        # master keeps the early responses of the later ones meanwhile.
+        req_ids = [self.submit(action, **kwargs) for action, kwargs in calls]
+        deadline = time.time() + timeout / 1000.
+        results = []
+        for req_id, (action, kwargs) in zip(req_ids, calls):
+            targets = kwargs.get("targets")
+            results.append(self.collect(
+                req_id, max(0, (deadline - time.time()) * 1000),
+                None if targets is None else len(targets)))
+        return results
+
+    def run_and_wait(self, command=None, targets=None, script=None,
+                     args=None, timeout=10000, **kwargs):
+        if targets is not None:
+            targets = list(targets)
+            kwargs.setdefault("agents", len(targets))
+        if script is None:
+            if not isinstance(command, list):
+                command = ["sh", "-c", command]
+            responses = self.command(command, targets, timeout=timeout,
+                                     **kwargs)
+        else:
+            responses = self._run_script(script, args, targets, timeout,
+                                         kwargs)
+        return dict((resp["agent"], resp) for resp in responses)
+
+    def _run_script(self, script, args, targets, timeout, kwargs):
+        digest = script_hash(script)
+        fields = dict(kwargs, args=args, timeout=timeout)
+        if digest in self.scripts:
+            responses = self.request("run_cached", targets, hash=digest,
+                                     **fields)
+            if not any(resp.get("cache_miss") for resp in responses):
+                return responses
+            # The master has been restarted and lost it.
+        responses = self.request("run_cached", targets, script=script,
+                                 **fields)
+        self.scripts.add(digest)
+        return responses
+
+
+class AsyncClient(object):
+    def __init__(self, url, pool_size=None, session=None, executor=None):
+        self.client = Client(url, pool_size, session)
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(
+            pool_size or Client.POOL_SIZE)
+
+    def close(self):
+        self.executor.shutdown()
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def _run(self, method, *args, **kwargs):
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(method, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if name not in ("request", "ping", "command", "check", "tail",
+                        "agents", "poll", "missed", "missed_page",
+                        "output", "submit", "collect", "batch",
+                        "run_and_wait", "submit_job", "job", "job_results",
+                        "cancel_job", "wait_job"):
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+
+        async def call(*args, **kwargs):
+            return await self._run(method, *args, **kwargs)
+        return call
+
+    async def gather(self, calls):
+        return await asyncio.gather(*[
+            getattr(self, method)(*args, **kwargs)
+            for method, args, kwargs in calls])
+
+    async def stream(self, action, targets=None, timeout=1000, agents=None,
+                     **kwargs):
+        responses = await self._run(self.client.stream, action, targets,
+                                    timeout, agents, **kwargs)
+        done = object()
+        while True:
+            resp = await self._run(next, responses, done)
+            if resp is done:
+                return
+            yield resp
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+import collections
+import itertools
+import time
+import uuid
+
+monotonic = getattr(time, "monotonic", time.time)
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = (
+    "pending", "running", "done", "failed", "cancelled")
+
+
+def is_failure(resp):
+    return bool(resp.get("error")) or resp.get("exit_code") not in (None, 0)
+
+
+class Job(object):
+    DEFAULT_RETRIES = 2
+    # Milliseconds, so that a task sent to an agent gone since its last
+    # ping is retried elsewhere. 0 waits forever.
+    DEFAULT_TASK_TIMEOUT = 10 * 60 * 1000
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def __init__(self, tasks, agents, action="command", retries=None,
+                 task_timeout=None, job_id=None):
+        if not tasks:
+            raise ValueError("A job needs tasks.")
+        if not agents:
+            raise ValueError("A job needs a target list or agents known "
+                             "to match the selector.")
+        self.job_id = job_id or str(uuid.uuid4())
+        self.action = action
+        self.retries = int(self.DEFAULT_RETRIES if retries is None
+                           else retries)
+        # Seconds, a task running longer is retried elsewhere and its agent
+        # is left out until it answers.
+        if task_timeout is None:
+            task_timeout = self.DEFAULT_TASK_TIMEOUT
+        self.task_timeout = float(task_timeout) / 1000. or None
+
+        self.tasks = []
+        for spec in tasks:
+            if not isinstance(spec, dict):
+                raise ValueError("Tasks must be objects of request fields.")
+            # Background commands would answer before they are done.
+            spec = dict((key, value) for key, value in spec.items()
+                        if key not in ("thread", "target", "selector",
+                                       "req"))
+            if isinstance(spec.get("env"), list):
+                spec["env"] = dict(var.split("=", 1) for var in spec["env"])
+            self.tasks.append({"spec": spec, "state": PENDING,
+                               "attempts": 0, "agent": None,
+                               "result": None})
+        self.pending = collections.deque(range(len(self.tasks)))
+        # Each agent takes one task at a time and the next one once it has
+        # answered, so faster agents take on more of the job.
+        self.idle = collections.deque(agents)
+        self.agents = list(agents)
+        # Attempt request ID to (task index, agent, deadline).
+        self.running = {}
+        # Attempt request ID to agent, for attempts that timed out.
+        self.lost = {}
+        self.counts = collections.Counter({PENDING: len(self.tasks)})
+        self.completed = collections.Counter()
+        self.created = time.time()
+        self.finished = None
+
+    def is_active(self):
+        return self.finished is None
+
+    def _set_state(self, task, state):
+        self.counts[task["state"]] -= 1
+        self.counts[state] += 1
+        task["state"] = state
+
+    def dispatch(self):
+        now = monotonic()
+        requests = []
+        while self.pending and self.idle:
+            index = self.pending.popleft()
+            agent = self.idle.popleft()
+            task = self.tasks[index]
+            task["attempts"] += 1
+            task["agent"] = agent
+            self._set_state(task, RUNNING)
+
+            req_id = "%s-%d-%d" % (self.job_id, index, task["attempts"])
+            deadline = (now + self.task_timeout
+                        if self.task_timeout is not None else None)
+            self.running[req_id] = (index, agent, deadline)
+            requests.append((req_id, dict(task["spec"], action=self.action,
+                                          target=[agent])))
+        return requests
+
+    def get_req_ids(self):
+        return list(itertools.chain(self.running, self.lost))
+
+    def receive(self, req_id, resp):
+        if resp.get("in_progress"):
+            return
+        agent = self.lost.pop(req_id, None)
+        if agent is not None:
+            # Late but alive, the task has been retried already.
+            self.idle.append(agent)
+            return
+        if req_id not in self.running:
+            return
+
+        index, agent, _ = self.running.pop(req_id)
+        self.idle.append(agent)
+        task = self.tasks[index]
+        task["result"] = resp
+        if not is_failure(resp):
+            self._set_state(task, DONE)
+            self.completed[agent] += 1
+        else:
+            self._retry(index)
+
+    def _retry(self, index):
+        task = self.tasks[index]
+        if task["attempts"] > self.retries or self.finished is not None:
+            self._set_state(task, FAILED)
+        else:
+            self._set_state(task, PENDING)
+            self.pending.append(index)
+
+    def expire(self):
+        now = monotonic()
+        for req_id, (index, agent, deadline) in list(self.running.items()):
+            if deadline is None or deadline > now:
+                continue
+            del self.running[req_id]
+            self.lost[req_id] = agent
+            self.tasks[index]["result"] = {
+                "agent": agent, "error": "Task timed out."}
+            self._retry(index)
+
+    def check_finished(self):
+        if self.finished is None and not self.pending and not self.running:
+            self.finished = time.time()
+        elif (self.finished is None and self.pending and not self.idle and
+              not self.running):
+            # Every agent is lost, nobody is left to take the rest.
+            while self.pending:
+                task = self.tasks[self.pending.popleft()]
+                task["result"] = {"error": "No agents left."}
+                self._set_state(task, FAILED)
+            self.finished = time.time()
+
+    def cancel(self):
+        while self.pending:
+            self._set_state(self.tasks[self.pending.popleft()], CANCELLED)
+        # Running tasks may still finish, but are not retried.
+        self.running.clear()
+        for task in self.tasks:
+            if task["state"] == RUNNING:
+                self._set_state(task, CANCELLED)
+        if self.finished is None:
+            self.finished = time.time()
+
+    def progress(self):
+        return {
+            "job": self.job_id,
+            "state": "running" if self.finished is None else "finished",
+            "tasks": len(self.tasks),
+            "counts": dict((state, count)
+                           for state, count in self.counts.items() if count),
+            "agents": len(self.agents),
+            "completed_by": dict(self.completed),
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+    def results(self, state=None, cursor=None, limit=None):
+        limit = int(limit or self.DEFAULT_LIMIT)
+        if not 0 < limit <= self.MAX_LIMIT:
+            raise ValueError("Limit must be within (0, %d]." %
+                             self.MAX_LIMIT)
+        start = int(cursor) + 1 if cursor is not None else 0
+
+        results = []
+        next_cursor = None
+        for index in range(start, len(self.tasks)):
+            task = self.tasks[index]
+            if state is not None and task["state"] != state:
+                continue
+            if len(results) == limit:
+                next_cursor = results[-1]["task"]
+                break
+            results.append({"task": index, "state": task["state"],
+                            "attempts": task["attempts"],
+                            "agent": task["agent"],
+                            "result": task["result"]})
+        return {"job": self.job_id, "results": results, "next": next_cursor}
+
+
+class JobQueue(object):
+    MAX_FINISHED = 100
+
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+
+    def submit(self, job):
+        self.jobs[job.job_id] = job
+        finished = [job_id for job_id, old in self.jobs.items()
+                    if not old.is_active()]
+        for job_id in finished[:max(0, len(finished) - self.MAX_FINISHED)]:
+            del self.jobs[job_id]
+        return job
+
+    def get(self, job_id):
+        # KeyError for unknown jobs.
+        return self.jobs[job_id]
+
+    def is_active(self):
+        return any(job.is_active() for job in self.jobs.values())
+
+    def pump(self, publish, collect):
+        # collect(req_id) returns the responses received for req_id so far.
+        for job in self.jobs.values():
+            if not job.is_active():
+                continue
+            job.expire()
+            for req_id in job.get_req_ids():
+                for resp in collect(req_id):
+                    job.receive(req_id, resp)
+            for req_id, req in job.dispatch():
+                publish(req_id, req)
+            job.check_finished()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import re
+
+NAME = r"[A-Za-z0-9_./-]+"
+
+
+def parse_label(text):
+    key, sep, value = text.partition("=")
+    key = key.strip()
+    if not sep or not re.match("^%s$" % NAME, key):
+        raise ValueError("Invalid label '%s', expected key=value." % text)
+    return key, value.strip()
+
+
+class Selector(object):
+    TERM_RE = re.compile(
+        r"^\s*(?:"
+        r"!\s*(?P<absent>{name})|"
+        r"(?P<key>{name})\s*(?:"
+        r"(?P<op>!=|==|=)\s*(?P<value>{name}|)|"
+        r"\s(?P<set_op>in|notin)\s*\((?P<values>[^()]*)\)"
+        r")?"
+        r")\s*$".format(name=NAME))
+
+    def __init__(self, text):
+        self.text = text
+        self.terms = [self._parse_term(term) for term in self._split(text)]
+        if not self.terms:
+            raise ValueError("Empty selector.")
+
+    @classmethod
+    def _split(cls, text):
+        terms = []
+        depth = start = 0
+        for index, char in enumerate(text):
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "," and depth == 0:
+                terms.append(text[start:index])
+                start = index + 1
+        terms.append(text[start:])
+        return [term for term in terms if term.strip()]
+
+    @classmethod
+    def _parse_term(cls, term):
+        match = cls.TERM_RE.match(term)
+        if match is None:
+            raise ValueError("Invalid selector term '%s'." % term.strip())
+
+        if match.group("absent"):
+            return "absent", match.group("absent"), None
+        key = match.group("key")
+        if match.group("op"):
+            op = "!=" if match.group("op") == "!=" else "="
+            return op, key, match.group("value")
+        if match.group("set_op"):
+            values = set(value.strip()
+                         for value in match.group("values").split(","))
+            return match.group("set_op"), key, values - set([""])
+        return "exists", key, None
+
+    def matches(self, labels):
+        for op, key, value in self.terms:
+            label = labels.get(key)
+            if op == "=":
+                matched = label == value
+            elif op == "!=":
+                matched = label != value
+            elif op == "in":
+                matched = label in value
+            elif op == "notin":
+                matched = label not in value
+            elif op == "exists":
+                matched = key in labels
+            else:
+                matched = key not in labels
+            if not matched:
+                return False
+        return True
@@ -1,17 +1,32 @@
 #!/usr/bin/python
 
 import argparse
+import base64
+import bisect
 import cgi
 import collections
 import datetime
 import functools
+import hashlib
+import itertools
 import json
+import math
+import os
 import six
 import threading
 import time
 import uuid
 import zmq
 
+import jobs
+import labels
+import profiling
+import recorder
+import results
+import spool
+import tracing
+import transport
+
 datetime_now = datetime.datetime.now
 
 
@@ -19,46 +34,612 @@ INF = float("+inf")
 
 class AgentsRequest(object):
     def __init__(self, req, config, req_id=None):
-        self.req_id = req_id or str(uuid.uuid4())
+        # Clients may pick the ID to /poll for the responses by later.
+        self.req_id = req_id or req.get("req") or str(uuid.uuid4())
 
         self.req = req
         self.config = config
 
     def __call__(self, publish_socket, pull_socket):
+        config = dict(self.config)
+        expected = config.pop("expected", None)
+        latencies = config.pop("latencies", None)
+        if "wave" in config:
+            # Later waves would only look slow to the latency history.
+            return self.send_waves(publish_socket, pull_socket, expected,
+                                   config)
+        if latencies is not None:
+            config.setdefault("recv_times", {})
+        seq = self.publish(publish_socket, config.get("replay"))
+        sent = time.time()
+
+        if expected:
+            queue = self.recv_expected(seq, pull_socket, expected, latencies,
+                                       config)
+        else:
+            config.pop("quorum", None)
+            config.pop("straggler_factor", None)
+            queue = self.recv_responses(self.req_id, pull_socket, **config)
+
+        if latencies is not None:
+            latencies.update(self.req.get("action"), sent,
+                             config["recv_times"])
+        return queue
+
+    def publish(self, publish_socket, replay=None, target=None):
         req = {
             "req": self.req_id
         }
         req.update(self.req)
+        if target is not None:
+            req["target"] = target
 
+        seq = None
+        if replay is not None:
+            seq = replay.add(req)
         publish_socket.send_json(req)
+        return seq
+
+    def recv_expected(self, seq, pull_socket, expected, latencies, config):
+        replay = config.get("replay")
+        timeout = float(config.pop("timeout", 1000))
+        agents = float(config.pop("agents", INF))
+        quorum = config.pop("quorum", None)
+        if quorum is not None:
+            agents = min(agents,
+                         math.ceil(len(expected) * float(quorum) / 100.))
+        factor = config.pop("straggler_factor", None)
+        if factor is not None and latencies is None:
+            factor = None
+        interval = replay.get_interval(expected) if replay else None
+        retransmits = 0
+        tstart = datetime_now()
 
-        return self.recv_responses(
-            self.req_id, pull_socket, **self.config)
+        queue = []
+        pending = set(expected)
+        while len(queue) < agents:
+            if factor is not None and not pending:
+                break
+            left = timeout - (datetime_now() - tstart).total_seconds()*1000
+            if factor is not None:
+                # Past the deadline of every pending agent they are only
+                # holding everybody else up.
+                deadline = latencies.get_deadline(
+                    self.req.get("action"), pending, float(factor))
+                if deadline is not None:
+                    left = min(left, deadline * 1000 - (
+                        datetime_now() - tstart).total_seconds()*1000)
+            if left <= 0:
+                break
+
+            retransmit = (replay is not None and
+                          retransmits < replay.MAX_RETRANSMITS and
+                          interval < left)
+            queue += self.recv_responses(
+                self.req_id, pull_socket,
+                timeout=interval if retransmit else left,
+                agents=agents - len(queue), **config)
+            pending -= set(resp["agent"] for resp in queue)
+            if len(queue) >= agents:
+                break
+            if not retransmit:
+                if factor is None:
+                    break
+                continue
+
+            missing = pending - replay.get_acked(seq)
+            if missing:
+                replay.retransmit(seq, missing)
+                retransmits += 1
+                interval *= 2
+            else:
+                retransmits = replay.MAX_RETRANSMITS
+
+        if factor is not None or quorum is not None:
+            queue += [{"agent": agent_id, "straggler": True,
+                       "error": "No response yet, a late one goes to "
+                                "/missed."}
+                      for agent_id in sorted(pending)]
+        return queue
+
+    @staticmethod
+    def get_share(value, total):
+        # A count, or a percentage of total such as "25%".
+        value = str(value)
+        if value.endswith("%"):
+            return total * float(value[:-1]) / 100.
+        return float(value)
+
+    is_failure = staticmethod(jobs.is_failure)
+
+    def send_waves(self, publish_socket, pull_socket, expected, config):
+        wave_size = int(math.ceil(self.get_share(config.pop("wave"),
+                                                 len(expected))))
+        if wave_size <= 0:
+            raise ValueError("Wave size must be positive.")
+        # With an interval each wave starts that many milliseconds after
+        # the previous one. Without, the next wave starts once the previous
+        # one has answered or timed out.
+        interval = config.pop("wave_interval", None)
+        abort_errors = config.pop("abort_errors", None)
+        timeout = float(config.pop("timeout", 1000))
+        for key in ("agents", "quorum", "straggler_factor"):
+            config.pop(key, None)
+
+        waves = [expected[index:index + wave_size]
+                 for index in range(0, len(expected), wave_size)]
+        queue = []
+        pending = set()
+        sent = failures = 0
+        skipped = []
+        for index, wave in enumerate(waves):
+            tstart = datetime_now()
+            self.publish(publish_socket, config.get("replay"), wave)
+            pending.update(wave)
+            sent += len(wave)
+
+            last = index == len(waves) - 1
+            wave_timeout = timeout
+            if interval is not None and not last:
+                wave_timeout = float(interval)
+            # Late answers of earlier waves come in under the same ID.
+            for resp in self.recv_responses(
+                    self.req_id, pull_socket, timeout=wave_timeout,
+                    agents=len(pending), **config):
+                if resp.get("agent") in pending:
+                    pending.discard(resp["agent"])
+                    queue.append(resp)
+                    failures += self.is_failure(resp)
+
+            failed = failures
+            if interval is None:
+                failed += len(pending)
+            if (abort_errors is not None and not last and
+                    failed > self.get_share(abort_errors, sent)):
+                skipped = [agent_id for rest in waves[index + 1:]
+                           for agent_id in rest]
+                break
+            if interval is not None and not last:
+                # An answered wave returns early, the next one still waits
+                # for its interval.
+                left = wave_timeout - (
+                    datetime_now() - tstart).total_seconds()*1000
+                if left > 0:
+                    time.sleep(left / 1000.)
+
+        queue += [{"agent": agent_id, "error": "No response yet, a late one "
+                                               "goes to /missed."}
+                  for agent_id in sorted(pending)]
+        queue += [{"agent": agent_id, "skipped": True,
+                   "error": "Not sent, the rollout was aborted after %d "
+                            "failures." % failed}
+                  for agent_id in skipped]
+        return queue
 
     @classmethod
+    @profiling.timed("recv_responses")
     def recv_responses(cls, req_id, pull_socket, missed_queue=None,
-                       timeout=1000, agents=INF):
+                       timeout=1000, agents=INF, outbox_acks=None,
+                       recv_times=None, replay=None):
         tstart = datetime_now()
         timeout = float(timeout)
         agents = float(agents)
         queue = []
         if missed_queue is None:
-            missed_queue = {}
+            missed_queue = MissedQueue()
         queue = missed_queue.pop(req_id, [])
 
         left = timeout
         while (left > 0 and len(queue) < agents
                and pull_socket.poll(left)):
             resp = pull_socket.recv_json()
-            if resp["req"] != req_id:
-                missed_queue.setdefault(resp["req"], []).append(resp)
+            if outbox_acks is not None and outbox_acks.receive(resp):
+                pass
+            elif replay is not None and replay.receive(resp):
+                pass
+            elif "req" not in resp:
+                # Delivery acknowledgement while reliable mode is off.
+                pass
+            elif resp["req"] != req_id:
+                missed_queue.add(resp)
             else:
                 queue.append(resp)
+                if recv_times is not None:
+                    recv_times[resp["agent"]] = time.time()
             left = timeout - (datetime_now() - tstart).total_seconds()*1000
 
         return queue
 
 
+def script_hash(script):
+    return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+class ScriptStore(object):
+    DEFAULT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.DEFAULT_SIZE
+        self.scripts = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, digest):
+        script = self.scripts.pop(digest, None)
+        if script is not None:
+            self.scripts[digest] = script
+        return script
+
+    def put(self, script):
+        digest = script_hash(script)
+        old = self.scripts.pop(digest, None)
+        if old is not None:
+            self.size -= len(old)
+        self.scripts[digest] = script
+        self.size += len(script)
+
+        # Least recently used first, but always keep the newest script.
+        while self.size > self.max_size and len(self.scripts) > 1:
+            _, evicted = self.scripts.popitem(last=False)
+            self.size -= len(evicted)
+        return digest
+
+
+class ClockEstimates(object):
+    SAMPLES = 8
+
+    def __init__(self):
+        self.samples = {}
+
+    def update(self, agent_id, sent, agent_recv, agent_send, received):
+        offset = ((agent_recv - sent) + (agent_send - received)) / 2.0
+        rtt = (received - sent) - (agent_send - agent_recv)
+        samples = self.samples.setdefault(
+            agent_id, collections.deque(maxlen=self.SAMPLES))
+        samples.append((rtt, offset))
+        return self.get(agent_id)
+
+    def get(self, agent_id):
+        samples = self.samples.get(agent_id)
+        if not samples:
+            return None
+        # As NTP does, trust the recent sample with the lowest round-trip,
+        # it has the least room for asymmetric delays.
+        rtt, offset = min(samples)
+        return {"offset": offset, "rtt": rtt}
+
+
+class Membership(object):
+    # Seconds, agents that have not answered a ping for this long are
+    # taken to be gone.
+    MAX_AGE = 10 * 60
+
+    def __init__(self, max_age=None):
+        # Labels of the agents by ID, as of their last ping response.
+        self.agents = {}
+        self.seen = {}
+        self.max_age = max_age or self.MAX_AGE
+
+    def update(self, responses):
+        now = time.time()
+        for resp in responses:
+            if "recv_time" in resp:
+                self.agents[resp["agent"]] = resp.get("labels", {})
+                self.seen[resp["agent"]] = now
+
+    def expire(self):
+        deadline = time.time() - self.max_age
+        for agent_id, seen in list(self.seen.items()):
+            if seen < deadline:
+                del self.seen[agent_id]
+                del self.agents[agent_id]
+
+    def select(self, selector=None):
+        self.expire()
+        return sorted(agent_id
+                      for agent_id, agent_labels in self.agents.items()
+                      if selector is None or selector.matches(agent_labels))
+
+
+class LatencyHistory(object):
+    SAMPLES = 100
+    MIN_SAMPLES = 5
+    PERCENTILE = 99
+    # Seconds, so that tiny latencies do not make for hair triggers.
+    MIN_DEADLINE = 0.05
+
+    def __init__(self):
+        self.samples = {}
+
+    def update(self, action, sent, recv_times):
+        for agent_id, received in recv_times.items():
+            samples = self.samples.setdefault(
+                (action, agent_id), collections.deque(maxlen=self.SAMPLES))
+            samples.append(received - sent)
+
+    def get_percentile(self, action, agent_id):
+        samples = self.samples.get((action, agent_id))
+        if samples is None or len(samples) < self.MIN_SAMPLES:
+            return None
+        samples = sorted(samples)
+        index = int(math.ceil(self.PERCENTILE / 100. * len(samples))) - 1
+        return samples[max(index, 0)]
+
+    def get_deadline(self, action, agents, factor):
+        deadline = 0
+        for agent_id in agents:
+            latency = self.get_percentile(action, agent_id)
+            if latency is None:
+                # Nothing known to judge this one by.
+                return None
+            deadline = max(deadline, latency * factor)
+        return max(deadline, self.MIN_DEADLINE)
+
+
+class ReplayBuffer(object):
+    DEFAULT_SIZE = 1000
+    MAX_RETRANSMITS = 3
+    # Retransmit intervals, in ms.
+    DEFAULT_INTERVAL = 200
+    MIN_INTERVAL = 20
+    RTT_FACTOR = 4
+
+    def __init__(self, publish_socket, clocks, max_size=None):
+        self.publish_socket = publish_socket
+        self.clocks = clocks
+        self.max_size = max_size or self.DEFAULT_SIZE
+        self.next_seq = 0
+        self.requests = collections.OrderedDict()
+        self.acks = {}
+
+    def add(self, req):
+        req["seq"] = seq = self.next_seq
+        self.next_seq += 1
+        self.requests[seq] = req
+        self.acks[seq] = set()
+        while len(self.requests) > self.max_size:
+            evicted, _ = self.requests.popitem(last=False)
+            del self.acks[evicted]
+        return seq
+
+    def get_acked(self, seq):
+        return self.acks.get(seq, set())
+
+    def get_interval(self, agents):
+        rtts = [estimate["rtt"] for estimate in map(self.clocks.get, agents)
+                if estimate is not None]
+        if not rtts:
+            return self.DEFAULT_INTERVAL
+        return max(self.MIN_INTERVAL, self.RTT_FACTOR * max(rtts) * 1000)
+
+    def retransmit(self, seq, agents):
+        req = self.requests.get(seq)
+        if req is None:
+            return
+
+        target = req.get("target")
+        if target:
+            if not isinstance(target, list):
+                target = target.split(",")
+            agents = set(agents) & set(target)
+        if agents:
+            # Still a broadcast, but only these agents take it.
+            self.publish_socket.send_json(
+                dict(req, replay_to=sorted(agents)))
+
+    def receive(self, resp):
+        if "ack_seq" in resp:
+            acked = self.acks.get(resp["ack_seq"])
+            if acked is not None:
+                acked.update(resp["agents"])
+            return True
+        if "nack" in resp:
+            for seq in resp["nack"]:
+                self.retransmit(seq, resp["agents"])
+            return True
+        return False
+
+
+class OutboxAcks(object):
+    MAX_SEEN = 10000
+
+    def __init__(self):
+        self.pending = {}
+        self.seen = collections.defaultdict(collections.OrderedDict)
+
+    def receive(self, resp):
+        seq = resp.get("outbox_seq")
+        if seq is None:
+            return False
+
+        # Acknowledge duplicates as well, the first ack could be lost.
+        self.pending.setdefault(resp["agent"], []).append(seq)
+
+        seen = self.seen[resp["agent"]]
+        key = (resp["req"], seq)
+        if key in seen:
+            return True
+        seen[key] = True
+        if len(seen) > self.MAX_SEEN:
+            seen.popitem(last=False)
+        return False
+
+    def pop_requests(self):
+        # One per agent under its own topic, so that agents do not receive
+        # the acknowledgements of the whole swarm.
+        requests = [collections.OrderedDict([
+            (transport.get_ack_key(agent_id), True),
+            ("req", str(uuid.uuid4())),
+            ("action", "outbox_ack"),
+            ("noreply", True),
+            ("target", [agent_id]),
+            ("acks", {agent_id: seqs})])
+            for agent_id, seqs in sorted(self.pending.items())]
+        self.pending = {}
+        return requests
+
+
+class MissedQueue(object):
+    DEFAULT_LIMIT = 1000
+    MAX_LIMIT = 10000
+
+    def __init__(self):
+        self.counter = itertools.count(1)
+        # ID to (receive time, response), IDs grow with receive time.
+        self.entries = {}
+        # Ascending IDs, all of them and by request and agent. Removed IDs
+        # stay until the next compaction.
+        self.ids = []
+        self.by_req = collections.defaultdict(list)
+        self.by_agent = collections.defaultdict(list)
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, resp):
+        entry_id = next(self.counter)
+        self.entries[entry_id] = (time.time(), resp)
+        self.ids.append(entry_id)
+        self.by_req[resp["req"]].append(entry_id)
+        self.by_agent[resp.get("agent")].append(entry_id)
+
+    def pop(self, req_id, default=None):
+        ids = self.by_req.pop(req_id, None)
+        if ids is None:
+            return default
+        return [resp for _, resp in self._remove(ids)]
+
+    def _remove(self, ids):
+        removed = [self.entries.pop(entry_id) for entry_id in ids
+                   if entry_id in self.entries]
+        self.stale += len(removed)
+        if self.stale > len(self.entries):
+            self._compact()
+        return removed
+
+    def _compact(self):
+        self.ids = [entry_id for entry_id in self.ids
+                    if entry_id in self.entries]
+        for index in (self.by_req, self.by_agent):
+            for key, ids in list(index.items()):
+                ids[:] = [entry_id for entry_id in ids
+                          if entry_id in self.entries]
+                if not ids:
+                    del index[key]
+        self.stale = 0
+
+    def query(self, req=None, agent=None, min_age=None, max_age=None,
+              cursor=None, limit=None, delete=False):
+        limit = int(limit or self.DEFAULT_LIMIT)
+        if not 0 < limit <= self.MAX_LIMIT:
+            raise ValueError("Limit must be within (0, %d]." %
+                             self.MAX_LIMIT)
+        now = time.time()
+        newest = now - float(min_age) if min_age is not None else INF
+        oldest = now - float(max_age) if max_age is not None else -INF
+
+        if req is not None:
+            ids = self.by_req.get(req, [])
+        elif agent is not None:
+            ids = self.by_agent.get(agent, [])
+        else:
+            ids = self.ids
+
+        matched = []
+        next_cursor = None
+        start = bisect.bisect_right(ids, int(cursor)) if cursor else 0
+        for entry_id in itertools.islice(ids, start, None):
+            entry = self.entries.get(entry_id)
+            if entry is None or (
+                    agent is not None and entry[1].get("agent") != agent):
+                continue
+            if entry[0] > newest:
+                # The rest is newer still.
+                break
+            if entry[0] < oldest:
+                continue
+            if len(matched) == limit:
+                next_cursor = matched[-1]
+                break
+            matched.append(entry_id)
+
+        missed = collections.OrderedDict()
+        entries = ([self.entries[entry_id] for entry_id in matched]
+                   if not delete else self._remove(matched))
+        for _, resp in entries:
+            missed.setdefault(resp["req"], []).append(resp)
+        return {"missed": missed, "next": next_cursor, "total": len(self)}
+
+
+class FileDistribution(object):
+    DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, source, chunk_size=None):
+        self.source = source
+        self.chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        self.file_id = str(uuid.uuid4())
+
+        digest = hashlib.sha256()
+        self.chunk_hashes = []
+        self.size = 0
+        with open(source, "rb") as fh:
+            for chunk in iter(lambda: fh.read(self.chunk_size), b""):
+                digest.update(chunk)
+                self.chunk_hashes.append(hashlib.sha256(chunk).hexdigest())
+                self.size += len(chunk)
+        self.sha256 = digest.hexdigest()
+
+    def get_status_request(self, dest):
+        return {
+            "action": "file_status",
+            "file_id": self.file_id,
+            "dest": dest,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "sha256": self.sha256,
+        }
+
+    def get_chunk_request(self, fh, index):
+        fh.seek(index * self.chunk_size)
+        data = fh.read(self.chunk_size)
+        return {
+            "action": "file_chunk",
+            "noreply": True,
+            "file_id": self.file_id,
+            "index": index,
+            "sha256": self.chunk_hashes[index],
+            "data": base64.b64encode(data).decode("ascii"),
+        }
+
+    @classmethod
+    def get_missing_chunks(cls, responses):
+        missing = collections.defaultdict(list)
+        for resp in responses:
+            for start, end in resp.get("missing", []):
+                for index in range(start, end):
+                    missing[index].append(resp["agent"])
+        return missing
+
+
+def summarize_usage(responses):
+    summary = {}
+    for resp in responses:
+        for key, value in (resp.get("usage") or {}).items():
+            stats = summary.get(key)
+            if stats is None:
+                stats = summary[key] = {
+                    "count": 0, "sum": 0, "min": value, "max": value}
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["min"] = min(stats["min"], value)
+            stats["max"] = max(stats["max"], value)
+
+    for stats in summary.values():
+        stats["mean"] = stats["sum"] / float(stats["count"])
+
+    return summary
+
+
 class RegisterHandlerMeta(type):
     def __new__(cls, clsname, base, namespace):
         methods = namespace["methods"] = collections.defaultdict(dict)
@@ -84,6 +665,8 @@ def register(path, methods=('GET',)):
 class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
     POST_CONFIG = dict(timeout=1000, agents=INF)
     POLL_CONFIG = dict(timeout=10000, agents=INF)
+    MISSED_FILTERS = ("req", "agent", "min_age", "max_age", "cursor",
+                      "limit")
 
     def __init__(self, request, client_address, server, path=None):
         self.pull_socket = server.pull_socket
@@ -107,13 +690,200 @@ class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
     @register("/missed", ('GET', 'DELETE'))
     def missed(self):
         config = self._get_request_from_url(**self.POLL_CONFIG)
+        filters = dict((key, config.pop(key)) for key in self.MISSED_FILTERS
+                       if key in config)
         AgentsRequest.recv_responses(
             None, self.pull_socket, self.server_vars.missed_queue,
-            **config)
+            outbox_acks=self.server_vars.outbox_acks,
+            replay=self.server_vars.replay, **config)
+
+        # DELETE removes just the page returned, so that concurrent users
+        # do not lose responses they have not seen.
+        try:
+            page = self.server_vars.missed_queue.query(
+                delete=self.command == "DELETE", **filters)
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(page)
+
+    @register("/agents")
+    def agents(self):
+        selector = self._get_request_from_url().get("selector")
+        try:
+            selector = labels.Selector(selector) if selector else None
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+
+        membership = self.server_vars.membership
+        self.send_json_response(
+            {"agents": dict((agent_id, membership.agents[agent_id])
+                            for agent_id in membership.select(selector))})
+
+    @register("/debug/profile")
+    def debug_profile(self):
+        profiler = self.server_vars.profiler
+        if profiler is None:
+            self.send_json_response(
+                {"error": "Profiling is off, start with --profile."},
+                status=400)
+            return
+
+        seconds = self._get_request_from_url().get("seconds")
+        try:
+            if seconds is not None:
+                profiler.start(seconds)
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(profiler.get_result())
+
+    @register("/debug/events")
+    def debug_events(self):
+        if self.server_vars.recorder is None:
+            self.send_json_response(
+                {"error": "Event recording is off, see --events-size."},
+                status=400)
+            return
+
+        filters = self._get_request_from_url()
+        try:
+            events = self.server_vars.recorder.dump(**filters)
+        except (TypeError, ValueError) as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(events)
+
+    @register("/results")
+    def get_results(self):
+        if self.server_vars.results is None:
+            self.send_json_response(
+                {"error": "Result store is off, see --results-db."},
+                status=400)
+            return
+
+        filters = self._get_request_from_url()
+        try:
+            page = self.server_vars.results.query(**filters)
+        except (TypeError, ValueError) as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(page)
+
+    @register("/output/")
+    def output(self):
+        if self.server_vars.spool is None:
+            self.send_json_response(
+                {"error": "Output spooling is off, see --spool-dir."},
+                status=400)
+            return
+
+        names = [six.moves.urllib.parse.unquote(name)
+                 for name in self.url.path.split("/")[2:]]
+        try:
+            fh = self.server_vars.spool.open(*names)
+        except (TypeError, ValueError, IOError, OSError):
+            self.send_json_response({"error": "No such output."}, status=404)
+            return
+
+        with fh:
+            size = os.fstat(fh.fileno()).st_size
+            try:
+                byte_range = spool.parse_range(self.headers.get("Range"),
+                                               size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % size)
+                self.end_headers()
+                return
+
+            first, last = byte_range or (0, size - 1)
+            if byte_range is None:
+                self.send_response(200)
+            else:
+                self.send_response(206)
+                self.send_header("Content-Range",
+                                 "bytes %d-%d/%d" % (first, last, size))
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(last - first + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            self.send_file(fh, first, last - first + 1)
+
+    def send_file(self, fh, offset, count):
+        if count <= 0:
+            return
+        sendfile = getattr(self.connection, "sendfile", None)
+        if sendfile is not None:
+            # Zero copy where the platform has it.
+            sendfile(fh, offset, count)
+            return
+        fh.seek(offset)
+        while count > 0:
+            data = fh.read(min(count, 64 * 1024))
+            if not data:
+                break
+            self.wfile.write(data)
+            count -= len(data)
+
+    @register("/jobs", ('GET', 'POST'))
+    def jobs(self):
+        job_queue = self.server_vars.jobs
+        if self.command == "GET":
+            self.send_json_response(
+                {"jobs": [job.progress() for job in job_queue.jobs.values()]})
+            return
+
+        req = self._get_request_from_post()
+        req.update(self._get_request_from_url())
+        try:
+            job = jobs.Job(
+                req.get("tasks"), self._get_expected_agents(req),
+                req.get("action", "command"), req.get("retries"),
+                req.get("task_timeout"))
+        except (TypeError, ValueError) as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        job_queue.submit(job)
+        self.pump_jobs()
+        self.send_json_response(job.progress())
+
+    @register("/jobs/", ('GET', 'DELETE'))
+    def job(self):
+        # /jobs/<job> for progress, /jobs/<job>/results for task results.
+        names = self.url.path.split("/")[2:]
+        try:
+            job = self.server_vars.jobs.get(names[0])
+        except KeyError:
+            job = None
+        if job is None or names[1:] not in ([], ["results"]):
+            self.send_json_response({"error": "No such job."}, status=404)
+            return
 
-        self.send_json_response({"missed": self.server_vars.missed_queue})
         if self.command == "DELETE":
-            self.server_vars.missed_queue.clear()
+            job.cancel()
+            self.send_json_response(job.progress())
+            return
+
+        params = self._get_request_from_url()
+        try:
+            self.pump_jobs(float(params.pop("wait", 0)), job)
+            if names[1:]:
+                page = job.results(**params)
+            else:
+                page = job.progress()
+        except (TypeError, ValueError) as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(page)
+
+    @register("/debug/counters", ('GET', 'DELETE'))
+    def debug_counters(self):
+        self.send_json_response(
+            {"counters": profiling.counters.snapshot()})
+        if self.command == "DELETE":
+            profiling.counters.clear()
 
     @register("/ping")
     def ping(self):
@@ -123,29 +893,115 @@ class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
     @register("/poll")
     def poll(self):
         config = self._get_request_from_url(**self.POLL_CONFIG)
+        summary = config.pop("summary", None)
 
         responses = AgentsRequest.recv_responses(
             config.pop("req", self.server_vars.last_req_id),
             self.pull_socket, self.server_vars.missed_queue,
-            **config)
-        self.send_json_response(responses)
+            outbox_acks=self.server_vars.outbox_acks,
+            replay=self.server_vars.replay, **config)
+        self.send_json_response(self._summarize(responses, summary))
 
-    def route(self):
+    @classmethod
+    def _summarize(cls, responses, summary=None):
+        if summary == "usage":
+            return {"responses": responses,
+                    "usage": summarize_usage(responses)}
+        return responses
+
+    def _get_handler(self):
         path = self.url.path
-        try:
-            handler = self.methods[self.command][path]
-        except KeyError:
+        handlers = self.methods.get(self.command, {})
+        if path not in handlers:
+            # Paths registered with a trailing slash take any path under
+            # them, e.g. /output/<req>/<agent>/<stream>.
+            path = path[:path.find("/", 1) + 1]
+        return path, handlers.get(path)
+
+    def route(self):
+        path, handler = self._get_handler()
+        if handler is None:
             self.send_response(404)
             self.end_headers()
             return
 
-        return handler(self)
+        self.poll_profiler()
+        self.trace_http()
+        try:
+            with profiling.counters.timed("route %s %s" % (self.command,
+                                                           path)):
+                return handler(self)
+        finally:
+            self.send_outbox_acks()
+            self.pump_jobs()
 
     do_PUT = do_GET = do_DELETE = route
 
     def do_POST(self):
+        if self._get_handler()[1] is not None:
+            return self.route()
+
+        self.poll_profiler()
+        self.trace_http()
         config = self._get_request_from_url(**self.POST_CONFIG)
-        self.send_request_to_agents(config)
+        try:
+            self.send_request_to_agents(config)
+        finally:
+            self.send_outbox_acks()
+            self.pump_jobs()
+
+    def poll_profiler(self):
+        if self.server_vars.profiler is not None:
+            self.server_vars.profiler.poll()
+
+    def trace_http(self):
+        if self.server_vars.tracer is None:
+            return
+
+        body = b""
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            # Keep the body readable for _get_request_from_post().
+            body = self.rfile.read(length)
+            self.rfile = six.BytesIO(body)
+        self.server_vars.tracer.write("http", {
+            "method": self.command,
+            "path": self.path,
+            "content_type": self.headers.get("Content-Type"),
+            "body": body.decode("latin-1"),
+        })
+
+    def pump_jobs(self, wait=0, job=None):
+        # Jobs only move on while the master serves requests, waiting
+        # clients keep them going.
+        job_queue = self.server_vars.jobs
+        missed_queue = self.server_vars.missed_queue
+        replay = self.server_vars.replay
+
+        def publish(req_id, req):
+            AgentsRequest(req, {}, req_id).publish(self.publish_socket,
+                                                   replay)
+
+        def collect(req_id):
+            return missed_queue.pop(req_id, [])
+
+        tstart = datetime_now()
+        while True:
+            job_queue.pump(publish, collect)
+            active = job.is_active() if job else job_queue.is_active()
+            left = wait - (datetime_now() - tstart).total_seconds()*1000
+            if not active or left <= 0:
+                return
+            if self.pull_socket.poll(left):
+                # Whatever came in goes to the missed queue, to collect.
+                AgentsRequest.recv_responses(
+                    None, self.pull_socket, missed_queue, timeout=1,
+                    outbox_acks=self.server_vars.outbox_acks,
+                    replay=replay)
+
+    def send_outbox_acks(self):
+        for req in self.server_vars.outbox_acks.pop_requests():
+            self.publish_socket.send_json(req)
 
     def _parse_request(self):
         req = self._get_request_from_post()
@@ -154,6 +1010,8 @@ class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
         if set(req) & set(url_req):
             raise ValueError("Duplicate argumets.")
         req.update(url_req)
+        if req.get("selector"):
+            labels.Selector(req["selector"])
 
         return req
 
@@ -167,10 +1025,170 @@ class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
             )
             return
 
+        summary = config.pop("summary", None)
+        name = "_request_%s" % req["action"]
+        sender = getattr(self, name, None)
+        if sender is None:
+            # Any action goes, do not count each of them apart.
+            name, sender = "_request_agents", self._request_agents
+        try:
+            with profiling.counters.timed(name):
+                response = sender(req, config)
+        except ValueError as e:
+            self.send_json_response({"error": str(e)}, status=400)
+            return
+        self.send_json_response(self._summarize(response, summary))
+
+    def _request_agents(self, req, config):
+        if req.get("selector") and float(config.get("agents", INF)) == INF:
+            # Stop waiting once every known matching agent has answered.
+            known = self.server_vars.membership.select(
+                labels.Selector(req["selector"]))
+            if known:
+                config = dict(config, agents=len(known))
+
+        if req.get("template") and "shards" not in req:
+            # Agents number themselves within the full set, which resends
+            # and waves narrowing the target later must not change.
+            req["shards"] = self._get_expected_agents(req)
+
+        config = dict(config, outbox_acks=self.server_vars.outbox_acks,
+                      missed_queue=self.server_vars.missed_queue,
+                      latencies=self.server_vars.latencies)
+        if (self.server_vars.replay is not None or "quorum" in config or
+                "straggler_factor" in config or "wave" in config):
+            config["expected"] = self._get_expected_agents(req)
+        if "wave" in config and not config["expected"]:
+            raise ValueError("Waves need a target list or agents known to "
+                             "match the selector.")
+        if self.server_vars.replay is not None:
+            config["replay"] = self.server_vars.replay
+
         request = AgentsRequest(req, config)
         self.server_vars.last_req_id = request.req_id
-        response = request(self.publish_socket, self.pull_socket)
-        self.send_json_response(response)
+        return request(self.publish_socket, self.pull_socket)
+
+    def _get_expected_agents(self, req):
+        target = req.get("target")
+        if target:
+            if not isinstance(target, list):
+                target = target.split(",")
+            return sorted(set(target))
+
+        selector = req.get("selector")
+        return self.server_vars.membership.select(
+            labels.Selector(selector) if selector else None)
+
+    def _request_ping(self, req, config):
+        recv_times = {}
+        sent = time.time()
+        responses = self._request_agents(
+            req, dict(config, recv_times=recv_times))
+
+        self.server_vars.membership.update(responses)
+        offsets = {}
+        for resp in responses:
+            received = recv_times.get(resp["agent"])
+            if received is None or "recv_time" not in resp:
+                continue
+            estimate = self.server_vars.clocks.update(
+                resp["agent"], sent, resp["recv_time"], resp["send_time"],
+                received)
+            resp["clock_offset"] = offsets[resp["agent"]] = estimate["offset"]
+            resp["rtt"] = estimate["rtt"]
+
+        if offsets:
+            AgentsRequest(
+                {"action": "clock", "noreply": True, "offsets": offsets}, {}
+            ).publish(self.publish_socket)
+        return responses
+
+    def _request_command(self, req, config):
+        start_in = req.pop("start_in", None)
+        if start_in is not None:
+            req["start_at"] = time.time() + float(start_in) / 1000.
+        return self._request_agents(req, config)
+
+    def _request_put_script(self, req, config):
+        self.server_vars.scripts.put(req["script"])
+        return self._request_agents(req, config)
+
+    def _request_run_cached(self, req, config):
+        script = req.pop("script", None)
+        if script is not None:
+            req["hash"] = self.server_vars.scripts.put(script)
+        else:
+            script = self.server_vars.scripts.get(req.get("hash"))
+
+        responses = self._request_agents(req, dict(config))
+        missing = [resp["agent"] for resp in responses
+                   if resp.get("cache_miss")]
+        if not missing or script is None:
+            return responses
+
+        # Resend the script body only to the agents that do not have it.
+        retry_req = dict(req, script=script, target=missing)
+        # A new ID, agents would answer the old one from their cache.
+        retry_req.pop("req", None)
+        retry_config = dict(config, agents=len(missing))
+        last_req_id = self.server_vars.last_req_id
+        retried = self._request_agents(retry_req, retry_config)
+        # /poll keeps following the original request.
+        self.server_vars.last_req_id = last_req_id
+        retried_agents = set(resp["agent"] for resp in retried)
+
+        return [resp for resp in responses
+                if resp["agent"] not in retried_agents] + retried
+
+    def _request_distribute(self, req, config):
+        distribution = FileDistribution(
+            req["source"], int(req.get("chunk_size", 0)))
+        status_req = distribution.get_status_request(req["dest"])
+        target = req.get("target")
+        if target:
+            status_req["target"] = target
+            if not isinstance(target, list):
+                target = target.split(",")
+        expected = set(target or [])
+        rounds = int(req.get("rounds", 3))
+        interval = float(req.get("interval", 0)) / 1000.
+
+        with open(distribution.source, "rb") as fh:
+            for attempt in range(rounds + 1):
+                responses = self._request_agents(dict(status_req),
+                                                 dict(config))
+                replied = set(resp["agent"] for resp in responses
+                              if "missing" in resp)
+                if not target:
+                    # Agents that answered once have to answer again.
+                    expected |= replied
+                silent = expected - replied
+
+                statuses = list(responses)
+                if target:
+                    # A targeted agent that did not answer in time may be
+                    # missing anything.
+                    everything = [[0, len(distribution.chunk_hashes)]]
+                    statuses += [{"agent": agent, "missing": everything}
+                                 for agent in silent]
+                missing = distribution.get_missing_chunks(statuses)
+                if (not missing and not silent) or attempt == rounds:
+                    break
+
+                everyone = replied | silent if target else replied
+                for index in sorted(missing):
+                    chunk_req = distribution.get_chunk_request(fh, index)
+                    if set(missing[index]) != everyone:
+                        chunk_req["target"] = missing[index]
+                    elif req.get("target"):
+                        chunk_req["target"] = req["target"]
+                    AgentsRequest(chunk_req, {}).publish(self.publish_socket)
+                    if interval:
+                        time.sleep(interval)
+
+        return responses + [
+            {"agent": agent, "error": "No file_status response."}
+            for agent in sorted(silent)]
 
     def _get_request_from_post(self):
         if (not self.headers.get("Content-Length") or
@@ -207,8 +1225,20 @@ class RequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler, object):
 
 class ServerVariables(object):
     def __init__(self):
-        self.missed_queue = {}
+        self.missed_queue = MissedQueue()
         self.last_req_id = None
+        self.scripts = ScriptStore()
+        self.outbox_acks = OutboxAcks()
+        self.clocks = ClockEstimates()
+        self.membership = Membership()
+        self.replay = None
+        self.latencies = LatencyHistory()
+        self.profiler = None
+        self.recorder = None
+        self.tracer = None
+        self.results = None
+        self.spool = None
+        self.jobs = jobs.JobQueue()
 
 class MasterAgentHTTPServer(six.moves.BaseHTTPServer.HTTPServer):
     def __init__(self, address, request, publish_socket, pull_socket):
@@ -218,13 +1248,14 @@ class MasterAgentHTTPServer(six.moves.BaseHTTPServer.HTTPServer):
         self.server_vars = ServerVariables()
 
 
-def init_zmq(publish_url, pull_url):
-    publish_context = zmq.Context()
-    publish_socket = publish_context.socket(zmq.PUB)
+def init_zmq(publish_url, pull_url, transport_profile=None):
+    if transport_profile is None:
+        transport_profile = transport.TransportProfile()
+
+    publish_socket = transport_profile.socket(zmq.PUB)
     publish_socket.bind(publish_url)
 
-    pull_context = zmq.Context()
-    pull_socket = pull_context.socket(zmq.PULL)
+    pull_socket = transport_profile.socket(zmq.PULL)
     pull_socket.bind(pull_url)
 
     return publish_socket, pull_socket
@@ -245,23 +1276,92 @@ def parse_args(args=None):
     parser.add_argument(
         "--pull-url", help="ZMQ Pull bind URL",
         default="tcp://*:1235")
+    parser.add_argument(
+        "--reliable", action="store_true",
+        help="Number requests, replay the ones agents report missing and "
+             "retransmit to known targets that do not acknowledge them")
+    parser.add_argument(
+        "--replay-size", type=int, default=ReplayBuffer.DEFAULT_SIZE,
+        help="Number of recent requests kept for replay")
+    parser.add_argument(
+        "--events-size", type=int,
+        default=recorder.FlightRecorder.DEFAULT_SIZE,
+        help="Number of recent message events to keep for /debug/events, "
+             "0 turns recording off")
+    parser.add_argument(
+        "--spool-dir",
+        help="Store agent outputs larger than --spool-threshold in this "
+             "directory and return /output references instead")
+    parser.add_argument(
+        "--spool-threshold", type=int,
+        default=spool.OutputSpool.DEFAULT_THRESHOLD,
+        help="Size in characters above which outputs are spooled")
+    parser.add_argument(
+        "--results-db",
+        help="Keep every agent response in this SQLite database for "
+             "/results queries")
+    parser.add_argument(
+        "--results-batch", type=int, default=results.ResultStore.BATCH_SIZE,
+        help="Maximum number of responses written to the result store "
+             "per transaction")
+    parser.add_argument(
+        "--trace",
+        help="Record HTTP requests and agent responses to this gzipped "
+             "trace file for replay with tracing.py")
+    profiling.Profiler.add_arguments(parser)
+    transport.TransportProfile.add_arguments(parser)
 
     return parser.parse_args(args)
 
 def main(args=None):
     args = parse_args(args)
     publish_socket, pull_socket = init_zmq(
-        args.publish_url, args.pull_url)
+        args.publish_url, args.pull_url,
+        transport.TransportProfile.from_args(args))
+    flight_recorder = None
+    if args.events_size > 0:
+        flight_recorder = recorder.FlightRecorder(args.events_size)
+        publish_socket = recorder.RecordingSocket(
+            publish_socket, flight_recorder, "publish")
+        pull_socket = recorder.RecordingSocket(
+            pull_socket, flight_recorder, "receive")
+    output_spool = None
+    if args.spool_dir:
+        output_spool = spool.OutputSpool(args.spool_dir,
+                                         args.spool_threshold)
+        pull_socket = spool.SpoolingSocket(pull_socket, output_spool)
+    result_store = None
+    if args.results_db:
+        result_store = results.ResultStore(args.results_db,
+                                           args.results_batch)
+        pull_socket = results.StoringSocket(pull_socket, result_store)
+    tracer = None
+    if args.trace:
+        tracer = tracing.TraceWriter(args.trace)
+        publish_socket = tracing.TracingSocket(publish_socket, tracer)
+        pull_socket = tracing.TracingSocket(pull_socket, tracer)
 
     server = MasterAgentHTTPServer(
         (args.http_host, args.http_port), RequestHandler,
         publish_socket, pull_socket)
+    server.server_vars.recorder = flight_recorder
+    server.server_vars.tracer = tracer
+    server.server_vars.results = result_store
+    server.server_vars.spool = output_spool
+    server.server_vars.profiler = profiling.Profiler.from_args(args)
+    if args.reliable:
+        server.server_vars.replay = ReplayBuffer(
+            publish_socket, server.server_vars.clocks, args.replay_size)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
 
     server.server_close()
+    if tracer is not None:
+        tracer.close()
+    if result_store is not None:
+        result_store.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+import cProfile
+import collections
+import contextlib
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+
+import six
+
+monotonic = getattr(time, "monotonic", time.time)
+
+
+class Counters(object):
+    def __init__(self):
+        # Name to [count, total seconds, maximum seconds].
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = [0, 0.0, 0.0]
+            counter[0] += 1
+            counter[1] += elapsed
+            counter[2] = max(counter[2], elapsed)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return dict((name, {"count": count, "total": total, "max": max_,
+                                "mean": total / count})
+                        for name, (count, total, max_)
+                        in self.counters.items())
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+
+
+counters = Counters()
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with counters.timed(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler(object):
+    MODES = ("cprofile", "sampling")
+    MAX_SECONDS = 600
+    SAMPLE_INTERVAL = 0.005
+    # Functions of a cProfile dump, stacks of a sampling one.
+    TOP = 100
+
+    def __init__(self, mode, sample_interval=None):
+        if mode not in self.MODES:
+            raise ValueError("Unknown profile mode '%s'." % mode)
+        self.mode = mode
+        self.sample_interval = sample_interval or self.SAMPLE_INTERVAL
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.profile = None
+        self.samples = None
+        self.result = None
+
+    @classmethod
+    def add_arguments(cls, parser):
+        parser.add_argument(
+            "--profile", choices=cls.MODES,
+            help="Allow profiling on request: cprofile traces the thread "
+                 "serving requests, sampling takes stacks of all threads")
+
+    @classmethod
+    def from_args(cls, args):
+        if args.profile is None:
+            return None
+        return cls(args.profile)
+
+    def start(self, seconds):
+        seconds = float(seconds)
+        if not 0 < seconds <= self.MAX_SECONDS:
+            raise ValueError("Profile window must be within (0, %d] "
+                             "seconds." % self.MAX_SECONDS)
+
+        with self.lock:
+            if self.deadline is not None:
+                # Already collecting, e.g. for another agent of the group.
+                return
+            self.deadline = monotonic() + seconds
+            self.result = None
+            if self.mode == "cprofile":
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            else:
+                self.samples = collections.Counter()
+                sampler = threading.Thread(target=self._sample)
+                sampler.daemon = True
+                sampler.start()
+
+    def _sample(self):
+        ident = threading.current_thread().ident
+        while monotonic() < self.deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("%s:%s" % (
+                        os.path.basename(frame.f_code.co_filename),
+                        frame.f_code.co_name))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_interval)
+        self._finish()
+
+    def poll(self):
+        # cProfile only stops in the thread it was started in.
+        if self.profile is not None and monotonic() >= self.deadline:
+            self._finish()
+
+    def _finish(self):
+        with self.lock:
+            if self.profile is not None:
+                self.profile.disable()
+                stream = six.StringIO()
+                stats = pstats.Stats(self.profile, stream=stream)
+                stats.sort_stats("cumulative").print_stats(self.TOP)
+                self.result = stream.getvalue()
+                self.profile = None
+            else:
+                # Collapsed stacks, as flame graph tools take them.
+                self.result = "".join(
+                    "%s %d\n" % item
+                    for item in self.samples.most_common(self.TOP))
+                self.samples = None
+            self.deadline = None
+
+    def get_result(self):
+        self.poll()
+        with self.lock:
+            if self.deadline is not None:
+                return {"mode": self.mode,
+                        "left": max(0.0, self.deadline - monotonic())}
+            return {"mode": self.mode, "profile": self.result}
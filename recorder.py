@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+import itertools
+import json
+import time
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+class FlightRecorder(object):
+    DEFAULT_SIZE = 10000
+    # codec_time is the JSON encoding time of sent messages and the
+    # decoding time of received ones, in seconds.
+    FIELDS = ("time", "event", "req", "agent", "size", "codec_time")
+
+    def __init__(self, size=None):
+        self.size = size or self.DEFAULT_SIZE
+        self.events = [None] * self.size
+        # next() of a count is atomic, concurrent senders need no lock.
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def record(self, event, req, agent, size, codec_time):
+        index = next(self.counter)
+        self.events[index % self.size] = (
+            time.time(), event, req, agent, size, codec_time)
+        # May lag behind a concurrent record() by one, dump() then just
+        # misses the newest event.
+        self.recorded = index + 1
+
+    def dump(self, event=None, req=None, agent=None, since=None,
+             limit=None):
+        recorded = self.recorded
+        first = max(0, recorded - self.size)
+        events = [self.events[index % self.size]
+                  for index in range(first, recorded)]
+
+        if since is not None:
+            since = float(since)
+        if limit is not None:
+            limit = int(limit)
+            if limit < 0:
+                raise ValueError("Limit must not be negative.")
+        matched = [dict(zip(self.FIELDS, values)) for values in events
+                   if values is not None and
+                   (event is None or values[1] == event) and
+                   (req is None or values[2] == req) and
+                   (agent is None or values[3] == agent) and
+                   (since is None or values[0] >= since)]
+        if limit is not None:
+            matched = matched[-limit:] if limit else []
+        return {"recorded": recorded, "dropped": first, "events": matched}
+
+
+class RecordingSocket(object):
+    def __init__(self, socket, recorder, event):
+        self.socket = socket
+        self.recorder = recorder
+        self.event = event
+
+    def send_json(self, obj, flags=0):
+        tstart = timer()
+        data = json.dumps(obj).encode("utf-8")
+        codec_time = timer() - tstart
+
+        self.socket.send(data, flags)
+        self.recorder.record(self.event, obj.get("req"), obj.get("agent"),
+                             len(data), codec_time)
+
+    def recv_json(self, flags=0):
+        data = self.socket.recv(flags)
+
+        tstart = timer()
+        obj = json.loads(data.decode("utf-8"))
+        codec_time = timer() - tstart
+
+        self.recorder.record(self.event, obj.get("req"), obj.get("agent"),
+                             len(data), codec_time)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+import json
+import sqlite3
+import threading
+import time
+
+from six.moves import queue
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS responses ("
+    "id INTEGER PRIMARY KEY, req TEXT, agent TEXT, time REAL, "
+    "outbox_seq INTEGER, response TEXT)",
+    # Outbox resends of a stored response are left out, responses without
+    # an outbox_seq never collide.
+    "CREATE UNIQUE INDEX IF NOT EXISTS responses_outbox "
+    "ON responses (req, agent, outbox_seq)",
+    "CREATE INDEX IF NOT EXISTS responses_req ON responses (req)",
+    "CREATE INDEX IF NOT EXISTS responses_agent ON responses (agent)",
+    "CREATE INDEX IF NOT EXISTS responses_time ON responses (time)",
+)
+
+
+class ResultStore(object):
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+    MAX_PENDING = 100000
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def __init__(self, path, batch_size=None, flush_interval=None):
+        self.path = path
+        self.batch_size = batch_size or self.BATCH_SIZE
+        self.flush_interval = flush_interval or self.FLUSH_INTERVAL
+        self.pending = queue.Queue(self.MAX_PENDING)
+        self.dropped = 0
+        self.written = 0
+
+        conn = self.connect()
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.close()
+
+        self.reader = None
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        # Readers do not block the writer and the other way around.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def add(self, resp):
+        try:
+            self.pending.put_nowait((resp.get("req"), resp.get("agent"),
+                                     time.time(), resp.get("outbox_seq"),
+                                     resp))
+        except queue.Full:
+            # The request path never waits for the disk.
+            self.dropped += 1
+
+    def _write(self):
+        conn = self.connect()
+        stop = False
+        while not stop:
+            try:
+                batch = [self.pending.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stop = True
+                batch.pop()
+
+            with conn:
+                cursor = conn.executemany(
+                    "INSERT OR IGNORE INTO responses "
+                    "(req, agent, time, outbox_seq, response) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(req, agent, recv_time, seq, json.dumps(resp))
+                     for req, agent, recv_time, seq, resp in batch])
+            self.written += cursor.rowcount
+        conn.close()
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+
+    def query(self, req=None, agent=None, since=None, until=None,
+              cursor=None, limit=None):
+        limit = int(limit or self.DEFAULT_LIMIT)
+        if not 0 < limit <= self.MAX_LIMIT:
+            raise ValueError("Limit must be within (0, %d]." %
+                             self.MAX_LIMIT)
+
+        clauses, params = [], []
+        for clause, value, convert in (
+                ("req = ?", req, str), ("agent = ?", agent, str),
+                ("time >= ?", since, float), ("time < ?", until, float),
+                ("id > ?", cursor, int)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(convert(value))
+
+        sql = "SELECT id, req, agent, time, response FROM responses"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id LIMIT ?"
+
+        # Only the thread serving HTTP reads.
+        if self.reader is None:
+            self.reader = self.connect()
+        rows = self.reader.execute(sql, params + [limit + 1]).fetchall()
+
+        results = [{"id": row[0], "req": row[1], "agent": row[2],
+                    "time": row[3], "response": json.loads(row[4])}
+                   for row in rows[:limit]]
+        return {
+            "results": results,
+            # Pass as cursor for the next page.
+            "next": results[-1]["id"] if len(rows) > limit else None,
+            "pending": self.pending.qsize(),
+            "dropped": self.dropped,
+        }
+
+
+class StoringSocket(object):
+    def __init__(self, socket, store):
+        self.socket = socket
+        self.store = store
+
+    def recv_json(self, *args, **kwargs):
+        obj = self.socket.recv_json(*args, **kwargs)
+        # Acks and in progress markers carry no result.
+        if "req" in obj and "agent" in obj and not obj.get("in_progress"):
+            self.store.add(obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
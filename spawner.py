@@ -0,0 +1,386 @@
+#!/usr/bin/python
+
+import argparse
+import array
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+MAX_MESSAGE_SIZE = 1024 * 1024
+MAX_FDS = 3
+RUSAGE_FIELDS = ("ru_utime", "ru_stime", "ru_maxrss", "ru_minflt",
+                 "ru_majflt", "ru_nvcsw", "ru_nivcsw", "ru_inblock",
+                 "ru_oublock")
+
+
+def read_proc_io(pid):
+    try:
+        with open("/proc/%d/io" % pid) as io_fh:
+            lines = io_fh.readlines()
+    except (IOError, OSError):
+        return {}
+
+    counters = {}
+    for line in lines:
+        key, _, value = line.partition(":")
+        if key in ("rchar", "wchar", "syscr", "syscw",
+                   "read_bytes", "write_bytes"):
+            counters[key] = int(value)
+    return counters
+
+
+def get_returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def send_message(sock, message, fds=()):
+    data = json.dumps(message).encode("utf-8")
+    ancdata = []
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                    array.array("i", fds))]
+    sock.sendmsg([data], ancdata)
+
+
+def recv_message(sock):
+    fds = array.array("i")
+    data, ancdata, _, _ = sock.recvmsg(
+        MAX_MESSAGE_SIZE, socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    for level, type_, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                    len(cmsg_data) % fds.itemsize])
+    if not data:
+        return None, []
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+class ResourceUsage(object):
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class SpawnServer(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.children = {}
+
+    def spawn(self, req, fds):
+        # Indices into the passed descriptors, None leaves the stream
+        # inherited from the spawn server.
+        stdio = [fds[index] if index is not None else None
+                 for index in req["stdio"]]
+
+        env = req.get("env")
+        if env is None:
+            env = os.environ
+        argv = req["path"]
+
+        try:
+            if hasattr(os, "posix_spawnp"):
+                file_actions = [(os.POSIX_SPAWN_DUP2, fd, target)
+                                for target, fd in enumerate(stdio)
+                                if fd is not None]
+                return os.posix_spawnp(
+                    argv[0], argv, env, file_actions=file_actions,
+                    setsid=bool(req.get("new_session")))
+
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for target, fd in enumerate(stdio):
+                        if fd is not None:
+                            os.dup2(fd, target)
+                    if req.get("new_session"):
+                        os.setsid()
+                    os.execvpe(argv[0], argv, env)
+                finally:
+                    os._exit(127)
+            return pid
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def reap(self):
+        while True:
+            io_counters = {}
+            if hasattr(os, "waitid"):
+                try:
+                    result = os.waitid(
+                        os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+                except ChildProcessError:
+                    return
+                if result is None:
+                    return
+                pid = result.si_pid
+                io_counters = read_proc_io(pid)
+                _, status, rusage = os.wait4(pid, 0)
+            else:
+                try:
+                    pid, status, rusage = os.wait4(-1, os.WNOHANG)
+                except OSError:
+                    return
+                if not pid:
+                    return
+
+            spawn_id = self.children.pop(pid, None)
+            if spawn_id is None:
+                continue
+            send_message(self.sock, {
+                "id": spawn_id,
+                "returncode": get_returncode(status),
+                "rusage": dict((field, getattr(rusage, field))
+                               for field in RUSAGE_FIELDS),
+                "io": io_counters,
+            })
+
+    def serve(self):
+        wakeup_r, wakeup_w = os.pipe()
+        for fd in (wakeup_r, wakeup_w):
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        while True:
+            readable, _, _ = select.select([self.sock, wakeup_r], [], [])
+            if wakeup_r in readable:
+                try:
+                    os.read(wakeup_r, 4096)
+                except OSError:
+                    pass
+            if self.sock in readable:
+                req, fds = recv_message(self.sock)
+                if req is None:
+                    return
+                for fd in fds:
+                    os.set_inheritable(fd, False)
+                try:
+                    pid = self.spawn(req, fds)
+                except Exception as e:
+                    send_message(self.sock, {"id": req["id"],
+                                             "error": str(e)})
+                else:
+                    self.children[pid] = req["id"]
+                    send_message(self.sock, {"id": req["id"], "pid": pid})
+            self.reap()
+
+
+class SpawnedProcess(object):
+    def __init__(self, spawn_id):
+        self.spawn_id = spawn_id
+        self.pid = None
+        self.error = None
+        self.returncode = None
+        self.rusage = None
+        self.io_counters = None
+        self.stdout = self.stderr = None
+        self.started = threading.Event()
+        self.exited = threading.Event()
+
+    def _started(self, message):
+        self.pid = message.get("pid")
+        self.error = message.get("error")
+        self.started.set()
+
+    def _exited(self, message):
+        self.returncode = message["returncode"]
+        self.rusage = ResourceUsage(**message["rusage"])
+        self.io_counters = message["io"]
+        self.exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def _failed(self, error):
+        self.error = error
+        self.started.set()
+        self.exited.set()
+
+    def wait_usage(self):
+        self.exited.wait()
+        if self.returncode is None:
+            raise OSError(self.error)
+        return self.returncode, self.rusage, self.io_counters
+
+    def wait(self):
+        return self.wait_usage()[0]
+
+
+class SpawnClient(object):
+    def __init__(self):
+        sock_type = getattr(socket, "SOCK_SEQPACKET", socket.SOCK_DGRAM)
+        self.sock, server_sock = socket.socketpair(socket.AF_UNIX,
+                                                   sock_type)
+
+        self.server_pid = os.fork()
+        if self.server_pid == 0:
+            status = 0
+            try:
+                self.sock.close()
+                SpawnServer(server_sock).serve()
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        server_sock.close()
+
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.processes = {}
+        self.closed = False
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        while True:
+            message, _ = recv_message(self.sock)
+            if message is None:
+                with self.lock:
+                    self.closed = True
+                    processes, self.processes = self.processes, {}
+                for process in processes.values():
+                    process._failed("Spawn server has exited.")
+                return
+            with self.lock:
+                process = self.processes.get(message["id"])
+                if "returncode" in message:
+                    self.processes.pop(message["id"], None)
+            if process is None:
+                continue
+            if "returncode" in message:
+                process._exited(message)
+            else:
+                process._started(message)
+
+    def spawn(self, path, stdout=None, stderr=None, env=None,
+              new_session=False):
+        data = json.dumps({"path": list(path), "env": env})
+        if len(data) > MAX_MESSAGE_SIZE - 1024:
+            raise ValueError("Spawn request is too large.")
+
+        fds = []
+        write_fds = []
+        read_fds = [None, None, None]
+        stdio = [None, None, None]
+        for target, redirection in ((1, stdout), (2, stderr)):
+            if redirection is None:
+                continue
+            elif redirection == subprocess.STDOUT:
+                stdio[target] = stdio[1]
+                continue
+            elif redirection == subprocess.PIPE:
+                read_fds[target], fd = os.pipe()
+                write_fds.append(fd)
+            else:
+                fd = redirection.fileno()
+            stdio[target] = len(fds)
+            fds.append(fd)
+
+        try:
+            with self.lock:
+                if self.closed:
+                    raise OSError("Spawn server has exited.")
+                spawn_id = self.next_id
+                self.next_id += 1
+                send_message(self.sock, {
+                    "id": spawn_id, "path": list(path), "env": env,
+                    "stdio": stdio, "new_session": new_session,
+                }, fds)
+                process = self.processes[spawn_id] = SpawnedProcess(spawn_id)
+        except Exception:
+            for fd in read_fds:
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            for fd in write_fds:
+                os.close(fd)
+
+        process.started.wait()
+        if process.error is not None:
+            with self.lock:
+                self.processes.pop(spawn_id, None)
+            for fd in read_fds:
+                if fd is not None:
+                    os.close(fd)
+            raise OSError(process.error)
+
+        if read_fds[1] is not None:
+            process.stdout = os.fdopen(read_fds[1], "rb")
+        if read_fds[2] is not None:
+            process.stderr = os.fdopen(read_fds[2], "rb")
+        return process
+
+    def close(self):
+        # shutdown() wakes up the reader thread and lets the spawn server
+        # see the end of the stream.
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.reader.join()
+        self.sock.close()
+        os.waitpid(self.server_pid, 0)
+
+
+def benchmark(count, path):
+    def run_popen():
+        subprocess.Popen(path).wait()
+
+    def run_posix_spawn():
+        pid = os.posix_spawnp(path[0], path, os.environ)
+        os.waitpid(pid, 0)
+
+    client = SpawnClient()
+
+    def run_spawn_server():
+        client.spawn(path).wait()
+
+    methods = [("popen", run_popen), ("spawn_server", run_spawn_server)]
+    if hasattr(os, "posix_spawnp"):
+        methods.insert(1, ("posix_spawn", run_posix_spawn))
+
+    results = {}
+    for name, method in methods:
+        tstart = time.time()
+        for i in range(count):
+            method()
+        results[name] = (time.time() - tstart) / count * 1e6
+
+    client.close()
+    return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Compare command spawn latency of Popen, posix_spawn "
+                    "and the spawn server")
+    parser.add_argument(
+        "--count", type=int, default=1000,
+        help="Number of commands to run with each method")
+    parser.add_argument(
+        "--ballast", type=int, default=0,
+        help="Megabytes of memory to allocate first, to emulate a big "
+             "agent process")
+    parser.add_argument(
+        "path", nargs="*", default=["true"],
+        help="Command to run")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    ballast = bytearray(args.ballast * 1024 * 1024)
+    for name, usec in sorted(benchmark(args.count, args.path).items()):
+        sys.stdout.write("%-12s %10.1f us/spawn\n" % (name, usec))
+    del ballast
+
+if __name__ == "__main__":
+    main()
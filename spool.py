@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import os
+import re
+import tempfile
+
+import six
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    # Returns the inclusive (first, last) byte positions, None to send the
+    # whole file.
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        # Multiple ranges are not supported, the full body is a valid
+        # answer to them.
+        return None
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range, the last N bytes.
+        first, last = max(0, size - int(last)), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError("Range not satisfiable.")
+    return first, last
+
+
+class OutputSpool(object):
+    DEFAULT_THRESHOLD = 64 * 1024
+    STREAMS = ("stdout", "stderr", "stdout_tail", "stderr_tail")
+
+    def __init__(self, path, threshold=None):
+        self.path = path
+        self.threshold = threshold or self.DEFAULT_THRESHOLD
+
+    def _get_path(self, req, agent, stream):
+        names = (req, agent)
+        if stream not in self.STREAMS or not all(
+                isinstance(name, six.string_types) and name and
+                name not in (".", "..") for name in names):
+            raise ValueError("Invalid output reference.")
+        return os.path.join(self.path, *[
+            six.moves.urllib.parse.quote(name, safe="") for name in names +
+            (stream,)])
+
+    def get_ref(self, req, agent, stream):
+        return "/output/%s" % "/".join(
+            six.moves.urllib.parse.quote(name, safe="")
+            for name in (req, agent, stream))
+
+    def spill(self, resp):
+        for stream in self.STREAMS:
+            text = resp.get(stream)
+            if (not isinstance(text, six.string_types) or
+                    len(text) <= self.threshold):
+                continue
+            try:
+                path = self._get_path(resp.get("req"), resp.get("agent"),
+                                      stream)
+            except ValueError:
+                return
+
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            data = text.encode("utf-8")
+            # Readers never see a partially written output.
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.rename(tmp_path, path)
+
+            del resp[stream]
+            resp["%s_ref" % stream] = self.get_ref(
+                resp["req"], resp["agent"], stream)
+            resp["%s_bytes" % stream] = len(data)
+
+    def open(self, req, agent, stream):
+        # IOError when there is no such output.
+        return open(self._get_path(req, agent, stream), "rb")
+
+
+class SpoolingSocket(object):
+    def __init__(self, socket, spool):
+        self.socket = socket
+        self.spool = spool
+
+    def recv_json(self, *args, **kwargs):
+        obj = self.socket.recv_json(*args, **kwargs)
+        self.spool.spill(obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
@@ -1,23 +1,218 @@
 #!/usr/bin/python
 
+import base64
 import ddt
+import hashlib
+import json
 import mock
+import os
+import shutil
+import signal
 import subprocess
+import tempfile
 import unittest
 import zmq
 
 import agent
+import spawner
+
+
+@ddt.ddt
+class OutputFilterTestCase(unittest.TestCase):
+    TEXT = "a 1\nb 2\nerror: 3\nc 4\nerror: 5\n"
+
+    @ddt.unpack
+    @ddt.data(
+        {"options": {"include": "error"}, "text": "error: 3\nerror: 5\n"},
+        {"options": {"exclude": "error"}, "text": "a 1\nb 2\nc 4\n"},
+        {"options": {"include": "^[a-z] ", "exclude": "^b"},
+         "text": "a 1\nc 4\n"},
+        {"options": {"head_lines": "2"}, "text": "a 1\nb 2\n"},
+        {"options": {"tail_lines": 1}, "text": "error: 5\n"},
+        {"options": {"head_lines": 1, "tail_lines": 1},
+         "text": "a 1\nerror: 5\n"},
+        {"options": {"head_lines": 3, "tail_lines": 3}, "text": TEXT},
+        {"options": {"head_lines": 0}, "text": ""},
+        {"options": {"include": "error", "tail_lines": 1},
+         "text": "error: 5\n"},
+    )
+    def test_apply(self, options, text):
+        self.assertEqual((text, None),
+                         agent.OutputFilter(**options).apply(self.TEXT))
+
+    def test_apply_extract(self):
+        output_filter = agent.OutputFilter(
+            extract=r"^(?P<name>\w+):? (?P<value>[\d.]+)(?P<unit> ms)?",
+            head_lines=0)
+
+        self.assertEqual(
+            ("", {"name": "error", "value": 5, "unit": None}),
+            output_filter.apply(self.TEXT))
+        self.assertEqual(
+            ("", {"name": "rate", "value": 1.5, "unit": " ms"}),
+            output_filter.apply("rate 1.5 ms\n"))
+
+    def test_from_request(self):
+        self.assertIsNone(agent.OutputFilter.from_request({"foo": "bar"}))
+
+        output_filter = agent.OutputFilter.from_request(
+            {"include": "a", "tail_lines": "3", "foo": "bar"})
+
+        self.assertEqual("a", output_filter.include.pattern)
+        self.assertEqual(3, output_filter.tail_lines)
+        self.assertIsNone(output_filter.exclude)
+
+
+@ddt.ddt
+class OutputCaptureTestCase(unittest.TestCase):
+    @ddt.unpack
+    @ddt.data(
+        {"limit": None, "writes": [b"abc", b"def"],
+         "head": b"abcdef", "tail": b"", "truncated": False},
+        {"limit": 8, "writes": [b"abc", b"def"],
+         "head": b"abcd", "tail": b"ef", "truncated": False},
+        {"limit": 4, "writes": [b"abc", b"def", b"ghi"],
+         "head": b"ab", "tail": b"hi", "truncated": True},
+        {"limit": 5, "writes": [b"abcdefghij"],
+         "head": b"abc", "tail": b"ij", "truncated": True},
+        {"limit": 1, "writes": [b"abc"],
+         "head": b"a", "tail": b"", "truncated": True},
+    )
+    def test_write(self, limit, writes, head, tail, truncated):
+        capture = agent.OutputCapture(limit)
+
+        for data in writes:
+            capture.write(data)
+
+        self.assertEqual(head, bytes(capture.head))
+        self.assertEqual(tail, bytes(capture.tail))
+        self.assertEqual(sum(map(len, writes)), capture.size)
+        self.assertEqual(truncated, capture.truncated)
+
+    @mock.patch("os.read", side_effect=[b"abc", b"def", b""])
+    def test_consume(self, mock_os_read):
+        capture = agent.OutputCapture()
+        pipe = mock.Mock(**{"fileno.return_value": 42})
+
+        capture.consume(pipe)
+
+        self.assertEqual(b"abcdef", bytes(capture.head))
+        self.assertEqual(
+            [mock.call(42, capture.CHUNK_SIZE)] * 3, mock_os_read.mock_calls)
+        pipe.close.assert_called_once_with()
+
+    def test_fill_response(self):
+        capture = agent.OutputCapture(4)
+        capture.write(b"abc")
+
+        resp = {}
+        capture.fill_response(resp, "stdout")
+
+        self.assertEqual(
+            {"stdout": "abc", "stdout_size": 3, "stdout_truncated": False},
+            resp)
+
+    def test_fill_response_truncated(self):
+        capture = agent.OutputCapture(4)
+        capture.write(b"abcdefg")
+
+        resp = {}
+        capture.fill_response(resp, "stdout")
+
+        self.assertEqual(
+            {"stdout": "ab", "stdout_tail": "fg", "stdout_size": 7,
+             "stdout_truncated": True},
+            resp)
+
+    def test_fill_response_filter(self):
+        capture = agent.OutputCapture(12)
+        capture.write(b"x 1\ny 2\nz 3\nx 4\n")
+        output_filter = agent.OutputFilter(
+            include="x", extract=r"x (?P<x>\d+)")
+
+        resp = {}
+        capture.fill_response(resp, "stdout", output_filter)
+
+        self.assertEqual(
+            {"stdout": "x 1\n", "stdout_tail": "x 4\n",
+             "stdout_fields": {"x": 4}, "stdout_size": 16,
+             "stdout_truncated": True},
+            resp)
+
 
 @ddt.ddt
 class CommandExecutorTestCase(unittest.TestCase):
     def test__thread_target(self):
-        mock_process = mock.Mock(**{"wait.return_value": "foobar"})
+        mock_process = mock.Mock()
         executor = agent.CommandExecutor({}, {})
+        executor._wait = mock.Mock(return_value="foobar")
 
         executor._thread_target(mock_process)
 
         self.assertEqual("foobar", executor.exit_code)
-        mock_process.wait.assert_called_once_with()
+        executor._wait.assert_called_once_with(mock_process)
+
+    @ddt.unpack
+    @ddt.data(
+        {"status": 3 << 8, "expected": 3},
+        {"status": 9, "expected": -9},
+    )
+    @mock.patch("spawner.read_proc_io", return_value={"rchar": 100})
+    @mock.patch("os.wait4")
+    @mock.patch("os.waitid", create=True)
+    def test__wait4(self, mock_os_waitid, mock_os_wait4,
+                    mock_spawner_read_proc_io, status, expected):
+        mock_os_wait4.return_value = (42, status, "rusage")
+        process = mock.Mock(pid=42)
+
+        self.assertEqual(
+            (expected, "rusage", {"rchar": 100}),
+            agent.CommandExecutor._wait4(process))
+
+        self.assertEqual(expected, process.returncode)
+        mock_os_waitid.assert_called_once_with(
+            os.P_PID, 42, os.WEXITED | os.WNOWAIT)
+        mock_os_wait4.assert_called_once_with(42, 0)
+        mock_spawner_read_proc_io.assert_called_once_with(42)
+
+    @ddt.data(True, False)
+    @mock.patch("agent.monotonic", return_value=15.5)
+    def test__wait(self, spawned, mock_monotonic):
+        rusage = mock.Mock(
+            ru_utime=1.5, ru_stime=0.5, ru_maxrss=2048, ru_minflt=10,
+            ru_majflt=1, ru_nvcsw=5, ru_nivcsw=6, ru_inblock=7, ru_oublock=8)
+        retval = (3, rusage, {"rchar": 100})
+        executor = agent.CommandExecutor({}, {})
+        executor.start_time = 10
+        executor._wait4 = mock.Mock(return_value=retval)
+        if spawned:
+            process = spawner.SpawnedProcess(0)
+            process.wait_usage = mock.Mock(return_value=retval)
+        else:
+            process = mock.Mock()
+
+        self.assertEqual(3, executor._wait(process))
+
+        if spawned:
+            process.wait_usage.assert_called_once_with()
+            self.assertFalse(executor._wait4.called)
+        else:
+            executor._wait4.assert_called_once_with(process)
+        self.assertEqual(
+            {
+                "wall_time": 5.5,
+                "user_time": 1.5,
+                "system_time": 0.5,
+                "max_rss_kb": 2048,
+                "minor_faults": 10,
+                "major_faults": 1,
+                "voluntary_switches": 5,
+                "involuntary_switches": 6,
+                "block_input": 7,
+                "block_output": 8,
+                "rchar": 100,
+            },
+            executor.usage)
 
     @ddt.data({"config": "null",
                "expected": "null"},
@@ -78,16 +273,26 @@ class CommandExecutorTestCase(unittest.TestCase):
 
         return executor, req, resp
 
+    def _get_captures(self, *outputs, **kwargs):
+        captures = []
+        for output in outputs:
+            capture = agent.OutputCapture(kwargs.get("limit"))
+            capture.write(output)
+            captures.append(capture)
+        return captures
+
     @mock.patch("subprocess.Popen")
     def test_run(self, mock_subprocess_popen):
         executor, req, resp = self._get_executor_for_run()
         executor._get_stdout_stderr = mock.Mock(
             return_value=("stdout_fh", "stderr_fh"))
+        executor._communicate = mock.Mock(
+            return_value=self._get_captures(b"stdout_out", b"stderr_out"))
 
-        mock_subprocess_popen.return_value.communicate.return_value = (
-            "stdout_out", "stderr_out")
-        mock_subprocess_popen.return_value.wait.return_value = "barfoo"
-
+        def mock_wait(process):
+            executor.usage = "usage"
+            return "barfoo"
+        executor._wait = mock.Mock(side_effect=mock_wait)
 
         new_resp = executor.run()
 
@@ -97,19 +302,189 @@ class CommandExecutorTestCase(unittest.TestCase):
                 "exit_code": "barfoo",
                 "resp": "foobar",
                 "stdout": "stdout_out",
-                "stderr": "stderr_out"
+                "stderr": "stderr_out",
+                "usage": "usage"
             },
             resp)
 
         mock_subprocess_popen.assert_called_once_with(
             req["path"], stdout="stdout_fh", stderr="stderr_fh",
-            env=None)
+            env=None, start_new_session=False)
+        executor._communicate.assert_called_once_with(
+            mock_subprocess_popen.return_value)
+        executor._wait.assert_called_once_with(
+            mock_subprocess_popen.return_value)
+
+    def test_run_spawn_client(self):
+        executor, req, resp = self._get_executor_for_run()
+        executor.spawn_client = mock.Mock()
+        executor._get_stdout_stderr = mock.Mock(
+            return_value=("stdout_fh", "stderr_fh"))
+        executor._communicate = mock.Mock(return_value=[None, None])
+        executor._wait = mock.Mock(return_value=0)
+
+        executor.run()
+
+        executor.spawn_client.spawn.assert_called_once_with(
+            req["path"], stdout="stdout_fh", stderr="stderr_fh", env=None,
+            new_session=False)
+        executor._communicate.assert_called_once_with(
+            executor.spawn_client.spawn.return_value)
+        executor._wait.assert_called_once_with(
+            executor.spawn_client.spawn.return_value)
+
+    @mock.patch("subprocess.Popen")
+    def test_run_capture_limit(self, mock_subprocess_popen):
+        executor, req, resp = self._get_executor_for_run()
+        executor.capture_limit = 4
+        executor._get_stdout_stderr = mock.Mock(
+            return_value=(subprocess.PIPE, subprocess.PIPE))
+        stdout, = self._get_captures(b"abcdefg", limit=4)
+        executor._communicate = mock.Mock(return_value=[stdout, None])
+        executor._wait = mock.Mock(return_value=0)
+
+        executor.run()
+
+        executor._communicate.assert_called_once_with(
+            mock_subprocess_popen.return_value)
         self.assertEqual(
-            [
-                mock.call.communicate(),
-                mock.call.wait()
-            ],
-            mock_subprocess_popen.return_value.mock_calls)
+            {
+                "exit_code": 0,
+                "usage": None,
+                "resp": "foobar",
+                "stdout": "ab",
+                "stdout_tail": "fg",
+                "stdout_size": 7,
+                "stdout_truncated": True,
+            },
+            resp)
+
+    @ddt.data(False, True)
+    def test_run_timeout(self, spawned):
+        req = {"path": ["sh", "-c", "echo start; sleep 10 & wait"],
+               "time_limit": "0.2", "kill_after": "1"}
+        resp = {}
+        spawn_client = spawner.SpawnClient() if spawned else None
+        self.addCleanup(lambda: spawn_client and spawn_client.close())
+        executor = agent.CommandExecutor(req, resp,
+                                         spawn_client=spawn_client)
+
+        executor.run()
+
+        self.assertTrue(resp["timed_out"])
+        self.assertEqual("start\n", resp["stdout"])
+        self.assertEqual(-signal.SIGTERM, resp["exit_code"])
+        # The backgrounded sleep is killed along with the shell, otherwise
+        # it would keep the pipe open for 10 seconds.
+        self.assertLess(resp["usage"]["wall_time"], 5)
+
+    def test_run_timeout_kill(self):
+        req = {"path": ["sh", "-c", "trap '' TERM; echo start; sleep 10"],
+               "time_limit": 0.2, "kill_after": 0.2}
+        resp = {}
+        executor = agent.CommandExecutor(req, resp)
+
+        executor.run()
+
+        self.assertTrue(resp["timed_out"])
+        self.assertEqual("start\n", resp["stdout"])
+        self.assertEqual(-signal.SIGKILL, resp["exit_code"])
+
+    def test_run_timeout_not_reached(self):
+        req = {"path": ["true"], "time_limit": 10}
+        resp = {}
+        executor = agent.CommandExecutor(req, resp)
+
+        executor.run()
+
+        self.assertEqual(0, resp["exit_code"])
+        self.assertFalse(resp["timed_out"])
+
+    def test_timeout_is_master_wait(self):
+        # The master passes its own URL timeout (ms) on to the agents.
+        executor = agent.CommandExecutor({"timeout": "1000"}, {})
+
+        self.assertIsNone(executor.timeout)
+
+    @mock.patch("os.killpg")
+    def test__watch(self, mock_os_killpg):
+        executor = agent.CommandExecutor(
+            {"time_limit": 0, "kill_after": 0}, {})
+        process = mock.Mock(pid=42)
+
+        executor._watch(process)
+
+        self.assertTrue(executor.timed_out)
+        self.assertEqual(
+            [mock.call(42, signal.SIGTERM), mock.call(42, signal.SIGKILL)],
+            mock_os_killpg.call_args_list)
+
+    @mock.patch("os.killpg", side_effect=OSError)
+    def test__watch_exited(self, mock_os_killpg):
+        executor = agent.CommandExecutor(
+            {"time_limit": 0, "kill_after": 0}, {})
+        executor._watch(mock.Mock(pid=42))
+        self.assertTrue(executor.timed_out)
+
+        executor = agent.CommandExecutor({"time_limit": 0}, {})
+        executor.exited.set()
+        executor._watch(mock.Mock(pid=42))
+        self.assertFalse(executor.timed_out)
+
+    def test_run_output_filter(self):
+        req = {"path": ["sh", "-c", "echo a; echo rate=42; echo b >&2"],
+               "include": "rate", "extract": "rate=(?P<rate>\\d+)"}
+        resp = {}
+        executor = agent.CommandExecutor(req, resp)
+
+        executor.run()
+
+        self.assertEqual("rate=42\n", resp["stdout"])
+        self.assertEqual({"rate": 42}, resp["stdout_fields"])
+        self.assertEqual("", resp["stderr"])
+        self.assertEqual({}, resp["stderr_fields"])
+
+    @mock.patch("time.sleep")
+    @mock.patch("time.time")
+    def test__sleep_until(self, mock_time_time, mock_time_sleep):
+        mock_time_time.side_effect = [10.0, 10.999, 11.0005]
+
+        agent.CommandExecutor._sleep_until(11.0)
+
+        mock_time_sleep.assert_called_once_with(
+            1.0 - agent.CommandExecutor.SPIN_TIME)
+
+    @mock.patch("time.time", return_value=100.001)
+    @mock.patch("subprocess.Popen")
+    def test_run_start_at(self, mock_subprocess_popen, mock_time_time):
+        executor, req, resp = self._get_executor_for_run()
+        req["start_at"] = "99.5"
+        executor.clock_offset = 0.5
+        executor._sleep_until = mock.Mock()
+        executor._get_stdout_stderr = mock.Mock(
+            return_value=("stdout_fh", "stderr_fh"))
+        executor._communicate = mock.Mock(return_value=[None, None])
+        executor._wait = mock.Mock(return_value=0)
+
+        executor.run()
+
+        executor._sleep_until.assert_called_once_with(100.0)
+        self.assertAlmostEqual(0.001, resp["start_skew"])
+
+    def test__communicate(self):
+        executor = agent.CommandExecutor({"capture_limit": "6"}, {})
+        stdout_r, stdout_w = os.pipe()
+        os.write(stdout_w, b"0123456789")
+        os.close(stdout_w)
+        process = mock.Mock(stdout=os.fdopen(stdout_r, "rb"), stderr=None)
+
+        stdout, stderr = executor._communicate(process)
+
+        self.assertIsNone(stderr)
+        self.assertEqual(b"012", bytes(stdout.head))
+        self.assertEqual(b"789", bytes(stdout.tail))
+        self.assertEqual(10, stdout.size)
+        self.assertTrue(process.stdout.closed)
 
     @mock.patch("subprocess.Popen")
     @mock.patch("threading.Thread")
@@ -137,7 +512,8 @@ class CommandExecutorTestCase(unittest.TestCase):
             resp)
 
         mock_subprocess_popen.assert_called_once_with(
-            req["path"], stdout=mock_stdout, stderr=mock_stderr, env=None)
+            req["path"], stdout=mock_stdout, stderr=mock_stderr, env=None,
+            start_new_session=False)
 
         mock_threading_thread.assert_called_once_with(
             target=executor._thread_target,
@@ -177,6 +553,286 @@ class CommandExecutorTestCase(unittest.TestCase):
             getattr(executor, name).close.assert_called_once_with()
 
 
+class ScriptCacheTestCase(unittest.TestCase):
+    SCRIPT = u"#!/bin/sh\necho hello\n"
+
+    def setUp(self):
+        super(ScriptCacheTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.cache = agent.ScriptCache(os.path.join(self.path, "cache"))
+
+    def tearDown(self):
+        super(ScriptCacheTestCase, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        digest = self.cache.put(self.SCRIPT)
+
+        self.assertEqual(agent.script_hash(self.SCRIPT), digest)
+        path = self.cache.get(digest)
+        self.assertEqual(os.path.join(self.cache.path, digest), path)
+        with open(path) as fh:
+            self.assertEqual(self.SCRIPT, fh.read())
+        self.assertTrue(os.access(path, os.X_OK))
+
+    def test_put_hash_mismatch(self):
+        self.assertRaises(ValueError, self.cache.put, self.SCRIPT, "0" * 64)
+
+    def test_put_creates_private_dir(self):
+        self.cache.put(self.SCRIPT)
+
+        self.assertEqual(0o700, os.stat(self.cache.path).st_mode & 0o777)
+
+    def test_get_miss(self):
+        self.assertIsNone(self.cache.get("0" * 64))
+
+    def test_get_tampered(self):
+        digest = self.cache.put(self.SCRIPT)
+        with open(os.path.join(self.cache.path, digest), "w") as fh:
+            fh.write("#!/bin/sh\nrm -rf ~\n")
+
+        self.assertIsNone(self.cache.get(digest))
+        self.assertFalse(os.path.exists(os.path.join(self.cache.path,
+                                                     digest)))
+
+    def test_unsafe_dir(self):
+        os.mkdir(self.cache.path)
+        os.chmod(self.cache.path, 0o777)
+
+        self.assertRaises(ValueError, self.cache.put, self.SCRIPT)
+        self.assertRaises(ValueError, self.cache.get, "0" * 64)
+
+    @mock.patch("os.getuid", return_value=12345)
+    def test_dir_owned_by_other(self, mock_os_getuid):
+        os.mkdir(self.cache.path, 0o700)
+
+        self.assertRaises(ValueError, self.cache.get, "0" * 64)
+
+    def test_dir_symlink(self):
+        os.mkdir(os.path.join(self.path, "other"), 0o700)
+        os.symlink(os.path.join(self.path, "other"), self.cache.path)
+
+        self.assertRaises(ValueError, self.cache.put, self.SCRIPT)
+
+    def test_get_invalid_hash(self):
+        self.assertRaises(ValueError, self.cache.get, "../../etc/passwd")
+
+    def test_evict(self):
+        digests = []
+        for i in range(3):
+            digests.append(self.cache.put(self.SCRIPT + u"#%d\n" % i))
+            os.utime(self.cache.get(digests[-1]), (i, i))
+        # Touch the oldest one, so the others get evicted instead.
+        os.utime(self.cache.get(digests[0]), (10, 10))
+        self.cache.max_size = 2 * len(self.SCRIPT) + 4
+
+        self.cache.put(self.SCRIPT)
+
+        self.assertIsNotNone(self.cache.get(digests[0]))
+        self.assertIsNone(self.cache.get(digests[1]))
+        self.assertIsNone(self.cache.get(digests[2]))
+        self.assertIsNotNone(self.cache.get(agent.script_hash(self.SCRIPT)))
+
+
+class FileTransferTestCase(unittest.TestCase):
+    DATA = b"0123456789abcdefghij"
+
+    def setUp(self):
+        super(FileTransferTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.dest = os.path.join(self.path, "dest")
+
+    def tearDown(self):
+        super(FileTransferTestCase, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def _get_transfer(self, data=DATA):
+        return agent.FileTransfer(
+            self.dest, len(data), 8, hashlib.sha256(data).hexdigest())
+
+    def _write_chunk(self, transfer, index, data=DATA):
+        chunk = data[index * 8:(index + 1) * 8]
+        transfer.write_chunk(index, chunk, hashlib.sha256(chunk).hexdigest())
+
+    def test_transfer(self):
+        transfer = self._get_transfer()
+        self.assertEqual([[0, 3]], transfer.missing())
+
+        self._write_chunk(transfer, 1)
+        self.assertEqual([[0, 1], [2, 3]], transfer.missing())
+        self.assertFalse(transfer.finish())
+
+        self._write_chunk(transfer, 0)
+        self._write_chunk(transfer, 2)
+        self.assertEqual([], transfer.missing())
+        self.assertTrue(transfer.finish())
+
+        with open(self.dest, "rb") as fh:
+            self.assertEqual(self.DATA, fh.read())
+        self.assertEqual(["dest"], os.listdir(self.path))
+
+    def test_transfer_already_there(self):
+        with open(self.dest, "wb") as fh:
+            fh.write(self.DATA)
+
+        transfer = self._get_transfer()
+
+        self.assertTrue(transfer.complete)
+        self.assertEqual([], transfer.missing())
+        self.assertTrue(transfer.finish())
+
+    def test_write_chunk_hash_mismatch(self):
+        transfer = self._get_transfer()
+
+        self.assertRaises(ValueError, transfer.write_chunk,
+                          0, self.DATA[:8], "0" * 64)
+        self.assertEqual([[0, 3]], transfer.missing())
+
+    def test_write_chunk_size_mismatch(self):
+        transfer = self._get_transfer()
+        chunk = self.DATA[:4]
+
+        self.assertRaises(ValueError, transfer.write_chunk,
+                          0, chunk, hashlib.sha256(chunk).hexdigest())
+
+    def test_abort(self):
+        transfer = self._get_transfer()
+        self._write_chunk(transfer, 0)
+
+        transfer.abort()
+        transfer.abort()
+
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_finish_file_hash_mismatch(self):
+        transfer = agent.FileTransfer(self.dest, len(self.DATA), 8, "0" * 64)
+        for index in range(3):
+            self._write_chunk(transfer, index)
+
+        self.assertRaises(ValueError, transfer.finish)
+
+        self.assertEqual([[0, 3]], transfer.missing())
+        self.assertFalse(os.path.exists(self.dest))
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, "outbox")
+
+    def tearDown(self):
+        super(OutboxTestCase, self).tearDown()
+        shutil.rmtree(self.path)
+
+    def _read_log(self):
+        with open(self.log) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_append_ack(self):
+        outbox = agent.Outbox(self.log)
+
+        outbox.append({"req": "a"})
+        outbox.append({"req": "b"})
+        outbox.ack([0, 5])
+
+        self.assertEqual({1: {"req": "b", "outbox_seq": 1}}, outbox.pending)
+        self.assertEqual(
+            [{"resp": {"req": "a", "outbox_seq": 0}},
+             {"resp": {"req": "b", "outbox_seq": 1}},
+             {"ack": [0]}],
+            self._read_log())
+
+    def test_ack_all_compacts(self):
+        outbox = agent.Outbox(self.log)
+        outbox.append({"req": "a"})
+
+        outbox.ack([0])
+
+        self.assertEqual([{"next_seq": 1}], self._read_log())
+        self.assertEqual([], outbox.schedule)
+
+    def test_ack_compact_threshold(self):
+        outbox = agent.Outbox(self.log)
+        outbox.COMPACT_THRESHOLD = 2
+        for req in "abc":
+            outbox.append({"req": req})
+
+        outbox.ack([0])
+        self.assertEqual(4, len(self._read_log()))
+        outbox.ack([1])
+
+        self.assertEqual(
+            [{"next_seq": 3}, {"resp": {"req": "c", "outbox_seq": 2}}],
+            self._read_log())
+
+    def test_load(self):
+        outbox = agent.Outbox(self.log)
+        for req in "abc":
+            outbox.append({"req": req})
+        outbox.ack([1])
+        outbox.fh.write('{"resp": {"torn')
+        outbox.fh.close()
+
+        outbox = agent.Outbox(self.log)
+
+        self.assertEqual(
+            {0: {"req": "a", "outbox_seq": 0},
+             2: {"req": "c", "outbox_seq": 2}},
+            outbox.pending)
+        self.assertEqual(3, outbox.next_seq)
+        self.assertEqual(
+            [{"req": "a", "outbox_seq": 0}, {"req": "c", "outbox_seq": 2}],
+            outbox.get_due())
+
+    def test_load_torn_then_append(self):
+        outbox = agent.Outbox(self.log)
+        outbox.append({"req": "a"})
+        outbox.fh.write('{"resp": {"torn')
+        outbox.fh.close()
+
+        outbox = agent.Outbox(self.log)
+        outbox.append({"req": "b"})
+        outbox.fh.close()
+
+        self.assertEqual(
+            [{"resp": {"req": "a", "outbox_seq": 0}},
+             {"resp": {"req": "b", "outbox_seq": 1}}],
+            self._read_log())
+        outbox = agent.Outbox(self.log)
+        self.assertEqual([0, 1], sorted(outbox.pending))
+
+    def test_load_compacted(self):
+        outbox = agent.Outbox(self.log)
+        outbox.append({"req": "a"})
+        outbox.ack([0])
+
+        outbox = agent.Outbox(self.log)
+
+        self.assertEqual({}, outbox.pending)
+        self.assertEqual(1, outbox.next_seq)
+
+    @mock.patch("agent.monotonic")
+    def test_get_due(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        outbox = agent.Outbox(self.log, retry_interval=5, rate=2)
+        for req in "abc":
+            outbox.append({"req": req})
+
+        due = outbox.get_due()
+        self.assertEqual(["a", "b"], [resp["req"] for resp in due])
+        for resp in due:
+            outbox.reschedule(resp["outbox_seq"], outbox.retry_interval)
+        self.assertEqual([], outbox.get_due())
+
+        mock_monotonic.return_value = 101
+        self.assertEqual(["c"], [resp["req"] for resp in outbox.get_due()])
+
+        mock_monotonic.return_value = 106
+        outbox.ack([0])
+        self.assertEqual(["b"], [resp["req"] for resp in outbox.get_due()])
+
+
 @ddt.ddt
 class AgentTestCase(unittest.TestCase):
     mocks = []
@@ -214,19 +870,21 @@ class AgentTestCase(unittest.TestCase):
 
         self.assertEqual(
             [
+                # Shared zmq.Context()
+                mock.call(io_threads=1),
+
                 # SUB socket
-                # zmq.Context()
-                mock.call(),
                 # context.socket(zmq.SUB)
                 mock.call().socket(zmq.SUB),
                 # socket.connect
                 mock.call().socket().connect("subscribe_url"),
                 # socket.setsockopt_string(zmq.SUBSCRIBE...)
-                mock.call().socket().setsockopt_string(zmq.SUBSCRIBE, u""),
+                mock.call().socket().setsockopt_string(zmq.SUBSCRIBE,
+                                                       u'{"req"'),
+                mock.call().socket().setsockopt_string(
+                    zmq.SUBSCRIBE, u'{"ack:%s"' % agent_instance.agent_id),
 
                 # PUSH socket
-                # zmq.Context()
-                mock.call(),
                 # context.socket(zmq.PUSH)
                 mock.call().socket(zmq.PUSH),
                 # socket.connect
@@ -272,6 +930,72 @@ class AgentTestCase(unittest.TestCase):
             expected = recv_json
         self.assertEqual(expected, retval)
 
+    def test_recv_request_sequenced(self):
+        mock_init_subscribe_zmq, mock_init_push_zmq = self._start_zmq_mocks()
+        subscribe_socket = mock_init_subscribe_zmq.return_value
+        push_socket = mock_init_push_zmq.return_value
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="abc")
+
+        subscribe_socket.recv_json.return_value = {"seq": 3}
+        agent_instance.recv_request()
+        subscribe_socket.recv_json.return_value = {"seq": 6,
+                                                   "target": "other"}
+        agent_instance.recv_request()
+        subscribe_socket.recv_json.return_value = {"seq": 7}
+        agent_instance.recv_request()
+
+        self.assertEqual(
+            [
+                mock.call({"agents": ["abc"], "ack_seq": 3}, zmq.NOBLOCK),
+                mock.call({"agents": ["abc"], "nack": [4, 5]}, zmq.NOBLOCK),
+                mock.call({"agents": ["abc"], "ack_seq": 7}, zmq.NOBLOCK),
+            ],
+            push_socket.send_json.mock_calls)
+
+    def test_recv_request_ack_dropped(self):
+        mock_init_subscribe_zmq, mock_init_push_zmq = self._start_zmq_mocks()
+        mock_init_subscribe_zmq.return_value.recv_json.return_value = {
+            "seq": 1, "foo": "bar"}
+        mock_init_push_zmq.return_value.send_json.side_effect = zmq.Again
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+
+        self.assertEqual({"seq": 1, "foo": "bar"},
+                         agent_instance.recv_request())
+
+    @ddt.unpack
+    @ddt.data(
+        {"request": {"replay_to": ["abc"]}, "expected": True},
+        {"request": {"replay_to": ["other"]}, "expected": False},
+        {"request": {"replay_to": ["abc"], "target": "other"},
+         "expected": False},
+    )
+    def test_is_target_replay_to(self, request, expected):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="abc")
+
+        self.assertEqual(expected, agent_instance.is_target(request))
+
+    @ddt.unpack
+    @ddt.data(
+        {"request": {"selector": "role=db"}, "expected": True},
+        {"request": {"selector": "role=db,rack in (a1,a2)"},
+         "expected": False},
+        {"request": {"selector": "role=db", "target": "other"},
+         "expected": False},
+        {"request": {"selector": "role="}, "expected": False},
+        {"request": {"selector": "bad selector"}, "expected": False},
+        {"request": {"selector": ""}, "expected": True},
+    )
+    def test_is_target_selector(self, request, expected):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent(
+            "subscribe_url", "push_url", agent_id="abc",
+            labels={"role": "db", "rack": "a7"})
+
+        self.assertEqual(expected, agent_instance.is_target(request))
+
     def test_do_default(self):
         self._start_zmq_mocks()
         agent_instance = agent.Agent("subscribe_url", "push_url")
@@ -325,6 +1049,134 @@ class AgentTestCase(unittest.TestCase):
             {"custom": "return"}
         )
 
+    def test_loop_noreply(self):
+        _, mock_init_push_zmq = self._start_zmq_mocks()
+        push_socket = mock_init_push_zmq.return_value
+
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        agent_instance.recv_request = mock.Mock(
+            return_value={
+                "action": "mock",
+                "req": "foobar",
+                "noreply": True
+            })
+        agent_instance.do_mock = mock.Mock()
+
+        agent_instance.loop()
+
+        agent_instance.do_mock.assert_called_once_with(
+            agent_instance.recv_request.return_value, mock.ANY)
+        self.assertFalse(push_socket.send_json.called)
+
+    def test_loop_duplicate(self):
+        _, mock_init_push_zmq = self._start_zmq_mocks()
+        push_socket = mock_init_push_zmq.return_value
+
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="abc")
+        agent_instance.recv_request = mock.Mock(
+            return_value={"action": "mock", "req": "foobar"})
+        agent_instance.do_mock = mock.Mock(return_value={"foo": "bar"})
+
+        agent_instance.loop()
+        agent_instance.loop()
+
+        agent_instance.do_mock.assert_called_once_with(
+            agent_instance.recv_request.return_value, mock.ANY)
+        self.assertEqual([mock.call({"foo": "bar"})] * 2,
+                         push_socket.send_json.mock_calls)
+
+    @ddt.data(
+        ({"req": "foobar"}, [mock.call(
+            {"req": "foobar", "agent": "abc", "in_progress": True},
+            zmq.NOBLOCK)]),
+        ({"req": "foobar", "noreply": True}, []),
+    )
+    @ddt.unpack
+    def test_accept_request_in_progress(self, req, expected):
+        _, mock_init_push_zmq = self._start_zmq_mocks()
+        push_socket = mock_init_push_zmq.return_value
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="abc")
+
+        self.assertTrue(agent_instance.accept_request(req))
+        self.assertFalse(agent_instance.accept_request(req))
+
+        self.assertEqual(expected, push_socket.send_json.mock_calls)
+
+    def test_accept_request_outbox(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     outbox=mock.Mock())
+        agent_instance.requests.begin("foobar")
+        agent_instance.requests.finish("foobar", {"foo": "bar"})
+
+        self.assertFalse(agent_instance.accept_request({"req": "foobar"}))
+
+        self.assertFalse(agent_instance.outbox.append.called)
+
+    def test_loop_outbox_idle(self):
+        mock_init_subscribe_zmq, _ = self._start_zmq_mocks()
+        subscribe_socket = mock_init_subscribe_zmq.return_value
+        subscribe_socket.poll.return_value = 0
+
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     outbox=mock.Mock())
+        agent_instance.flush_outbox = mock.Mock()
+        agent_instance.recv_request = mock.Mock()
+
+        agent_instance.loop()
+
+        agent_instance.flush_outbox.assert_called_once_with()
+        subscribe_socket.poll.assert_called_once_with(
+            agent_instance.OUTBOX_POLL_INTERVAL)
+        self.assertFalse(agent_instance.recv_request.called)
+
+    def test_send_outbox(self):
+        self._start_zmq_mocks()
+        outbox = mock.Mock()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     outbox=outbox)
+        agent_instance.flush_outbox = mock.Mock()
+
+        agent_instance.send({"req": "foo"})
+
+        outbox.append.assert_called_once_with({"req": "foo"})
+        agent_instance.flush_outbox.assert_called_once_with()
+        self.assertFalse(agent_instance.push_socket.send_json.called)
+
+    def test_flush_outbox(self):
+        self._start_zmq_mocks()
+        outbox = mock.Mock(retry_interval=5)
+        outbox.get_due.return_value = [
+            {"outbox_seq": 1}, {"outbox_seq": 2}, {"outbox_seq": 3}]
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     outbox=outbox)
+        agent_instance.push_socket.send_json.side_effect = [
+            None, zmq.Again(), None]
+
+        agent_instance.flush_outbox()
+
+        self.assertEqual(
+            [mock.call({"outbox_seq": 1}, zmq.NOBLOCK),
+             mock.call({"outbox_seq": 2}, zmq.NOBLOCK)],
+            agent_instance.push_socket.send_json.mock_calls)
+        self.assertEqual(
+            [mock.call(1, 5), mock.call(2), mock.call(3)],
+            outbox.reschedule.mock_calls)
+
+    def test_do_outbox_ack(self):
+        self._start_zmq_mocks()
+        outbox = mock.Mock()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="foo", outbox=outbox)
+
+        agent_instance.do_outbox_ack({"acks": {"bar": [1]}}, {})
+        self.assertFalse(outbox.ack.called)
+
+        agent_instance.do_outbox_ack({"acks": {"foo": [1, 2]}}, {})
+        outbox.ack.assert_called_once_with([1, 2])
+
     def test_loop_mock_action_return_none(self):
         _, mock_init_push_zmq = self._start_zmq_mocks()
         push_socket = mock_init_push_zmq.return_value
@@ -350,8 +1202,9 @@ class AgentTestCase(unittest.TestCase):
             }
         )
 
+    @mock.patch("time.time", side_effect=[10.5, 10.75])
     @mock.patch("datetime.datetime")
-    def test_do_ping(self, mock_datetime_datetime):
+    def test_do_ping(self, mock_datetime_datetime, mock_time_time):
         self._start_zmq_mocks()
         agent_instance = agent.Agent("subscribe_url", "push_url")
 
@@ -363,9 +1216,86 @@ class AgentTestCase(unittest.TestCase):
         resp = {}
         agent_instance.do_ping(req, resp)
 
-        self.assertEqual("foobar", resp["time"])
+        self.assertEqual(
+            {"time": "foobar", "recv_time": 10.5, "send_time": 10.75}, resp)
         self.assertEqual({}, req)
 
+    def test_do_clock(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="a")
+
+        agent_instance.do_clock({"offsets": {"b": 1.5}}, {})
+        self.assertEqual(0.0, agent_instance.clock_offset)
+
+        agent_instance.do_clock({"offsets": {"a": -0.25}}, {})
+        self.assertEqual(-0.25, agent_instance.clock_offset)
+
+    def test_do_events(self):
+        self._start_zmq_mocks()
+        flight_recorder = mock.Mock(**{"dump.return_value": {"events": []}})
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     recorder=flight_recorder)
+        resp = {"req": "r2"}
+
+        agent_instance.do_events(
+            {"req": "r2", "events_req": "r1", "limit": 5}, resp)
+
+        flight_recorder.dump.assert_called_once_with(req="r1", limit=5)
+        self.assertEqual({"req": "r2", "events": []}, resp)
+
+    def test_do_events_off(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+
+        self.assertRaises(ValueError, agent_instance.do_events, {}, {})
+
+    @mock.patch("zmq.Context")
+    def test_init_zmq_recorder(self, mock_zmq_context):
+        flight_recorder = mock.Mock()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     recorder=flight_recorder)
+
+        for socket, event in ((agent_instance.subscribe_socket, "receive"),
+                              (agent_instance.push_socket, "send")):
+            self.assertIsInstance(socket, agent.recorder.RecordingSocket)
+            self.assertIs(flight_recorder, socket.recorder)
+            self.assertEqual(event, socket.event)
+
+    def test_do_profile_off(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+
+        self.assertRaises(ValueError, agent_instance.do_profile,
+                          {"seconds": 1}, {})
+
+    @mock.patch("agent.profiling.counters")
+    def test_do_profile(self, mock_counters):
+        self._start_zmq_mocks()
+        profiler = mock.Mock(**{"get_result.return_value": {"left": 1}})
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     profiler=profiler)
+        resp = {}
+
+        agent_instance.do_profile({"seconds": "2"}, resp)
+        agent_instance.do_profile({}, resp)
+
+        profiler.start.assert_called_once_with("2")
+        self.assertEqual(
+            {"left": 1, "counters": mock_counters.snapshot.return_value},
+            resp)
+
+    def test_loop_polls_profiler(self):
+        self._start_zmq_mocks()
+        profiler = mock.Mock()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     profiler=profiler)
+        agent_instance.recv_request = mock.Mock(return_value=None)
+
+        agent_instance.loop()
+
+        profiler.poll.assert_called_once_with()
+
     def test_do_tail_no_executor(self):
         self._start_zmq_mocks()
         agent_instance = agent.Agent("subscribe_url", "push_url")
@@ -403,6 +1333,19 @@ class AgentTestCase(unittest.TestCase):
             },
             resp)
 
+    def test_do_tail_filter(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        executor = agent_instance.executor = mock.Mock(stderr_fh=None)
+        executor.stdout_fh.read.return_value = b"a\nn=1\nb\nn=2\n"
+
+        resp = {}
+        agent_instance.do_tail(
+            {"exclude": "^n=", "extract": "n=(?P<n>\\d)"}, resp)
+
+        self.assertEqual(
+            {"stdout": "a\nb\n", "stdout_fields": {"n": 2}}, resp)
+
     def test_do_check_no_executor(self):
         self._start_zmq_mocks()
         agent_instance = agent.Agent("subscribe_url", "push_url")
@@ -421,14 +1364,15 @@ class AgentTestCase(unittest.TestCase):
         self._start_zmq_mocks()
         agent_instance = agent.Agent("subscribe_url", "push_url")
 
-        executor = agent_instance.executor = mock.Mock(exit_code="foobar")
+        executor = agent_instance.executor = mock.Mock(
+            exit_code="foobar", usage="usage", timeout=None)
 
         resp = {}
         agent_instance.do_check(req, resp)
 
         if req.get("wait") or req.get("clear"):
             executor.thread.join.assert_called_once_with()
-        self.assertEqual({"exit_code": "foobar"}, resp)
+        self.assertEqual({"exit_code": "foobar", "usage": "usage"}, resp)
         if req.get("clear"):
             executor.clear.assert_called_once_with()
             self.assertIsNone(agent_instance.executor)
@@ -450,7 +1394,489 @@ class AgentTestCase(unittest.TestCase):
         agent_instance.do_command(req, resp)
 
         mock_agent_command_executor.assert_called_once_with(
-            req, resp, agent_instance.agent_id)
+            req, resp, agent_instance.agent_id, capture_limit=None,
+            spawn_client=None, clock_offset=0.0)
         self.assertEqual(mock_agent_command_executor.return_value,
                          agent_instance.executor)
         mock_agent_command_executor.return_value.run.assert_called_once_with()
+
+    @ddt.data(
+        ({"path": ["run", "{index}/{count}"], "env": {"RACK": "{label:rack}"},
+          "target": "c,b,a"},
+         {"path": ["run", "1/3"], "env": {"RACK": "a7"}}),
+        ({"path": "run-{agent_id}", "shards": ["b", "x"]},
+         {"path": "run-b"}),
+        ({"path": ["{index}"], "target": ["a"]}, None),
+    )
+    @ddt.unpack
+    def test_expand_request(self, req, expected):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="b", labels={"rack": "a7"})
+        req = dict(req, template=True)
+        original = dict(req)
+
+        if expected is None:
+            self.assertRaises(ValueError, agent_instance.expand_request, req)
+            return
+
+        retval = agent_instance.expand_request(req)
+
+        self.assertEqual(original, req)
+        for key, value in expected.items():
+            self.assertEqual(value, retval[key])
+
+    def test_expand_request_no_template(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        req = {"path": ["echo", "{index}"]}
+
+        self.assertIs(req, agent_instance.expand_request(req))
+
+    @mock.patch("agent.CommandExecutor")
+    def test_do_command_template(self, mock_agent_command_executor):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     agent_id="a")
+
+        agent_instance.do_command(
+            {"path": ["echo", "{agent_id}"], "template": True}, {})
+
+        self.assertEqual(["echo", "a"],
+                         mock_agent_command_executor.call_args[0][0]["path"])
+
+    @mock.patch("agent.FileTransfer")
+    def test_do_file_status(self, mock_agent_file_transfer):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        req = {"file_id": "foo", "dest": "/tmp/bar", "size": "20",
+               "chunk_size": 8, "sha256": "abc"}
+
+        transfer = mock_agent_file_transfer.return_value
+        transfer.finish.return_value = False
+
+        for i in range(2):
+            resp = {}
+            agent_instance.do_file_status(req, resp)
+
+        mock_agent_file_transfer.assert_called_once_with(
+            "/tmp/bar", 20, 8, "abc")
+        self.assertEqual({"foo": transfer}, agent_instance.transfers)
+        self.assertEqual(
+            {"file_id": "foo", "complete": False,
+             "missing": transfer.missing.return_value},
+            resp)
+
+    def test_do_file_status_complete(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        transfer = agent_instance.transfers["foo"] = mock.Mock()
+        transfer.finish.return_value = True
+        transfer.missing.return_value = []
+
+        resp = {}
+        agent_instance.do_file_status({"file_id": "foo"}, resp)
+
+        self.assertEqual(
+            {"file_id": "foo", "complete": True, "missing": []}, resp)
+        self.assertEqual({}, agent_instance.transfers)
+
+    @mock.patch("agent.monotonic", return_value=1000)
+    def test_expire_transfers(self, mock_monotonic):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        old = agent_instance.transfers["old"] = mock.Mock(last_used=399)
+        new = agent_instance.transfers["new"] = mock.Mock(last_used=401)
+
+        agent_instance.handle_request({"req": "r", "action": "ping",
+                                       "noreply": True})
+
+        self.assertEqual({"new": new}, agent_instance.transfers)
+        old.abort.assert_called_once_with()
+        self.assertFalse(new.abort.called)
+
+    def test_do_file_chunk(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+        transfer = agent_instance.transfers["foo"] = mock.Mock()
+
+        agent_instance.do_file_chunk(
+            {"file_id": "foo", "index": 2, "sha256": "abc",
+             "data": base64.b64encode(b"data").decode("ascii")}, {})
+
+        transfer.write_chunk.assert_called_once_with(2, b"data", "abc")
+
+    def test_do_file_chunk_unknown(self):
+        self._start_zmq_mocks()
+        agent_instance = agent.Agent("subscribe_url", "push_url")
+
+        self.assertRaises(ValueError, agent_instance.do_file_chunk,
+                          {"file_id": "foo"}, {})
+
+    def test_do_put_script(self):
+        self._start_zmq_mocks()
+        script_cache = mock.Mock()
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     script_cache=script_cache)
+
+        resp = {}
+        agent_instance.do_put_script({"script": "foo", "hash": "bar"}, resp)
+
+        script_cache.put.assert_called_once_with("foo", "bar")
+        self.assertEqual({"hash": script_cache.put.return_value}, resp)
+
+    @ddt.unpack
+    @ddt.data(
+        {"req": {"hash": "abc"}, "path": ["/cache/abc"]},
+        {"req": {"hash": "abc", "args": "foo"},
+         "path": ["/cache/abc", "foo"]},
+        {"req": {"hash": "abc", "args": ["foo", 10]},
+         "path": ["/cache/abc", "foo", "10"]},
+        {"req": {"hash": "abc", "script": "body"}, "path": ["/cache/abc"],
+         "put": True},
+    )
+    def test_do_run_cached(self, req, path, put=False):
+        self._start_zmq_mocks()
+        script_cache = mock.Mock(**{"get.return_value": "/cache/abc"})
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     script_cache=script_cache)
+        agent_instance.do_command = mock.Mock()
+
+        resp = {}
+        retval = agent_instance.do_run_cached(req, resp)
+
+        if put:
+            script_cache.put.assert_called_once_with("body", "abc")
+            self.assertNotIn("script", req)
+        else:
+            self.assertFalse(script_cache.put.called)
+        script_cache.get.assert_called_once_with("abc")
+        self.assertEqual(path, req["path"])
+        agent_instance.do_command.assert_called_once_with(req, resp)
+        self.assertEqual(agent_instance.do_command.return_value, retval)
+
+    def test_do_run_cached_miss(self):
+        self._start_zmq_mocks()
+        script_cache = mock.Mock(**{"get.return_value": None})
+        agent_instance = agent.Agent("subscribe_url", "push_url",
+                                     script_cache=script_cache)
+        agent_instance.do_command = mock.Mock()
+
+        resp = {}
+        self.assertRaises(ValueError, agent_instance.do_run_cached,
+                          {"hash": "abc"}, resp)
+
+        self.assertEqual({"cache_miss": "abc"}, resp)
+        self.assertFalse(agent_instance.do_command.called)
+
+
+class AgentGroupTestCase(unittest.TestCase):
+    def _get_group(self, agent_ids=("a", "b", "c"), **kwargs):
+        self.transport_profile = mock.Mock()
+        return agent.AgentGroup("subscribe_url", "push_url", agent_ids,
+                                transport_profile=self.transport_profile,
+                                **kwargs)
+
+    def test___init__(self):
+        outbox_factory = mock.Mock(side_effect=lambda agent_id: agent_id)
+
+        group = self._get_group(outbox_factory=outbox_factory,
+                                capture_limit=10)
+
+        self.assertEqual(
+            [mock.call(zmq.SUB), mock.call(zmq.PUSH)],
+            self.transport_profile.socket.call_args_list)
+        subscribe_socket = self.transport_profile.socket.return_value
+        subscribe_socket.connect.assert_any_call("subscribe_url")
+        subscribe_socket.connect.assert_any_call("push_url")
+        self.assertEqual(["a", "b", "c"], list(group.agents))
+        for agent_id, agent_instance in group.agents.items():
+            self.assertEqual(agent_id, agent_instance.agent_id)
+            self.assertEqual(agent_id, agent_instance.outbox)
+            self.assertEqual(10, agent_instance.capture_limit)
+            self.assertIs(group.subscribe_socket,
+                          agent_instance.subscribe_socket)
+            self.assertIs(group.push_socket, agent_instance.push_socket)
+
+    def test_get_targets(self):
+        group = self._get_group()
+        agents = group.agents
+
+        self.assertEqual(list(agents.values()), group.get_targets({}))
+        self.assertEqual([agents["b"]],
+                         group.get_targets({"target": "b,d"}))
+        self.assertEqual(
+            set([agents["a"], agents["c"]]),
+            set(group.get_targets({"target": ["a", "c"]})))
+
+    def test_get_targets_selector(self):
+        group = self._get_group()
+        agents = group.agents
+        agents["a"].labels = {"role": "db"}
+        agents["b"].labels = {"role": "web"}
+        agents["c"].labels = {"role": "db"}
+
+        self.assertEqual([agents["a"], agents["c"]],
+                         group.get_targets({"selector": "role=db"}))
+        self.assertEqual([agents["c"]],
+                         group.get_targets({"selector": "role=db",
+                                            "target": "b,c"}))
+        self.assertEqual([], group.get_targets({"selector": "a b"}))
+
+    @mock.patch("threading.Thread")
+    def test_dispatch(self, mock_threading_thread):
+        group = self._get_group()
+        agent_instance = group.agents["a"]
+
+        group.dispatch(agent_instance, {"req": 1})
+        group.dispatch(agent_instance, {"req": 2})
+
+        mock_threading_thread.assert_called_once_with(
+            target=group._work, args=(agent_instance,))
+        mock_threading_thread.return_value.start.assert_called_once_with()
+        self.assertEqual([{"req": 1}, {"req": 2}],
+                         list(group.queues["a"]))
+
+    @mock.patch("threading.Thread")
+    def test_dispatch_duplicate(self, mock_threading_thread):
+        group = self._get_group()
+        agent_instance = group.agents["a"]
+
+        group.dispatch(agent_instance, {"req": 1})
+        group.dispatch(agent_instance, {"req": 1})
+
+        self.assertEqual([{"req": 1}], list(group.queues["a"]))
+        group.push_socket.socket.send_json.assert_called_once_with(
+            {"req": 1, "agent": "a", "in_progress": True}, zmq.NOBLOCK)
+
+    @mock.patch.object(agent.CommandExecutor, "_wait", return_value=0)
+    @mock.patch.object(agent.CommandExecutor, "_communicate",
+                       return_value=[None, None])
+    @mock.patch("subprocess.Popen")
+    @mock.patch("threading.Thread")
+    def test__work_own_request(self, mock_threading_thread,
+                               mock_subprocess_popen, mock_communicate,
+                               mock_wait):
+        group = self._get_group()
+        request = {"req": 1, "action": "command", "path": ["true"],
+                   "env": {"AGENT_ID": "", "FOO": "bar"}, "noreply": True}
+
+        for agent_instance in group.agents.values():
+            group.dispatch(agent_instance, request)
+        for agent_instance in group.agents.values():
+            group._work(agent_instance)
+
+        self.assertEqual(
+            [{"AGENT_ID": agent_id, "FOO": "bar"} for agent_id in "abc"],
+            [call[2]["env"] for call in mock_subprocess_popen.mock_calls
+             if call[0] == ""])
+        self.assertEqual({"AGENT_ID": "", "FOO": "bar"}, request["env"])
+
+    @mock.patch("threading.Thread")
+    def test__work(self, mock_threading_thread):
+        group = self._get_group()
+        agent_instance = group.agents["a"]
+        agent_instance.handle_request = mock.Mock()
+        group.dispatch(agent_instance, {"req": 1})
+        group.dispatch(agent_instance, {"req": 2})
+
+        group._work(agent_instance)
+
+        self.assertEqual(
+            [mock.call({"req": 1}), mock.call({"req": 2})],
+            agent_instance.handle_request.mock_calls)
+        self.assertEqual({}, group.queues)
+
+    def test_flush_outboxes(self):
+        group = self._get_group(outbox_factory=lambda agent_id: mock.Mock())
+        for agent_instance in group.agents.values():
+            agent_instance.flush_outbox = mock.Mock()
+        group.queues["b"] = [{"req": 1}]
+
+        group.flush_outboxes()
+
+        group.agents["a"].flush_outbox.assert_called_once_with()
+        self.assertFalse(group.agents["b"].flush_outbox.called)
+        group.agents["c"].flush_outbox.assert_called_once_with()
+        self.assertEqual({"b": [{"req": 1}]}, group.queues)
+
+    @mock.patch("threading.Thread")
+    def test_flush_outboxes_dispatch(self, mock_threading_thread):
+        group = self._get_group(agent_ids=("a",),
+                                outbox_factory=lambda agent_id: mock.Mock())
+        agent_instance = group.agents["a"]
+        agent_instance.flush_outbox = mock.Mock(
+            side_effect=lambda: group.dispatch(agent_instance, {"req": 1}))
+
+        group.flush_outboxes()
+
+        # The request dispatched while flushing waits for the flush and
+        # only then gets a worker.
+        mock_threading_thread.assert_called_once_with(
+            target=group._work, args=(agent_instance,))
+        mock_threading_thread.return_value.start.assert_called_once_with()
+        self.assertEqual([{"req": 1}], list(group.queues["a"]))
+
+    def test_loop(self):
+        group = self._get_group()
+        group.dispatch = mock.Mock()
+        group.subscribe_socket.recv_json.return_value = {"target": "a,c"}
+
+        group.loop()
+
+        group.subscribe_socket.poll.assert_called_once_with(
+            group.POLL_INTERVAL)
+        self.assertEqual(
+            set([group.agents["a"], group.agents["c"]]),
+            set(call[1][0] for call in group.dispatch.mock_calls))
+
+    def test_loop_sequenced(self):
+        group = self._get_group()
+        group.dispatch = mock.Mock()
+        group.sequence.expected = 4
+        group.subscribe_socket.recv_json.return_value = {
+            "seq": 5, "target": "a,c"}
+
+        group.loop()
+
+        send_json = group.push_socket.socket.send_json
+        self.assertEqual(
+            mock.call({"agents": ["a", "b", "c"], "nack": [4]}, zmq.NOBLOCK),
+            send_json.mock_calls[0])
+        ack = send_json.mock_calls[1][1][0]
+        self.assertEqual(5, ack["ack_seq"])
+        self.assertEqual(set(["a", "c"]), set(ack["agents"]))
+
+    def test_get_targets_replay_to(self):
+        group = self._get_group()
+        agents = group.agents
+
+        self.assertEqual([agents["b"]],
+                         group.get_targets({"replay_to": ["b", "d"]}))
+        self.assertEqual([agents["c"]], group.get_targets(
+            {"replay_to": ["b", "c"], "target": "a,c"}))
+
+    def test_loop_idle(self):
+        group = self._get_group()
+        group.dispatch = mock.Mock()
+        group.subscribe_socket.poll.return_value = 0
+
+        group.loop()
+
+        self.assertFalse(group.subscribe_socket.recv_json.called)
+        self.assertFalse(group.dispatch.called)
+
+
+class RequestCacheTestCase(unittest.TestCase):
+    def test_begin_finish(self):
+        cache = agent.RequestCache()
+
+        self.assertEqual((True, None), cache.begin("a"))
+        self.assertEqual((False, None), cache.begin("a"))
+        cache.finish("a", {"foo": "bar"})
+        self.assertEqual((False, {"foo": "bar"}), cache.begin("a"))
+
+    def test_begin_bounded(self):
+        cache = agent.RequestCache(max_size=2)
+
+        for req_id in "abc":
+            cache.begin(req_id)
+        cache.finish("a", {"foo": "bar"})
+
+        self.assertEqual(["b", "c"], list(cache.responses))
+        self.assertEqual((True, None), cache.begin("a"))
+
+
+class SequenceTrackerTestCase(unittest.TestCase):
+    def test_receive(self):
+        tracker = agent.SequenceTracker()
+
+        self.assertEqual([], tracker.receive({}))
+        self.assertEqual([], tracker.receive({"seq": 10}))
+        self.assertEqual([], tracker.receive({"seq": 11}))
+        self.assertEqual([12, 13], tracker.receive({"seq": 14}))
+        self.assertEqual([], tracker.receive({"seq": 12,
+                                              "replay_to": ["a"]}))
+        self.assertEqual(15, tracker.expected)
+
+    def test_receive_restart(self):
+        tracker = agent.SequenceTracker()
+        tracker.receive({"seq": 10})
+
+        self.assertEqual([], tracker.receive({"seq": 0}))
+        self.assertEqual(1, tracker.expected)
+
+    def test_receive_large_gap(self):
+        tracker = agent.SequenceTracker()
+        tracker.receive({"seq": 0})
+
+        missing = tracker.receive({"seq": 1000})
+
+        self.assertEqual(list(range(900, 1000)), missing)
+
+
+@ddt.ddt
+class ModuleTestCase(unittest.TestCase):
+    @ddt.unpack
+    @ddt.data(
+        {"target": None, "expected": None},
+        {"target": "", "expected": None},
+        {"target": "a,b", "expected": set(["a", "b"])},
+        {"target": ["a", "b"], "expected": set(["a", "b"])},
+    )
+    def test_parse_target(self, target, expected):
+        self.assertEqual(expected, agent.parse_target(target))
+
+    @ddt.unpack
+    @ddt.data(
+        ("run --shard {index}/{count}", "run --shard 2/4"),
+        ("{agent_id}@{label:rack}", "b@a7"),
+        ("awk '{{print $1}}'", "awk '{print $1}'"),
+        ("${HOME}", "${HOME}"),
+        ("{home}", None),
+        ("{label:role}", None),
+        ("{index:x}", None),
+    )
+    def test_expand_template(self, text, expected):
+        params = {"agent_id": "b", "index": 2, "count": 4}
+        labels = {"rack": "a7"}
+
+        if expected is None:
+            self.assertRaises(ValueError, agent.expand_template, text,
+                              params, labels)
+        else:
+            self.assertEqual(expected,
+                             agent.expand_template(text, params, labels))
+
+    @ddt.unpack
+    @ddt.data(
+        {"agent_id": "foo", "count": 1, "expected": ["foo"]},
+        {"agent_id": "foo-{index}", "count": 1, "expected": ["foo-0"]},
+        {"agent_id": "foo", "count": 2, "expected": ["foo-0", "foo-1"]},
+        {"agent_id": "rack{index}a", "count": 2,
+         "expected": ["rack0a", "rack1a"]},
+    )
+    def test_get_agent_ids(self, agent_id, count, expected):
+        self.assertEqual(expected, agent.get_agent_ids(agent_id, count))
+
+    @mock.patch("uuid.uuid4", side_effect=["u1", "u2"])
+    def test_get_agent_ids_uuid(self, mock_uuid_uuid4):
+        self.assertEqual(["u1", "u2"], agent.get_agent_ids(None, 2))
+
+    def test_parse_args_label(self):
+        args = agent.parse_args(["--label", "rack=a7", "--label", "role=db"])
+
+        self.assertEqual([("rack", "a7"), ("role", "db")], args.label)
+
+    @ddt.data("0", "-1")
+    @mock.patch("sys.stderr")
+    def test_parse_args_count(self, count, mock_sys_stderr):
+        self.assertRaises(SystemExit, agent.parse_args, ["--count", count])
+
+    def test_locked_socket(self):
+        socket = mock.Mock()
+        locked_socket = agent.LockedSocket(socket)
+
+        locked_socket.send_json({"foo": "bar"}, zmq.NOBLOCK)
+
+        socket.send_json.assert_called_once_with({"foo": "bar"}, zmq.NOBLOCK)
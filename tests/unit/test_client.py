@@ -0,0 +1,321 @@
+#!/usr/bin/python
+
+import asyncio
+import ddt
+import mock
+import unittest
+
+import client
+
+
+def http_response(data, status_code=200):
+    return mock.Mock(status_code=status_code,
+                     **{"json.return_value": data})
+
+
+@ddt.ddt
+class ModuleTestCase(unittest.TestCase):
+    def test_encode_fields(self):
+        self.assertEqual(
+            {"path": '["echo", "hi"]', "env": '["A=1", "B=x=y"]',
+             "thread": "true", "target": '"a"'},
+            client.encode_fields({
+                "path": ["echo", "hi"], "env": {"B": "x=y", "A": "1"},
+                "thread": True, "target": "a", "selector": None}))
+
+
+@ddt.ddt
+class ClientTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ClientTestCase, self).setUp()
+        self.session = mock.Mock()
+        self.client = client.Client("http://master/", session=self.session)
+
+    def test___init__(self):
+        self.assertEqual("http://master", self.client.url)
+        self.assertEqual(
+            ["http://", "https://"],
+            [call[1][0] for call in self.session.mount.mock_calls])
+        adapter = self.session.mount.call_args[0][1]
+        self.assertEqual(client.Client.POOL_SIZE, adapter._pool_maxsize)
+
+    def test_request(self):
+        self.session.request.return_value = http_response([{"agent": "a"}])
+
+        retval = self.client.request(
+            "command", ("a", "b"), timeout=100, path=["true"],
+            config={"quorum": 50})
+
+        self.assertEqual([{"agent": "a"}], retval)
+        self.session.request.assert_called_once_with(
+            "POST", "http://master/command",
+            params={"quorum": 50, "timeout": 100},
+            data={"path": '["true"]', "target": '["a", "b"]'})
+
+    @ddt.data(
+        ({}, {"path": '["sleep", "10"]'}),
+        ({"thread": True}, {"path": '["sleep", "10"]', "thread": "true"}),
+    )
+    @ddt.unpack
+    def test_command(self, kwargs, data):
+        self.session.request.return_value = http_response([])
+
+        self.client.command(["sleep", "10"], **kwargs)
+
+        self.assertEqual(data, self.session.request.call_args[1]["data"])
+
+    @ddt.data(
+        (http_response({"error": "Duplicate argumets."}, 400),
+         "Duplicate argumets."),
+        (mock.Mock(status_code=404, **{"json.side_effect": ValueError}),
+         "GET /agents failed with HTTP status 404."),
+    )
+    @ddt.unpack
+    def test__call_error(self, response, message):
+        self.session.request.return_value = response
+
+        with self.assertRaises(client.MasterAgentError) as context:
+            self.client._call("GET", "/agents")
+        self.assertEqual(message, str(context.exception))
+
+    def test_agents(self):
+        self.session.request.return_value = http_response(
+            {"agents": {"a": {}}})
+
+        self.assertEqual({"a": {}}, self.client.agents("role=db"))
+        self.session.request.assert_called_once_with(
+            "GET", "http://master/agents", params={"selector": "role=db"},
+            data=None)
+
+    @ddt.data(
+        ((), {}, 200),
+        ((2, 4), {"Range": "bytes=2-4"}, 206),
+        ((None, 10), {"Range": "bytes=-10"}, 206),
+    )
+    @ddt.unpack
+    def test_output(self, byte_range, headers, status_code):
+        self.session.request.return_value = mock.Mock(
+            status_code=status_code, content=b"data")
+
+        retval = self.client.output("/output/r1/a/stdout", *byte_range)
+
+        self.assertEqual(b"data", retval)
+        self.session.request.assert_called_once_with(
+            "GET", "http://master/output/r1/a/stdout", headers=headers)
+
+    def test_output_error(self):
+        self.session.request.return_value = mock.Mock(status_code=416)
+
+        self.assertRaises(client.MasterAgentError, self.client.output,
+                          "/output/r1/a/stdout", 100)
+
+    @ddt.data(False, True)
+    def test_missed(self, delete):
+        self.session.request.return_value = http_response(
+            {"missed": {"r1": [{"agent": "a"}]}, "next": None, "total": 1})
+
+        retval = self.client.missed(100, delete, agent="a")
+
+        self.assertEqual({"r1": [{"agent": "a"}]}, retval)
+        self.session.request.assert_called_once_with(
+            "DELETE" if delete else "GET", "http://master/missed",
+            params={"agent": "a", "timeout": 100}, data=None)
+
+    def test_iter_missed(self):
+        self.client.missed_page = mock.Mock(side_effect=[
+            {"missed": {"r1": [{"agent": "a"}, {"agent": "b"}]}, "next": 2},
+            {"missed": {"r2": [{"agent": "a"}]}, "next": None},
+        ])
+
+        retval = list(self.client.iter_missed(limit=2))
+
+        self.assertEqual([{"agent": "a"}, {"agent": "b"}, {"agent": "a"}],
+                         retval)
+        self.assertEqual(
+            [mock.call(None, False, limit=2),
+             mock.call(None, False, limit=2, cursor=2)],
+            self.client.missed_page.mock_calls)
+
+    def test_submit_job(self):
+        self.session.request.return_value = http_response({"job": "j"})
+
+        retval = self.client.submit_job([{"path": ["x"]}], ["a"], retries=1)
+
+        self.assertEqual("j", retval)
+        self.session.request.assert_called_once_with(
+            "POST", "http://master/jobs", params={"retries": 1},
+            data={"tasks": '[{"path": ["x"]}]', "target": '["a"]'})
+
+    @mock.patch("time.time")
+    def test_wait_job(self, mock_time_time):
+        mock_time_time.side_effect = [10.0, 10.0, 11.0, 11.0, 11.5, 11.5,
+                                      12.0]
+        self.client.job = mock.Mock(side_effect=[
+            {"state": "running"}, {"state": "running"},
+            {"state": "running"}])
+
+        retval = self.client.wait_job("j", timeout=2000)
+
+        self.assertEqual({"state": "running"}, retval)
+        self.assertEqual(
+            [mock.call("j", 1000), mock.call("j", 1000),
+             mock.call("j", 500.0)],
+            self.client.job.mock_calls)
+
+    def test_wait_job_finished(self):
+        self.client.job = mock.Mock(return_value={"state": "finished"})
+
+        self.assertEqual({"state": "finished"}, self.client.wait_job("j"))
+        self.client.job.assert_called_once_with("j", 1000)
+
+    def test_iter_job_results(self):
+        self.client.job_results = mock.Mock(side_effect=[
+            {"results": [{"task": 0}, {"task": 1}], "next": 1},
+            {"results": [{"task": 2}], "next": None},
+        ])
+
+        retval = list(self.client.iter_job_results("j", "failed"))
+
+        self.assertEqual([{"task": 0}, {"task": 1}, {"task": 2}], retval)
+        self.assertEqual(
+            [mock.call("j", "failed", None, 1000),
+             mock.call("j", "failed", 1, 1000)],
+            self.client.job_results.mock_calls)
+
+    @mock.patch("uuid.uuid4", return_value="id")
+    def test_submit(self, mock_uuid_uuid4):
+        self.session.request.return_value = http_response([])
+
+        self.assertEqual("id", self.client.submit("ping", ["a"]))
+        self.session.request.assert_called_once_with(
+            "POST", "http://master/ping", params={"timeout": 0},
+            data={"target": '["a"]', "req": '"id"'})
+
+    @mock.patch("time.time")
+    def test_iter_responses(self, mock_time_time):
+        mock_time_time.side_effect = [10.0, 10.0, 10.1, 10.2, 10.3]
+        self.client.poll = mock.Mock(side_effect=[
+            [{"agent": "a"}], [], [{"agent": "b"}]])
+
+        retval = list(self.client.iter_responses("id", 250, 3))
+
+        self.assertEqual([{"agent": "a"}, {"agent": "b"}], retval)
+        self.assertEqual(
+            [mock.call("id", 100, 3), mock.call("id", 100, 2),
+             mock.call("id", mock.ANY, 2)],
+            self.client.poll.mock_calls)
+        self.assertAlmostEqual(50, self.client.poll.call_args[0][1])
+
+    def test_iter_responses_enough(self):
+        self.client.poll = mock.Mock(return_value=[{"agent": "a"}])
+
+        retval = list(self.client.iter_responses("id", 1000, 1))
+
+        self.assertEqual([{"agent": "a"}], retval)
+        self.client.poll.assert_called_once_with("id", 100, 1)
+
+    def test_stream(self):
+        self.client.submit = mock.Mock(return_value="id")
+        self.client.iter_responses = mock.Mock()
+
+        retval = self.client.stream("ping", ["a", "b"], timeout=500, x=1)
+
+        self.assertEqual(self.client.iter_responses.return_value, retval)
+        self.client.submit.assert_called_once_with("ping", ["a", "b"], x=1)
+        self.client.iter_responses.assert_called_once_with("id", 500, 2)
+
+    def test_batch(self):
+        self.client.submit = mock.Mock(side_effect=["id1", "id2"])
+        self.client.collect = mock.Mock(side_effect=[["r1"], ["r2"]])
+
+        retval = self.client.batch(
+            [("ping", {"targets": ["a"]}), ("check", {})])
+
+        self.assertEqual([["r1"], ["r2"]], retval)
+        self.assertEqual(
+            [mock.call("ping", targets=["a"]), mock.call("check")],
+            self.client.submit.mock_calls)
+        self.assertEqual(
+            [mock.call("id1", mock.ANY, 1), mock.call("id2", mock.ANY, None)],
+            self.client.collect.mock_calls)
+
+    @ddt.data(
+        ("echo hi", ["sh", "-c", "echo hi"]),
+        (["echo", "hi"], ["echo", "hi"]),
+    )
+    @ddt.unpack
+    def test_run_and_wait(self, command, path):
+        self.client.command = mock.Mock(return_value=[
+            {"agent": "a", "exit_code": 0}, {"agent": "b", "exit_code": 1}])
+
+        retval = self.client.run_and_wait(command, iter(["a", "b"]))
+
+        self.assertEqual({"a": {"agent": "a", "exit_code": 0},
+                          "b": {"agent": "b", "exit_code": 1}}, retval)
+        self.client.command.assert_called_once_with(
+            path, ["a", "b"], timeout=10000, agents=2)
+
+    def test_run_and_wait_script(self):
+        digest = client.script_hash("script")
+        self.client.request = mock.Mock(side_effect=[
+            [{"agent": "a", "stdout": "1"}],
+            [{"agent": "a", "stdout": "2"}],
+            [{"agent": "a", "cache_miss": digest}],
+            [{"agent": "a", "stdout": "3"}],
+        ])
+
+        for i in range(3):
+            retval = self.client.run_and_wait(
+                script="script", args=["x"], timeout=5)
+        self.assertEqual({"a": {"agent": "a", "stdout": "3"}}, retval)
+
+        fields = {"args": ["x"], "timeout": 5}
+        self.assertEqual(
+            [
+                mock.call("run_cached", None, script="script", **fields),
+                mock.call("run_cached", None, hash=digest, **fields),
+                mock.call("run_cached", None, hash=digest, **fields),
+                mock.call("run_cached", None, script="script", **fields),
+            ],
+            self.client.request.mock_calls)
+
+
+class AsyncClientTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AsyncClientTestCase, self).setUp()
+        self.client = client.AsyncClient("http://master",
+                                         session=mock.Mock())
+        self.addCleanup(self.client.close)
+
+    def test_call(self):
+        self.client.client.ping = mock.Mock(return_value=[{"agent": "a"}])
+
+        retval = asyncio.run(self.client.ping(["a"], timeout=10))
+
+        self.assertEqual([{"agent": "a"}], retval)
+        self.client.client.ping.assert_called_once_with(["a"], timeout=10)
+
+    def test_unknown_attribute(self):
+        self.assertRaises(AttributeError, getattr, self.client, "close_all")
+
+    def test_gather(self):
+        self.client.client.ping = mock.Mock(return_value=["pong"])
+        self.client.client.agents = mock.Mock(return_value={"a": {}})
+
+        retval = asyncio.run(self.client.gather(
+            [("ping", (["a"],), {}), ("agents", (), {"selector": "x"})]))
+
+        self.assertEqual([["pong"], {"a": {}}], retval)
+        self.client.client.agents.assert_called_once_with(selector="x")
+
+    def test_stream(self):
+        self.client.client.stream = mock.Mock(
+            return_value=iter([{"agent": "a"}, {"agent": "b"}]))
+
+        async def collect():
+            return [resp async for resp in self.client.stream("ping")]
+
+        self.assertEqual([{"agent": "a"}, {"agent": "b"}],
+                         asyncio.run(collect()))
+        self.client.client.stream.assert_called_once_with(
+            "ping", None, 1000, None)
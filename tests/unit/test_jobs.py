@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+import ddt
+import mock
+import unittest
+
+import jobs
+
+
+@ddt.ddt
+class JobTestCase(unittest.TestCase):
+    def get_job(self, tasks=3, agents=("a", "b"), **kwargs):
+        return jobs.Job([{"path": ["task", str(i)]} for i in range(tasks)],
+                        list(agents), job_id="j", **kwargs)
+
+    @ddt.data(
+        ([], ["a"], "A job needs tasks."),
+        ([{"path": ["x"]}], [], "A job needs a target list or agents known "
+                                "to match the selector."),
+        (["x"], ["a"], "Tasks must be objects of request fields."),
+    )
+    @ddt.unpack
+    def test___init___invalid(self, tasks, agents, message):
+        with self.assertRaises(ValueError) as context:
+            jobs.Job(tasks, agents)
+        self.assertEqual(message, str(context.exception))
+
+    def test___init___spec(self):
+        job = jobs.Job([{"path": ["x"], "env": ["A=1=2"], "thread": True,
+                         "target": ["z"], "req": "r"}], ["a"])
+
+        self.assertEqual({"path": ["x"], "env": {"A": "1=2"}},
+                         job.tasks[0]["spec"])
+
+    def test_dispatch_and_receive(self):
+        job = self.get_job()
+
+        self.assertEqual(
+            [("j-0-1", {"path": ["task", "0"], "action": "command",
+                        "target": ["a"]}),
+             ("j-1-1", {"path": ["task", "1"], "action": "command",
+                        "target": ["b"]})],
+            job.dispatch())
+        self.assertEqual([], job.dispatch())
+
+        job.receive("j-1-1", {"agent": "b", "in_progress": True})
+        job.receive("j-1-1", {"agent": "b", "exit_code": 0})
+        job.receive("j-1-1", {"agent": "b", "exit_code": 0})
+        job.receive("other", {"agent": "b", "exit_code": 0})
+
+        self.assertEqual(
+            [("j-2-1", {"path": ["task", "2"], "action": "command",
+                        "target": ["b"]})],
+            job.dispatch())
+        self.assertEqual({"running": 2, "done": 1},
+                         job.progress()["counts"])
+        self.assertEqual({"b": 1}, job.progress()["completed_by"])
+
+    def test_retries(self):
+        job = self.get_job(tasks=1, agents=["a"], retries=1)
+
+        for attempt in (1, 2):
+            [(req_id, _)] = job.dispatch()
+            self.assertEqual("j-0-%d" % attempt, req_id)
+            job.receive(req_id, {"agent": "a", "exit_code": 1})
+        job.check_finished()
+
+        self.assertEqual([], job.dispatch())
+        self.assertEqual("failed", job.tasks[0]["state"])
+        self.assertEqual(2, job.tasks[0]["attempts"])
+        self.assertFalse(job.is_active())
+
+    @mock.patch("jobs.monotonic")
+    def test_expire(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        job = self.get_job(tasks=1, agents=["a", "b"], task_timeout=500)
+        job.dispatch()
+
+        mock_monotonic.return_value = 100.6
+        job.expire()
+
+        [(req_id, req)] = job.dispatch()
+        self.assertEqual(("j-0-2", ["b"]), (req_id, req["target"]))
+        self.assertEqual("Task timed out.", job.tasks[0]["result"]["error"])
+        # The late answer brings the agent back, but does not count.
+        job.receive("j-0-1", {"agent": "a", "exit_code": 0})
+        self.assertEqual(["a"], list(job.idle))
+        self.assertEqual("running", job.tasks[0]["state"])
+
+    @mock.patch("jobs.monotonic")
+    def test_no_agents_left(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        job = self.get_job(tasks=2, agents=["a"], task_timeout=500)
+        job.dispatch()
+
+        mock_monotonic.return_value = 101.0
+        job.expire()
+        job.check_finished()
+
+        self.assertFalse(job.is_active())
+        self.assertEqual({"failed": 2}, job.progress()["counts"])
+        self.assertEqual("No agents left.", job.tasks[1]["result"]["error"])
+
+    def test_cancel(self):
+        job = self.get_job()
+        job.dispatch()
+
+        job.cancel()
+        job.receive("j-0-1", {"agent": "a", "exit_code": 0})
+
+        self.assertEqual({"cancelled": 3}, job.progress()["counts"])
+        self.assertEqual("finished", job.progress()["state"])
+
+    @ddt.data(
+        ({}, [0, 1, 2, 3, 4], None),
+        ({"limit": "2"}, [0, 1], 1),
+        ({"limit": "2", "cursor": "1"}, [2, 3], 3),
+        ({"state": "running"}, [0, 1], None),
+        ({"state": "pending", "limit": 2}, [2, 3], 3),
+    )
+    @ddt.unpack
+    def test_results(self, params, tasks, next_cursor):
+        job = self.get_job(tasks=5)
+        job.dispatch()
+
+        page = job.results(**params)
+
+        self.assertEqual(tasks, [result["task"] for result in
+                                 page["results"]])
+        self.assertEqual(next_cursor, page["next"])
+
+    @ddt.data("0", "1001", "x")
+    def test_results_invalid_limit(self, limit):
+        self.assertRaises(ValueError, self.get_job().results, limit=limit)
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def test_pump(self):
+        job_queue = jobs.JobQueue()
+        job = job_queue.submit(jobs.Job([{"path": ["x"]}, {"path": ["y"]}],
+                                        ["a"], job_id="j"))
+        published = []
+        responses = {"j-0-1": [{"agent": "a", "exit_code": 0}]}
+
+        def publish(req_id, req):
+            published.append(req_id)
+
+        job_queue.pump(publish, lambda req_id: [])
+        job_queue.pump(publish, lambda req_id: responses.pop(req_id, []))
+        self.assertTrue(job_queue.is_active())
+        job_queue.pump(publish, lambda req_id: [{"agent": "a"}])
+
+        self.assertEqual(["j-0-1", "j-1-1"], published)
+        self.assertFalse(job_queue.is_active())
+        self.assertIs(job, job_queue.get("j"))
+        self.assertRaises(KeyError, job_queue.get, "k")
+
+    @mock.patch("jobs.monotonic")
+    def test_pump_dead_agent(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        job_queue = jobs.JobQueue()
+        job = job_queue.submit(jobs.Job([{"path": ["x"]}, {"path": ["y"]}],
+                                        ["alive", "dead"], job_id="j"))
+        published = []
+        targets = {}
+
+        def publish(req_id, req):
+            published.append((req_id, req["target"]))
+            targets[req_id] = req["target"]
+
+        def collect(req_id):
+            # Only the agent still around answers.
+            if targets[req_id] == ["alive"]:
+                return [{"agent": "alive", "exit_code": 0}]
+            return []
+
+        for _ in range(20):
+            job_queue.pump(publish, collect)
+        self.assertTrue(job.is_active())
+
+        # Without a task timeout given, the default one still applies.
+        mock_monotonic.return_value = (
+            100.0 + jobs.Job.DEFAULT_TASK_TIMEOUT / 1000. + 1)
+        job_queue.pump(publish, collect)
+        job_queue.pump(publish, collect)
+
+        self.assertEqual(
+            [("j-0-1", ["alive"]), ("j-1-1", ["dead"]),
+             ("j-1-2", ["alive"])],
+            published)
+        self.assertFalse(job.is_active())
+        self.assertEqual({"done": 2}, job.progress()["counts"])
+
+    @mock.patch.object(jobs.JobQueue, "MAX_FINISHED", 1)
+    def test_submit_drops_finished(self):
+        job_queue = jobs.JobQueue()
+        for job_id in ("j1", "j2", "j3"):
+            job = job_queue.submit(jobs.Job([{}], ["a"], job_id=job_id))
+            job.cancel()
+
+        self.assertEqual(["j2", "j3"], list(job_queue.jobs))
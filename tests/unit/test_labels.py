@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import ddt
+import unittest
+
+import labels
+
+
+@ddt.ddt
+class ModuleTestCase(unittest.TestCase):
+    @ddt.unpack
+    @ddt.data(
+        {"text": "rack=a7", "expected": ("rack", "a7")},
+        {"text": " role = db ", "expected": ("role", "db")},
+        {"text": "empty=", "expected": ("empty", "")},
+        {"text": "url=a=b", "expected": ("url", "a=b")},
+    )
+    def test_parse_label(self, text, expected):
+        self.assertEqual(expected, labels.parse_label(text))
+
+    @ddt.data("rack", "=a7", "ra ck=a7")
+    def test_parse_label_invalid(self, text):
+        self.assertRaises(ValueError, labels.parse_label, text)
+
+
+@ddt.ddt
+class SelectorTestCase(unittest.TestCase):
+    def test___init__(self):
+        selector = labels.Selector(
+            "role=db, rack in (a7, a8),env!=prod,!spare,zone,x notin (1)")
+
+        self.assertEqual(
+            [
+                ("=", "role", "db"),
+                ("in", "rack", set(["a7", "a8"])),
+                ("!=", "env", "prod"),
+                ("absent", "spare", None),
+                ("exists", "zone", None),
+                ("notin", "x", set(["1"])),
+            ],
+            selector.terms)
+
+    @ddt.data("", " , ", "rack in a7", "a b", "=a7", "rack in (a7")
+    def test___init___invalid(self, text):
+        self.assertRaises(ValueError, labels.Selector, text)
+
+    @ddt.unpack
+    @ddt.data(
+        {"selector": "role=db", "labels_": {"role": "db"}, "expected": True},
+        {"selector": "role==db", "labels_": {"role": "web"},
+         "expected": False},
+        {"selector": "role!=db", "labels_": {}, "expected": True},
+        {"selector": "rack in (a7,a8)", "labels_": {"rack": "a8"},
+         "expected": True},
+        {"selector": "rack in (a7,a8)", "labels_": {}, "expected": False},
+        {"selector": "rack notin (a7)", "labels_": {"rack": "a8"},
+         "expected": True},
+        {"selector": "spare", "labels_": {"spare": ""}, "expected": True},
+        {"selector": "!spare", "labels_": {"spare": ""}, "expected": False},
+        {"selector": "role=db,rack in (a7,a8)",
+         "labels_": {"role": "db", "rack": "a9"}, "expected": False},
+    )
+    def test_matches(self, selector, labels_, expected):
+        self.assertEqual(expected,
+                         labels.Selector(selector).matches(labels_))
@@ -1,12 +1,19 @@
 
 #!/usr/bin/python
 
+import base64
 import ddt
+import hashlib
 import itertools
 import mock
 import datetime
+import os
+import shutil
+import six
+import tempfile
 import unittest
 
+import labels
 import masteragent
 
 class MyDict(dict):
@@ -42,6 +49,248 @@ class AgentsRequestTestCase(unittest.TestCase):
             "42", pull_socket, config="foobar")
 
 
+    def get_wave_request(self, config, responses):
+        request = masteragent.AgentsRequest(
+            {"action": "command", "target": ["a", "b", "c", "d", "e"]},
+            dict(config, expected=["a", "b", "c", "d", "e"], timeout=5000,
+                 agents=5, missed_queue="missed"),
+            req_id="42")
+        request.recv_responses = mock.Mock(side_effect=responses)
+        return request
+
+    def test_send_waves(self):
+        request = self.get_wave_request({"wave": "40%"}, [
+            [{"agent": "a"}, {"agent": "b", "exit_code": 1}],
+            [{"agent": "c"}],
+            [{"agent": "e"}, {"agent": "a"}],
+        ])
+        publish_socket = mock.Mock()
+
+        retval = request(publish_socket, "pull")
+
+        self.assertEqual(
+            [{"agent": "a"}, {"agent": "b", "exit_code": 1},
+             {"agent": "c"}, {"agent": "e"},
+             {"agent": "d", "error": mock.ANY}],
+            retval)
+        self.assertEqual(
+            [["a", "b"], ["c", "d"], ["e"]],
+            [call[1][0]["target"] for call in
+             publish_socket.send_json.mock_calls])
+        self.assertEqual(
+            [mock.call("42", "pull", timeout=5000.0, agents=agents,
+                       missed_queue="missed")
+             for agents in (2, 2, 2)],
+            request.recv_responses.mock_calls)
+
+    @mock.patch("time.sleep")
+    @mock.patch("masteragent.datetime_now")
+    def test_send_waves_interval(self, mock_datetime_now, mock_time_sleep):
+        mock_datetime_now.side_effect = [
+            datetime.datetime(2000, 1, 1),
+            datetime.datetime(2000, 1, 1, 0, 0, 0, 30000),
+            datetime.datetime(2000, 1, 1, 0, 0, 1)]
+        request = self.get_wave_request(
+            {"wave": "3", "wave_interval": "100", "abort_errors": "0"},
+            [[{"agent": "a"}], [{"agent": "b"}]])
+
+        retval = request(mock.Mock(), "pull")
+
+        self.assertEqual(
+            [{"agent": "a"}, {"agent": "b"}, {"agent": "c", "error": mock.ANY},
+             {"agent": "d", "error": mock.ANY},
+             {"agent": "e", "error": mock.ANY}],
+            retval)
+        self.assertEqual(
+            [mock.call("42", "pull", timeout=100.0, agents=3,
+                       missed_queue="missed"),
+             mock.call("42", "pull", timeout=5000.0, agents=4,
+                       missed_queue="missed")],
+            request.recv_responses.mock_calls)
+        # The first wave answered after 30ms, the second one still waits
+        # out the rest of the interval.
+        self.assertEqual(1, len(mock_time_sleep.mock_calls))
+        self.assertAlmostEqual(0.07, mock_time_sleep.call_args[0][0])
+
+    @ddt.data(
+        ("0", 1),
+        ("1", 2),
+        ("50%", 3),
+        ("25%", 1),
+    )
+    @ddt.unpack
+    def test_send_waves_abort(self, abort_errors, sent_waves):
+        request = self.get_wave_request(
+            {"wave": "2", "abort_errors": abort_errors}, [
+                [{"agent": "a", "error": "boom"}, {"agent": "b"}],
+                [{"agent": "c", "exit_code": 2}, {"agent": "d"}],
+                [{"agent": "e"}],
+            ])
+        publish_socket = mock.Mock()
+
+        retval = request(publish_socket, "pull")
+
+        self.assertEqual(sent_waves, len(publish_socket.send_json.mock_calls))
+        skipped = [resp["agent"] for resp in retval if resp.get("skipped")]
+        self.assertEqual(["c", "d", "e"][(sent_waves - 1) * 2:], skipped)
+        self.assertEqual(5, len(retval))
+
+    @ddt.data("0", "-10%", "x")
+    def test_send_waves_invalid(self, wave):
+        request = self.get_wave_request({"wave": wave}, [])
+        publish_socket = mock.Mock()
+
+        self.assertRaises(ValueError, request, publish_socket, "pull")
+        self.assertFalse(publish_socket.send_json.called)
+
+    @mock.patch("masteragent.datetime_now")
+    def test___call___reliable(self, mock_datetime_now):
+        mock_datetime_now.return_value = datetime.datetime(2000, 1, 1)
+        replay = masteragent.ReplayBuffer(mock.Mock(),
+                                          masteragent.ClockEstimates())
+        request = masteragent.AgentsRequest(
+            req={"foo": "bar"},
+            config={"replay": replay, "expected": ["a", "b", "c"],
+                    "timeout": 5000},
+            req_id="42")
+
+        def recv_responses(req_id, pull_socket, timeout, agents, replay):
+            calls = request.recv_responses.call_count
+            if calls == 1:
+                replay.receive({"agents": ["b"], "ack_seq": 0})
+                return [{"agent": "a"}]
+            return [{"agent": "c"}] if calls == 2 else []
+
+        request.recv_responses = mock.Mock(side_effect=recv_responses)
+        publish_socket = replay.publish_socket
+
+        retval = request(publish_socket, None)
+
+        self.assertEqual([{"agent": "a"}, {"agent": "c"}], retval)
+        self.assertEqual(
+            [
+                mock.call({"foo": "bar", "req": "42", "seq": 0}),
+                mock.call({"foo": "bar", "req": "42", "seq": 0,
+                           "replay_to": ["c"]}),
+            ],
+            publish_socket.send_json.mock_calls)
+        # Nothing is missing after the retransmit, the rest of the
+        # timeout is waited out at once.
+        self.assertEqual(
+            [
+                mock.call("42", None, timeout=replay.DEFAULT_INTERVAL,
+                          agents=float("inf"), replay=replay),
+                mock.call("42", None, timeout=replay.DEFAULT_INTERVAL * 2,
+                          agents=float("inf"), replay=replay),
+                mock.call("42", None, timeout=5000, agents=float("inf"),
+                          replay=replay),
+            ],
+            request.recv_responses.mock_calls)
+
+    @mock.patch("masteragent.datetime_now")
+    def test___call___reliable_enough(self, mock_datetime_now):
+        mock_datetime_now.return_value = datetime.datetime(2000, 1, 1)
+        replay = masteragent.ReplayBuffer(mock.Mock(),
+                                          masteragent.ClockEstimates())
+        request = masteragent.AgentsRequest(
+            req={}, config={"replay": replay, "expected": ["a", "b"],
+                            "agents": 1},
+            req_id="42")
+        request.recv_responses = mock.Mock(return_value=[{"agent": "a"}])
+
+        retval = request(replay.publish_socket, None)
+
+        self.assertEqual([{"agent": "a"}], retval)
+        request.recv_responses.assert_called_once_with(
+            "42", None, timeout=replay.DEFAULT_INTERVAL, agents=1.0,
+            replay=replay)
+        replay.publish_socket.send_json.assert_called_once_with(
+            {"req": "42", "seq": 0})
+
+    def test___call___quorum(self):
+        request = masteragent.AgentsRequest(
+            req={}, config={"expected": ["a", "b", "c", "d"],
+                            "quorum": "50"},
+            req_id="42")
+        request.recv_responses = mock.Mock(
+            return_value=[{"agent": "b"}, {"agent": "x"}])
+
+        retval = request(mock.Mock(), None)
+
+        request.recv_responses.assert_called_once_with(
+            "42", None, timeout=mock.ANY, agents=2)
+        self.assertEqual(
+            [{"agent": "b"}, {"agent": "x"},
+             {"agent": "a", "straggler": True, "error": mock.ANY},
+             {"agent": "c", "straggler": True, "error": mock.ANY},
+             {"agent": "d", "straggler": True, "error": mock.ANY}],
+            retval)
+
+    @mock.patch("masteragent.datetime_now")
+    def test___call___straggler_factor(self, mock_datetime_now):
+        now = [0.0]
+        mock_datetime_now.side_effect = (
+            lambda: datetime.datetime.utcfromtimestamp(now[0]))
+        latencies = masteragent.LatencyHistory()
+        for agent_id in "abc":
+            latencies.update("command", 0, {agent_id: 0.1})
+            for i in range(latencies.MIN_SAMPLES):
+                latencies.update("command", 0, {agent_id: 0.01})
+        request = masteragent.AgentsRequest(
+            req={"action": "command"},
+            config={"expected": ["a", "b", "c"], "straggler_factor": "2",
+                    "timeout": 5000, "latencies": latencies},
+            req_id="42")
+
+        def recv_responses(req_id, pull_socket, timeout, agents,
+                           recv_times):
+            if request.recv_responses.call_count == 1:
+                now[0] += 0.05
+                return [{"agent": "a"}, {"agent": "c"}]
+            now[0] += timeout / 1000.
+            return []
+
+        request.recv_responses = mock.Mock(side_effect=recv_responses)
+
+        retval = request(mock.Mock(), None)
+
+        self.assertEqual(
+            [{"agent": "a"}, {"agent": "c"},
+             {"agent": "b", "straggler": True, "error": mock.ANY}],
+            retval)
+        self.assertEqual(
+            [200, 150],
+            [round(call[2]["timeout"])
+             for call in request.recv_responses.mock_calls])
+
+    def test___call___straggler_factor_all_answered(self):
+        request = masteragent.AgentsRequest(
+            req={}, config={"expected": ["a"], "straggler_factor": "2",
+                            "latencies": masteragent.LatencyHistory()},
+            req_id="42")
+        request.recv_responses = mock.Mock(return_value=[{"agent": "a"}])
+
+        self.assertEqual([{"agent": "a"}], request(mock.Mock(), None))
+        request.recv_responses.assert_called_once_with(
+            "42", None, timeout=mock.ANY, agents=float("inf"),
+            recv_times={})
+
+    def test___init___req_id(self):
+        self.assertEqual("42", masteragent.AgentsRequest(
+            {"req": "42"}, {}).req_id)
+        self.assertEqual("43", masteragent.AgentsRequest(
+            {"req": "42"}, {}, req_id="43").req_id)
+
+    def test_publish(self):
+        request = masteragent.AgentsRequest(
+            req={"foo": "bar"}, config={}, req_id="42")
+        publish_socket = mock.Mock()
+
+        request.publish(publish_socket)
+
+        publish_socket.send_json.assert_called_once_with(
+            {"foo": "bar", "req": "42"})
+
     @mock.patch("masteragent.datetime_now")
     @ddt.data(
         annotated({
@@ -151,6 +400,22 @@ class AgentsRequestTestCase(unittest.TestCase):
             "expected_missed_queue": [1],
             "expected_queue": [0, 2]
         }, name="recv enough responses"),
+        annotated({
+            "req_id": "foobar",
+            "recv_json": [
+                {"agent": "a", "outbox_seq": 1},
+                {"agent": "a", "outbox_seq": 1},
+                {"agent": "a", "outbox_seq": 2, "req": "foo"},
+                {"agent": "a", "outbox_seq": 2, "req": "foo"},
+            ],
+            "poll": [
+                True, True, True, True, False
+            ],
+            "now": [10, 10.1, 10.2, 10.3, 10.4],
+            "outbox_acks": masteragent.OutboxAcks(),
+            "expected_missed_queue": [2],
+            "expected_queue": [0],
+        }, name="outbox duplicates dropped"),
     )
     def test_recv_responses(self, param, mock_masteragent_datetime_now):
         recv_json = param.pop("recv_json")
@@ -171,7 +436,11 @@ class AgentsRequestTestCase(unittest.TestCase):
         ]
 
         expected_missed_queue = {}
-        param.setdefault("missed_queue", {})
+        missed_queue = masteragent.MissedQueue()
+        for resps in param.pop("missed_queue", {}).values():
+            for resp in resps:
+                missed_queue.add(resp)
+        param["missed_queue"] = missed_queue
 
         emq = param.pop("expected_missed_queue", None)
         if emq is not None:
@@ -202,7 +471,358 @@ class AgentsRequestTestCase(unittest.TestCase):
                 masteragent.AgentsRequest.recv_responses,
                 **param)
 
-        self.assertEqual(expected_missed_queue, param["missed_queue"])
+        self.assertEqual(expected_missed_queue,
+                         dict(missed_queue.query()["missed"]))
+
+    @mock.patch("time.time", side_effect=[5.0, 5.5, 6.0])
+    def test_recv_responses_recv_times(self, mock_time_time):
+        pull_socket = mock.Mock(**{
+            "recv_json.side_effect": [
+                {"req": "foo", "agent": "a"}, {"req": "bar", "agent": "b"},
+                {"req": "foo", "agent": "c"}],
+            "poll.return_value": True,
+        })
+        recv_times = {}
+
+        masteragent.AgentsRequest.recv_responses(
+            "foo", pull_socket, agents=2, recv_times=recv_times)
+
+        self.assertEqual({"a": 5.0, "c": 6.0}, recv_times)
+
+
+@ddt.ddt
+class MissedQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MissedQueueTestCase, self).setUp()
+        self.missed_queue = masteragent.MissedQueue()
+        with mock.patch("time.time", side_effect=[10.0, 11.0, 12.0, 13.0]):
+            for req, agent in (("r1", "a"), ("r1", "b"), ("r2", "a"),
+                               ("r3", "b")):
+                self.missed_queue.add({"req": req, "agent": agent})
+
+    def get_pairs(self, page):
+        return [(resp["req"], resp["agent"])
+                for resps in page["missed"].values() for resp in resps]
+
+    @ddt.data(
+        ({}, [("r1", "a"), ("r1", "b"), ("r2", "a"), ("r3", "b")], None),
+        ({"req": "r1"}, [("r1", "a"), ("r1", "b")], None),
+        ({"agent": "a"}, [("r1", "a"), ("r2", "a")], None),
+        ({"req": "r1", "agent": "b"}, [("r1", "b")], None),
+        ({"limit": "2"}, [("r1", "a"), ("r1", "b")], 2),
+        ({"limit": "2", "cursor": "2"}, [("r2", "a"), ("r3", "b")], None),
+        ({"agent": "b", "limit": "1"}, [("r1", "b")], 2),
+        ({"min_age": "2.5"}, [("r1", "a"), ("r1", "b")], None),
+        ({"max_age": "2.5"}, [("r2", "a"), ("r3", "b")], None),
+        ({"req": "r9"}, [], None),
+    )
+    @ddt.unpack
+    @mock.patch("time.time", return_value=14.0)
+    def test_query(self, filters, pairs, next_cursor, mock_time_time):
+        page = self.missed_queue.query(**filters)
+
+        self.assertEqual(pairs, self.get_pairs(page))
+        self.assertEqual(next_cursor, page["next"])
+        self.assertEqual(4, page["total"])
+
+    @ddt.data("0", "10001", "x")
+    def test_query_invalid_limit(self, limit):
+        self.assertRaises(ValueError, self.missed_queue.query, limit=limit)
+
+    def test_query_delete(self):
+        page = self.missed_queue.query(agent="a", delete=True)
+
+        self.assertEqual([("r1", "a"), ("r2", "a")], self.get_pairs(page))
+        self.assertEqual(2, len(self.missed_queue))
+        self.assertEqual([("r1", "b"), ("r3", "b")],
+                         self.get_pairs(self.missed_queue.query()))
+        self.assertEqual([], self.missed_queue.pop("r2", []))
+        self.assertEqual([{"req": "r1", "agent": "b"}],
+                         self.missed_queue.pop("r1"))
+
+    def test_pop_compacts(self):
+        self.assertIsNone(self.missed_queue.pop("r9"))
+        self.assertEqual(2, len(self.missed_queue.pop("r1")))
+        self.assertEqual([1, 2, 3, 4], self.missed_queue.ids)
+
+        self.missed_queue.pop("r2")
+
+        self.assertEqual([4], self.missed_queue.ids)
+        self.assertEqual({"b": [4]}, dict(self.missed_queue.by_agent))
+        self.assertEqual({"r3": [4]}, dict(self.missed_queue.by_req))
+
+
+class ClockEstimatesTestCase(unittest.TestCase):
+    def test_update(self):
+        clocks = masteragent.ClockEstimates()
+        self.assertIsNone(clocks.get("a"))
+
+        # Agent clock is 5 seconds ahead, 10 ms each way.
+        estimate = clocks.update("a", 100.0, 105.01, 105.02, 100.03)
+        self.assertAlmostEqual(5.0, estimate["offset"])
+        self.assertAlmostEqual(0.02, estimate["rtt"])
+
+        # A sample with a slow way back is not trusted over it.
+        estimate = clocks.update("a", 200.0, 205.01, 205.02, 200.5)
+        self.assertAlmostEqual(5.0, estimate["offset"])
+        self.assertAlmostEqual(0.02, estimate["rtt"])
+
+    def test_update_samples_bounded(self):
+        clocks = masteragent.ClockEstimates()
+        clocks.update("a", 0.0, 1.0, 1.0, 0.0)
+        for i in range(clocks.SAMPLES):
+            clocks.update("a", 0.0, 2.0, 2.0, 0.5)
+
+        self.assertEqual(2.0 - 0.25, clocks.get("a")["offset"])
+
+
+class MembershipTestCase(unittest.TestCase):
+    def test_update_select(self):
+        membership = masteragent.Membership()
+
+        membership.update([
+            {"agent": "a", "recv_time": 1, "labels": {"role": "db"}},
+            {"agent": "b", "recv_time": 1},
+            {"agent": "c", "error": "foo"},
+        ])
+
+        self.assertEqual({"a": {"role": "db"}, "b": {}}, membership.agents)
+        self.assertEqual(["a", "b"], membership.select())
+        self.assertEqual(
+            ["a"], membership.select(labels.Selector("role=db")))
+
+    @mock.patch("time.time")
+    def test_expire(self, mock_time_time):
+        membership = masteragent.Membership(max_age=60)
+        mock_time_time.return_value = 1000.0
+        membership.update([{"agent": "a", "recv_time": 1},
+                           {"agent": "b", "recv_time": 1}])
+        mock_time_time.return_value = 1050.0
+        membership.update([{"agent": "b", "recv_time": 1}])
+
+        mock_time_time.return_value = 1070.0
+        self.assertEqual(["b"], membership.select())
+        self.assertEqual({"b": {}}, membership.agents)
+
+
+class LatencyHistoryTestCase(unittest.TestCase):
+    def test_get_percentile(self):
+        latencies = masteragent.LatencyHistory()
+        self.assertIsNone(latencies.get_percentile("ping", "a"))
+
+        for i in range(1, 201):
+            latencies.update("ping", 10.0, {"a": 10.0 + i / 1000.})
+
+        self.assertEqual(latencies.SAMPLES, len(latencies.samples[
+            ("ping", "a")]))
+        self.assertAlmostEqual(0.199, latencies.get_percentile("ping", "a"))
+        self.assertIsNone(latencies.get_percentile("command", "a"))
+
+    def test_get_deadline(self):
+        latencies = masteragent.LatencyHistory()
+        for i in range(latencies.MIN_SAMPLES):
+            latencies.update("ping", 0, {"a": 0.01, "b": 0.1})
+
+        self.assertEqual(latencies.MIN_DEADLINE,
+                         latencies.get_deadline("ping", ["a"], 2))
+        self.assertAlmostEqual(0.3,
+                               latencies.get_deadline("ping", ["a", "b"], 3))
+        self.assertIsNone(latencies.get_deadline("ping", ["a", "c"], 2))
+
+
+class ReplayBufferTestCase(unittest.TestCase):
+    def test_add_bounded(self):
+        replay = masteragent.ReplayBuffer(mock.Mock(), None, max_size=2)
+
+        for i in range(3):
+            req = {"req": str(i)}
+            self.assertEqual(i, replay.add(req))
+            self.assertEqual(i, req["seq"])
+
+        self.assertEqual([1, 2], list(replay.requests))
+        self.assertEqual([1, 2], sorted(replay.acks))
+        self.assertEqual(set(), replay.get_acked(0))
+
+    def test_receive(self):
+        publish_socket = mock.Mock()
+        replay = masteragent.ReplayBuffer(publish_socket, None)
+        replay.add({"req": "a", "target": "x,y"})
+        replay.add({"req": "b"})
+
+        self.assertFalse(replay.receive({"req": "a", "agent": "x"}))
+        self.assertTrue(replay.receive({"agents": ["x"], "ack_seq": 0}))
+        self.assertTrue(replay.receive({"agents": ["x"], "ack_seq": 9}))
+        self.assertTrue(replay.receive({"agents": ["z"], "nack": [0, 1, 2]}))
+        self.assertTrue(replay.receive({"agents": ["x", "z"],
+                                        "nack": [0]}))
+
+        self.assertEqual(set(["x"]), replay.get_acked(0))
+        self.assertEqual(
+            [
+                mock.call({"req": "b", "seq": 1, "replay_to": ["z"]}),
+                mock.call({"req": "a", "target": "x,y", "seq": 0,
+                           "replay_to": ["x"]}),
+            ],
+            publish_socket.send_json.mock_calls)
+
+    def test_get_interval(self):
+        clocks = masteragent.ClockEstimates()
+        replay = masteragent.ReplayBuffer(None, clocks)
+        self.assertEqual(replay.DEFAULT_INTERVAL, replay.get_interval(["a"]))
+
+        clocks.update("a", 0.0, 0.0, 0.0, 0.001)
+        self.assertEqual(replay.MIN_INTERVAL, replay.get_interval(["a"]))
+
+        clocks.update("b", 0.0, 0.0, 0.0, 0.05)
+        self.assertAlmostEqual(200, replay.get_interval(["a", "b", "c"]))
+
+
+class OutboxAcksTestCase(unittest.TestCase):
+    def test_receive(self):
+        acks = masteragent.OutboxAcks()
+
+        self.assertFalse(acks.receive({"req": "a", "agent": "x"}))
+        self.assertFalse(
+            acks.receive({"req": "a", "agent": "x", "outbox_seq": 1}))
+        self.assertTrue(
+            acks.receive({"req": "a", "agent": "x", "outbox_seq": 1}))
+        self.assertFalse(
+            acks.receive({"req": "b", "agent": "x", "outbox_seq": 1}))
+        self.assertFalse(
+            acks.receive({"req": "a", "agent": "y", "outbox_seq": 1}))
+
+        requests = acks.pop_requests()
+        self.assertEqual(
+            [("ack:x", {"x": [1, 1, 1]}, ["x"]),
+             ("ack:y", {"y": [1]}, ["y"])],
+            [(list(req)[0], req["acks"], req["target"]) for req in requests])
+        for req in requests:
+            self.assertEqual("outbox_ack", req["action"])
+            self.assertTrue(req["noreply"])
+        self.assertEqual([], acks.pop_requests())
+
+    def test_receive_seen_bounded(self):
+        acks = masteragent.OutboxAcks()
+        acks.MAX_SEEN = 2
+
+        for seq in range(3):
+            acks.receive({"req": "a", "agent": "x", "outbox_seq": seq})
+
+        self.assertFalse(
+            acks.receive({"req": "a", "agent": "x", "outbox_seq": 0}))
+
+
+class FileDistributionTestCase(unittest.TestCase):
+    DATA = b"0123456789abcdefghij"
+
+    def setUp(self):
+        super(FileDistributionTestCase, self).setUp()
+        fd, self.source = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(self.DATA)
+        self.distribution = masteragent.FileDistribution(self.source, 8)
+
+    def tearDown(self):
+        super(FileDistributionTestCase, self).tearDown()
+        os.unlink(self.source)
+
+    def test___init__(self):
+        self.assertEqual(20, self.distribution.size)
+        self.assertEqual(hashlib.sha256(self.DATA).hexdigest(),
+                         self.distribution.sha256)
+        self.assertEqual(
+            [hashlib.sha256(chunk).hexdigest()
+             for chunk in (self.DATA[:8], self.DATA[8:16], self.DATA[16:])],
+            self.distribution.chunk_hashes)
+
+    def test_get_status_request(self):
+        self.assertEqual(
+            {
+                "action": "file_status",
+                "file_id": self.distribution.file_id,
+                "dest": "/dest",
+                "size": 20,
+                "chunk_size": 8,
+                "sha256": self.distribution.sha256,
+            },
+            self.distribution.get_status_request("/dest"))
+
+    def test_get_chunk_request(self):
+        with open(self.source, "rb") as fh:
+            req = self.distribution.get_chunk_request(fh, 2)
+
+        self.assertEqual(
+            {
+                "action": "file_chunk",
+                "noreply": True,
+                "file_id": self.distribution.file_id,
+                "index": 2,
+                "sha256": self.distribution.chunk_hashes[2],
+                "data": base64.b64encode(b"ghij").decode("ascii"),
+            },
+            req)
+
+    def test_get_missing_chunks(self):
+        missing = masteragent.FileDistribution.get_missing_chunks([
+            {"agent": "a", "missing": [[0, 2], [4, 5]]},
+            {"agent": "b", "missing": [[1, 2]]},
+            {"agent": "c", "missing": []},
+            {"agent": "d", "error": "foo"},
+        ])
+
+        self.assertEqual(
+            {0: ["a"], 1: ["a", "b"], 4: ["a"]},
+            missing)
+
+
+class ScriptStoreTestCase(unittest.TestCase):
+    def test_put_get(self):
+        store = masteragent.ScriptStore()
+
+        digest = store.put("body")
+
+        self.assertEqual(masteragent.script_hash("body"), digest)
+        self.assertEqual("body", store.get(digest))
+        self.assertIsNone(store.get("unknown"))
+        self.assertEqual(4, store.size)
+
+    def test_put_evicts_least_recently_used(self):
+        store = masteragent.ScriptStore(max_size=10)
+        first = store.put("aaaa")
+        second = store.put("bbbb")
+        store.get(first)
+
+        third = store.put("cccc")
+
+        self.assertEqual([first, third], list(store.scripts))
+        self.assertIsNone(store.get(second))
+        self.assertEqual(8, store.size)
+
+    def test_put_keeps_newest(self):
+        store = masteragent.ScriptStore(max_size=2)
+
+        digest = store.put("too large")
+
+        self.assertEqual("too large", store.get(digest))
+
+
+class ModuleFunctionsTestCase(unittest.TestCase):
+    def test_summarize_usage(self):
+        summary = masteragent.summarize_usage([
+            {"usage": {"wall_time": 1.0, "max_rss_kb": 100}},
+            {"usage": {"wall_time": 3.0, "max_rss_kb": 300}},
+            {"usage": None},
+            {"error": "No executor."},
+        ])
+
+        self.assertEqual(
+            {
+                "wall_time": {"count": 2, "sum": 4.0, "min": 1.0,
+                              "max": 3.0, "mean": 2.0},
+                "max_rss_kb": {"count": 2, "sum": 400, "min": 100,
+                               "max": 300, "mean": 200.0},
+            },
+            summary)
 
 
 @ddt.ddt
@@ -260,22 +880,46 @@ class RequestHandlerTestCase(unittest.TestCase):
             {"a": "b", "c": "d", "e": "f", "g": "h"},
             config)
 
+    @ddt.data(
+        ("GET", {"foo": "bar"}, {}),
+        ("DELETE", {"foo": "bar", "agent": "a", "limit": "1"},
+         {"agent": "a", "limit": "1"}),
+    )
+    @ddt.unpack
     @mock.patch("masteragent.AgentsRequest.recv_responses")
-    def test_missed(self, mock_agents_request_recv_responses):
+    def test_missed(self, command, url, filters,
+                    mock_agents_request_recv_responses):
         req_handler = self.get_req_handler()
         req_handler.send_json_response = mock.Mock()
-        req_handler._get_request_from_url = mock.Mock(
-            return_value={"foo": "bar"})
-        req_handler.command = "DELETE"
+        req_handler._get_request_from_url = mock.Mock(return_value=url)
+        req_handler.command = command
         req_handler.server_vars.missed_queue = mock.Mock()
 
         req_handler.missed()
 
         mock_agents_request_recv_responses.assert_called_once_with(
-            None, "foo", req_handler.server_vars.missed_queue, foo="bar")
+            None, "foo", req_handler.server_vars.missed_queue,
+            outbox_acks=req_handler.server_vars.outbox_acks,
+            replay=req_handler.server_vars.replay, foo="bar")
+        req_handler.server_vars.missed_queue.query.assert_called_once_with(
+            delete=command == "DELETE", **filters)
         req_handler.send_json_response.assert_called_once_with(
-            {"missed": req_handler.server_vars.missed_queue})
-        req_handler.server_vars.missed_queue.clear.assert_called_once_with()
+            req_handler.server_vars.missed_queue.query.return_value)
+
+    @mock.patch("masteragent.AgentsRequest.recv_responses")
+    def test_missed_invalid(self, mock_agents_request_recv_responses):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+        req_handler._get_request_from_url = mock.Mock(
+            return_value={"limit": "0"})
+        req_handler.command = "DELETE"
+        req_handler.server_vars.missed_queue.add({"req": "r1", "agent": "a"})
+
+        req_handler.missed()
+
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+        self.assertEqual(1, len(req_handler.server_vars.missed_queue))
 
     def test_ping(self):
         req_handler = self.get_req_handler()
@@ -307,11 +951,36 @@ class RequestHandlerTestCase(unittest.TestCase):
         mock_agents_request_recv_responses.assert_called_once_with(
             config.get("req", "last_req_id"),
             req_handler.pull_socket, req_handler.server_vars.missed_queue,
-            foo="bar"
+            outbox_acks=req_handler.server_vars.outbox_acks,
+            replay=req_handler.server_vars.replay, foo="bar"
         )
         req_handler.send_json_response.assert_called_once_with(
             mock_agents_request_recv_responses.return_value)
 
+    @mock.patch("masteragent.summarize_usage")
+    @mock.patch("masteragent.AgentsRequest.recv_responses")
+    def test_poll_summary(self, mock_agents_request_recv_responses,
+                          mock_summarize_usage):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+        req_handler._get_request_from_url = mock.Mock(
+            return_value={"req": "abc", "summary": "usage"})
+
+        req_handler.poll()
+
+        mock_agents_request_recv_responses.assert_called_once_with(
+            "abc", req_handler.pull_socket,
+            req_handler.server_vars.missed_queue,
+            outbox_acks=req_handler.server_vars.outbox_acks,
+            replay=req_handler.server_vars.replay)
+        mock_summarize_usage.assert_called_once_with(
+            mock_agents_request_recv_responses.return_value)
+        req_handler.send_json_response.assert_called_once_with(
+            {
+                "responses": mock_agents_request_recv_responses.return_value,
+                "usage": mock_summarize_usage.return_value
+            })
+
     def test_route_ok(self):
         self.assertEqual(
             masteragent.RequestHandler.route,
@@ -330,7 +999,10 @@ class RequestHandlerTestCase(unittest.TestCase):
     @ddt.data(
         ("/here", "GET", False),
         ("/here", "POST", True),
-        ("/there", "POST", False)
+        ("/there", "POST", False),
+        ("/prefix/a/b", "GET", False),
+        ("/prefix", "GET", True),
+        ("/here/a", "GET", True),
     )
     def test_route(self, path, command, should_404):
         req_handler = self.get_req_handler()
@@ -339,7 +1011,8 @@ class RequestHandlerTestCase(unittest.TestCase):
         req_handler.send_response = mock.Mock()
         req_handler.end_headers = mock.Mock()
         req_handler.methods = {
-            "GET": {"/here": lambda x: "foobar"},
+            "GET": {"/here": lambda x: "foobar",
+                    "/prefix/": lambda x: "foobar"},
             "POST": {"/there": lambda x: "foobar"},
         }
 
@@ -352,6 +1025,8 @@ class RequestHandlerTestCase(unittest.TestCase):
 
     def test_do_POST(self):
         req_handler = self.get_req_handler()
+        req_handler.url = mock.Mock(path="/command")
+        req_handler.command = "POST"
         req_handler.send_request_to_agents = mock.Mock()
         req_handler._get_request_from_url = mock.Mock()
 
@@ -361,6 +1036,31 @@ class RequestHandlerTestCase(unittest.TestCase):
             req_handler._get_request_from_url.return_value
         )
 
+    def test_trace_http(self):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.tracer = mock.Mock()
+        req_handler.command = "POST"
+        req_handler.path = "/ping?timeout=10"
+        req_handler.headers = {"Content-Length": "14",
+                               "Content-Type": "application/json"}
+        req_handler.rfile = six.BytesIO(b"target=%22a%22")
+
+        req_handler.trace_http()
+
+        req_handler.server_vars.tracer.write.assert_called_once_with(
+            "http", {"method": "POST", "path": "/ping?timeout=10",
+                     "content_type": "application/json",
+                     "body": "target=%22a%22"})
+        self.assertEqual(b"target=%22a%22", req_handler.rfile.read())
+
+    def test_trace_http_off(self):
+        req_handler = self.get_req_handler()
+        req_handler.rfile = mock.Mock()
+
+        req_handler.trace_http()
+
+        self.assertFalse(req_handler.rfile.read.called)
+
     @ddt.unpack
     @ddt.data(
         ({"a": "b"}, {"a": "c"}, "", True),
@@ -385,16 +1085,477 @@ class RequestHandlerTestCase(unittest.TestCase):
 
         self.assertEqual(post, req)
 
+    def test__parse_request_selector(self):
+        req_handler = self.get_req_handler("/command")
+        req_handler._get_request_from_url = mock.Mock(return_value={})
+        req_handler._get_request_from_post = mock.Mock(
+            return_value={"selector": "rack in a7"})
+        req_handler.url = mock.Mock(path="/command")
+
+        self.assertRaises(ValueError, req_handler._parse_request)
+
+    @ddt.unpack
+    @ddt.data(
+        {"req": {"selector": "role=db"}, "config": {},
+         "expected": {"agents": 2}},
+        {"req": {"selector": "role=db"}, "config": {"agents": "5"},
+         "expected": {"agents": "5"}},
+        {"req": {"selector": "role=none"}, "config": {}, "expected": {}},
+        {"req": {}, "config": {}, "expected": {}},
+    )
+    @mock.patch("masteragent.AgentsRequest")
+    def test__request_agents(self, mock_agents_request, req, config,
+                             expected):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.membership.agents = {
+            "a": {"role": "db"}, "b": {"role": "db"}, "c": {}}
+
+        retval = req_handler._request_agents(req, config)
+
+        mock_agents_request.assert_called_once_with(
+            req, dict(expected,
+                      outbox_acks=req_handler.server_vars.outbox_acks,
+                      missed_queue=req_handler.server_vars.missed_queue,
+                      latencies=req_handler.server_vars.latencies))
+        self.assertEqual(mock_agents_request.return_value.req_id,
+                         req_handler.server_vars.last_req_id)
+        self.assertEqual(mock_agents_request.return_value.return_value,
+                         retval)
+
+    @ddt.unpack
+    @ddt.data(
+        {"req": {"target": "b,a,b"}, "expected": ["a", "b"]},
+        {"req": {"target": ["c"]}, "expected": ["c"]},
+        {"req": {"selector": "role=db"}, "expected": ["a", "b"]},
+        {"req": {}, "expected": ["a", "b", "c"]},
+    )
+    @mock.patch("masteragent.AgentsRequest")
+    def test__request_agents_reliable(self, mock_agents_request, req,
+                                      expected):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.replay = replay = mock.Mock()
+        req_handler.server_vars.membership.agents = {
+            "a": {"role": "db"}, "b": {"role": "db"}, "c": {}}
+
+        req_handler._request_agents(req, {})
+
+        config = mock_agents_request.call_args[0][1]
+        self.assertIs(replay, config["replay"])
+        self.assertEqual(expected, config["expected"])
+
+    @ddt.unpack
+    @ddt.data(
+        {"req": {"template": True, "selector": "role=db"},
+         "shards": ["a", "b"]},
+        {"req": {"template": True}, "shards": ["a", "b", "c"]},
+        {"req": {"template": True, "target": "c,a"}, "shards": ["a", "c"]},
+        {"req": {"template": True, "shards": ["x"]}, "shards": ["x"]},
+        {"req": {}, "shards": None},
+    )
+    @mock.patch("masteragent.AgentsRequest")
+    def test__request_agents_template(self, mock_agents_request, req,
+                                      shards):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.membership.agents = {
+            "a": {"role": "db"}, "b": {"role": "db"}, "c": {}}
+
+        req_handler._request_agents(req, {})
+
+        self.assertEqual(
+            shards, mock_agents_request.call_args[0][0].get("shards"))
+
+    def test_debug_profile_off(self):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.debug_profile()
+
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+
+    @ddt.data(
+        ({}, None, {"mode": "cprofile", "profile": "dump"}),
+        ({"seconds": "5"}, None, {"mode": "cprofile", "left": 5}),
+        ({"seconds": "0"}, ValueError("bad window"), None),
+    )
+    @ddt.unpack
+    def test_debug_profile(self, url, start_error, expected):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.profiler = profiler = mock.Mock()
+        profiler.start.side_effect = start_error
+        profiler.get_result.return_value = expected
+        req_handler._get_request_from_url = mock.Mock(return_value=url)
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.debug_profile()
+
+        if "seconds" in url:
+            profiler.start.assert_called_once_with(url["seconds"])
+        else:
+            self.assertFalse(profiler.start.called)
+        if start_error is None:
+            req_handler.send_json_response.assert_called_once_with(expected)
+        else:
+            req_handler.send_json_response.assert_called_once_with(
+                {"error": "bad window"}, status=400)
+
+    @ddt.data(
+        ({"agent": "a", "limit": "1"}, 200),
+        ({"since": "soon"}, 400),
+        ({"foo": "bar"}, 400),
+    )
+    @ddt.unpack
+    def test_debug_events(self, url, status):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.recorder = flight_recorder = (
+            masteragent.recorder.FlightRecorder())
+        flight_recorder.record("receive", "r1", "a", 10, 0.1)
+        flight_recorder.record("receive", "r1", "b", 10, 0.1)
+        req_handler._get_request_from_url = mock.Mock(return_value=url)
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.debug_events()
+
+        if status == 200:
+            req_handler.send_json_response.assert_called_once_with(
+                flight_recorder.dump(agent="a"))
+        else:
+            self.assertEqual(
+                400, req_handler.send_json_response.call_args[1]["status"])
+
+    def test_debug_events_off(self):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.debug_events()
+
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+
+    @ddt.data(
+        (None, 200),
+        (ValueError("Limit must be within (0, 1000]."), 400),
+        (TypeError("unexpected keyword argument 'foo'"), 400),
+    )
+    @ddt.unpack
+    def test_get_results(self, error, status):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.results = mock.Mock(
+            **{"query.side_effect": error})
+        req_handler._get_request_from_url = mock.Mock(
+            return_value={"agent": "a"})
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.get_results()
+
+        req_handler.server_vars.results.query.assert_called_once_with(
+            agent="a")
+        if status == 200:
+            req_handler.send_json_response.assert_called_once_with(
+                req_handler.server_vars.results.query.return_value)
+        else:
+            req_handler.send_json_response.assert_called_once_with(
+                {"error": str(error)}, status=400)
+
+    def test_get_results_off(self):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.get_results()
+
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+
+    def get_output_handler(self, path, headers=None):
+        req_handler = self.get_req_handler()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        req_handler.server_vars.spool = masteragent.spool.OutputSpool(
+            tmpdir, threshold=1)
+        req_handler.server_vars.spool.spill(
+            {"req": "r 1", "agent": "a", "stdout": "0123456789"})
+        req_handler.url = mock.Mock(path=path)
+        req_handler.headers = headers or {}
+        req_handler.connection = mock.Mock(spec=[])
+        req_handler.wfile = six.BytesIO()
+        req_handler.send_response = mock.Mock()
+        req_handler.send_header = mock.Mock()
+        req_handler.end_headers = mock.Mock()
+        return req_handler
+
+    @ddt.data(
+        ({}, 200, None, b"0123456789"),
+        ({"Range": "bytes=2-4"}, 206, "bytes 2-4/10", b"234"),
+        ({"Range": "bytes=-2"}, 206, "bytes 8-9/10", b"89"),
+        ({"Range": "bytes=10-"}, 416, "bytes */10", b""),
+    )
+    @ddt.unpack
+    def test_output(self, headers, status, content_range, body):
+        req_handler = self.get_output_handler("/output/r%201/a/stdout",
+                                              headers)
+
+        req_handler.output()
+
+        req_handler.send_response.assert_called_once_with(status)
+        headers = dict(call[1] for call in
+                       req_handler.send_header.mock_calls)
+        self.assertEqual(content_range, headers.get("Content-Range"))
+        if status != 416:
+            self.assertEqual(str(len(body)), headers["Content-Length"])
+        self.assertEqual(body, req_handler.wfile.getvalue())
+
+    def test_output_sendfile(self):
+        req_handler = self.get_output_handler(
+            "/output/r%201/a/stdout", {"Range": "bytes=3-"})
+        req_handler.connection = mock.Mock()
+
+        req_handler.output()
+
+        req_handler.connection.sendfile.assert_called_once_with(
+            mock.ANY, 3, 7)
+
+    @ddt.data(
+        "/output/r%201/a/stderr",
+        "/output/r%201/a",
+        "/output/r%201/a/stdout/x",
+        "/output/../a/stdout",
+    )
+    def test_output_missing(self, path):
+        req_handler = self.get_output_handler(path)
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.output()
+
+        req_handler.send_json_response.assert_called_once_with(
+            {"error": "No such output."}, status=404)
+
+    def test_output_off(self):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.output()
+
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+
+    def get_jobs_handler(self, command, path, url=None, post=None):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.membership.agents = {"a": {}, "b": {}}
+        req_handler.command = command
+        req_handler.url = mock.Mock(path=path)
+        req_handler._get_request_from_url = mock.Mock(
+            return_value=dict(url or {}))
+        req_handler._get_request_from_post = mock.Mock(
+            return_value=dict(post or {}))
+        req_handler.send_json_response = mock.Mock()
+        req_handler.pump_jobs = mock.Mock()
+        return req_handler
+
+    def test_jobs_submit(self):
+        req_handler = self.get_jobs_handler(
+            "POST", "/jobs", {"retries": "0"},
+            {"tasks": [{"path": ["x"]}], "target": ["b"]})
+
+        req_handler.jobs()
+
+        [job] = req_handler.server_vars.jobs.jobs.values()
+        self.assertEqual(["b"], job.agents)
+        self.assertEqual(0, job.retries)
+        req_handler.pump_jobs.assert_called_once_with()
+        req_handler.send_json_response.assert_called_once_with(
+            job.progress())
+
+    @ddt.data(
+        {},
+        {"tasks": [{"path": ["x"]}], "selector": "role=web"},
+        {"tasks": [{"path": ["x"]}], "retries": "x"},
+    )
+    def test_jobs_submit_invalid(self, post):
+        req_handler = self.get_jobs_handler("POST", "/jobs", post=post)
+
+        req_handler.jobs()
+
+        self.assertEqual({}, req_handler.server_vars.jobs.jobs)
+        self.assertEqual(
+            400, req_handler.send_json_response.call_args[1]["status"])
+
+    def test_jobs_list(self):
+        req_handler = self.get_jobs_handler("GET", "/jobs")
+        job = req_handler.server_vars.jobs.submit(
+            masteragent.jobs.Job([{}], ["a"]))
+
+        req_handler.jobs()
+
+        req_handler.send_json_response.assert_called_once_with(
+            {"jobs": [job.progress()]})
+
+    @ddt.data(
+        ("GET", "/jobs/j", {"wait": "100"}, 200),
+        ("GET", "/jobs/j/results", {"limit": "1"}, 200),
+        ("DELETE", "/jobs/j", {}, 200),
+        ("GET", "/jobs/k", {}, 404),
+        ("GET", "/jobs/j/other", {}, 404),
+        ("GET", "/jobs/j/results", {"limit": "0"}, 400),
+        ("GET", "/jobs/j", {"wait": "x"}, 400),
+    )
+    @ddt.unpack
+    def test_job(self, command, path, url, status):
+        req_handler = self.get_jobs_handler(command, path, url)
+        job = req_handler.server_vars.jobs.submit(
+            masteragent.jobs.Job([{}, {}], ["a"], job_id="j"))
+
+        req_handler.job()
+
+        if status != 200:
+            self.assertEqual(
+                status, req_handler.send_json_response.call_args[1]["status"])
+            return
+        if command == "DELETE":
+            self.assertFalse(job.is_active())
+            expected = job.progress()
+        elif path.endswith("/results"):
+            req_handler.pump_jobs.assert_called_once_with(0.0, job)
+            expected = job.results(limit=1)
+        else:
+            req_handler.pump_jobs.assert_called_once_with(100.0, job)
+            expected = job.progress()
+        req_handler.send_json_response.assert_called_once_with(expected)
+
+    @mock.patch("masteragent.AgentsRequest.recv_responses")
+    def test_pump_jobs(self, mock_recv_responses):
+        req_handler = self.get_req_handler()
+        req_handler.publish_socket = mock.Mock()
+        req_handler.pull_socket = mock.Mock(**{"poll.return_value": True})
+        missed_queue = req_handler.server_vars.missed_queue
+        job = req_handler.server_vars.jobs.submit(
+            masteragent.jobs.Job([{"path": ["x"]}], ["a"], job_id="j"))
+
+        def recv_responses(*args, **kwargs):
+            missed_queue.add({"req": "j-0-1", "agent": "a", "exit_code": 0})
+        mock_recv_responses.side_effect = recv_responses
+
+        req_handler.pump_jobs(5000, job)
+
+        req_handler.publish_socket.send_json.assert_called_once_with(
+            {"req": "j-0-1", "path": ["x"], "action": "command",
+             "target": ["a"]})
+        mock_recv_responses.assert_called_once_with(
+            None, req_handler.pull_socket, missed_queue, timeout=1,
+            outbox_acks=req_handler.server_vars.outbox_acks, replay=None)
+        self.assertFalse(job.is_active())
+        self.assertEqual(0, len(missed_queue))
+
+    def test_pump_jobs_no_wait(self):
+        req_handler = self.get_req_handler()
+        req_handler.pull_socket = mock.Mock()
+
+        req_handler.pump_jobs()
+
+        self.assertFalse(req_handler.pull_socket.poll.called)
+
+    @ddt.data(("/jobs", True), ("/command", False))
+    @ddt.unpack
+    def test_do_POST_registered(self, path, routed):
+        req_handler = self.get_req_handler()
+        req_handler.url = mock.Mock(path=path)
+        req_handler.command = "POST"
+        req_handler.route = mock.Mock()
+        req_handler.send_request_to_agents = mock.Mock()
+        req_handler._get_request_from_url = mock.Mock(return_value={})
+
+        req_handler.do_POST()
+
+        self.assertEqual(routed, req_handler.route.called)
+        self.assertEqual(not routed,
+                         req_handler.send_request_to_agents.called)
+
+    @ddt.data("GET", "DELETE")
+    @mock.patch("masteragent.profiling.counters")
+    def test_debug_counters(self, command, mock_counters):
+        req_handler = self.get_req_handler()
+        req_handler.command = command
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.debug_counters()
+
+        req_handler.send_json_response.assert_called_once_with(
+            {"counters": mock_counters.snapshot.return_value})
+        self.assertEqual(command == "DELETE", mock_counters.clear.called)
+
+    @mock.patch("masteragent.profiling.counters")
+    def test_send_request_to_agents_counters(self, mock_counters):
+        req_handler = self.get_req_handler()
+        req_handler.send_json_response = mock.Mock()
+        req_handler._request_agents = mock.Mock(return_value=[])
+        req_handler._request_ping = mock.Mock(return_value=[])
+
+        for action in ("ping", "foo"):
+            req_handler._parse_request = mock.Mock(
+                return_value={"action": action})
+            req_handler.send_request_to_agents({})
+
+        self.assertEqual(
+            [mock.call("_request_ping"), mock.call("_request_agents")],
+            mock_counters.timed.call_args_list)
+
+    @ddt.data(
+        ({"action": "command", "target": ["a"]}, 200),
+        ({"action": "command", "selector": "role=web"}, 400),
+    )
+    @ddt.unpack
+    @mock.patch("masteragent.AgentsRequest")
+    def test_send_request_to_agents_waves(self, req, status,
+                                          mock_agents_request):
+        req_handler = self.get_req_handler()
+        req_handler._parse_request = mock.Mock(return_value=req)
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.send_request_to_agents({"wave": "1"})
+
+        if status == 200:
+            self.assertEqual(
+                ["a"], mock_agents_request.call_args[0][1]["expected"])
+        else:
+            self.assertFalse(mock_agents_request.called)
+            self.assertEqual(
+                400, req_handler.send_json_response.call_args[1]["status"])
+
+    @ddt.data(None, "role=db", "bad selector")
+    def test_agents(self, selector):
+        req_handler = self.get_req_handler()
+        req_handler.server_vars.membership.agents = {
+            "a": {"role": "db"}, "b": {}}
+        req_handler._get_request_from_url = mock.Mock(
+            return_value={"selector": selector} if selector else {})
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.agents()
+
+        if selector is None:
+            req_handler.send_json_response.assert_called_once_with(
+                {"agents": {"a": {"role": "db"}, "b": {}}})
+        elif selector == "role=db":
+            req_handler.send_json_response.assert_called_once_with(
+                {"agents": {"a": {"role": "db"}}})
+        else:
+            self.assertEqual(
+                400, req_handler.send_json_response.call_args[1]["status"])
+
     @mock.patch("masteragent.AgentsRequest")
     def test_send_request_to_agents(self, mock_masteragent_agents_request):
         req_handler = self.get_req_handler()
-        req_handler._parse_request = mock.Mock()
+        req_handler._parse_request = mock.Mock(
+            return_value={"action": "command"})
         req_handler.send_json_response = mock.Mock()
 
         req_handler.send_request_to_agents({"foo": "bar"})
 
         mock_masteragent_agents_request.assert_called_once_with(
-            req_handler._parse_request.return_value, {"foo": "bar"})
+            req_handler._parse_request.return_value,
+            {"foo": "bar",
+             "outbox_acks": req_handler.server_vars.outbox_acks,
+             "missed_queue": req_handler.server_vars.missed_queue,
+             "latencies": req_handler.server_vars.latencies})
         self.assertEqual(
             mock_masteragent_agents_request.return_value.req_id,
             req_handler.server_vars.last_req_id)
@@ -403,6 +1564,293 @@ class RequestHandlerTestCase(unittest.TestCase):
         req_handler.send_json_response.assert_called_once_with(
             mock_masteragent_agents_request.return_value.return_value)
 
+    def test_send_request_to_agents_sender(self):
+        req_handler = self.get_req_handler()
+        req_handler._parse_request = mock.Mock(
+            return_value={"action": "run_cached"})
+        req_handler._request_run_cached = mock.Mock()
+        req_handler.send_json_response = mock.Mock()
+
+        req_handler.send_request_to_agents({"foo": "bar"})
+
+        req_handler._request_run_cached.assert_called_once_with(
+            {"action": "run_cached"}, {"foo": "bar"})
+        req_handler.send_json_response.assert_called_once_with(
+            req_handler._request_run_cached.return_value)
+
+    def test__request_put_script(self):
+        req_handler = self.get_req_handler()
+        req_handler._request_agents = mock.Mock()
+        req = {"action": "put_script", "script": "body"}
+
+        retval = req_handler._request_put_script(req, {})
+
+        self.assertEqual(
+            "body",
+            req_handler.server_vars.scripts.get(
+                masteragent.script_hash("body")))
+        req_handler._request_agents.assert_called_once_with(req, {})
+        self.assertEqual(req_handler._request_agents.return_value, retval)
+
+    def test__request_run_cached(self):
+        req_handler = self.get_req_handler()
+        digest = masteragent.script_hash("body")
+        responses = [
+            ("req-1", [{"agent": "a", "exit_code": 0},
+                       {"agent": "b", "cache_miss": digest},
+                       {"agent": "c", "cache_miss": digest}]),
+            ("req-2", [{"agent": "b", "exit_code": 0},
+                       {"agent": "c", "exit_code": 1}]),
+        ]
+
+        def request_agents(req, config):
+            req_id, resps = responses.pop(0)
+            req_handler.server_vars.last_req_id = req_id
+            return resps
+
+        req_handler._request_agents = mock.Mock(side_effect=request_agents)
+
+        retval = req_handler._request_run_cached(
+            {"action": "run_cached", "script": "body", "req": "mine"},
+            {"timeout": 10})
+
+        self.assertEqual(
+            [
+                mock.call({"action": "run_cached", "hash": digest,
+                           "req": "mine"},
+                          {"timeout": 10}),
+                mock.call({"action": "run_cached", "hash": digest,
+                           "script": "body", "target": ["b", "c"]},
+                          {"timeout": 10, "agents": 2}),
+            ],
+            req_handler._request_agents.mock_calls)
+        self.assertEqual(
+            [{"agent": "a", "exit_code": 0},
+             {"agent": "b", "exit_code": 0},
+             {"agent": "c", "exit_code": 1}],
+            retval)
+        self.assertEqual("req-1", req_handler.server_vars.last_req_id)
+
+    @mock.patch("masteragent.AgentsRequest")
+    def test__request_run_cached_template(self, mock_agents_request):
+        req_handler = self.get_req_handler()
+        mock_agents_request.return_value.side_effect = [
+            [{"agent": "a", "exit_code": 0},
+             {"agent": "b", "cache_miss": "abc"}],
+            [{"agent": "b", "exit_code": 0}],
+        ]
+
+        req_handler._request_run_cached(
+            {"action": "run_cached", "script": "body", "template": True,
+             "target": ["a", "b", "c"]}, {})
+
+        retry_req = mock_agents_request.call_args_list[1][0][0]
+        self.assertEqual(["b"], retry_req["target"])
+        self.assertEqual(["a", "b", "c"], retry_req["shards"])
+
+    @mock.patch.object(masteragent.AgentsRequest, "recv_responses")
+    def test__request_agents_template_waves(self, mock_recv_responses):
+        req_handler = self.get_req_handler()
+        req_handler.publish_socket = publish_socket = mock.Mock()
+        mock_recv_responses.side_effect = [[{"agent": "a"}, {"agent": "b"}],
+                                           [{"agent": "c"}]]
+
+        req_handler._request_agents(
+            {"action": "command", "template": True, "target": "c,b,a"},
+            {"wave": "2"})
+
+        self.assertEqual(
+            [(["a", "b"], ["a", "b", "c"]), (["c"], ["a", "b", "c"])],
+            [(call[1][0]["target"], call[1][0]["shards"])
+             for call in publish_socket.send_json.mock_calls])
+
+    def test__request_run_cached_unknown_hash(self):
+        req_handler = self.get_req_handler()
+        responses = [{"agent": "a", "cache_miss": "abc"}]
+        req_handler._request_agents = mock.Mock(return_value=responses)
+
+        retval = req_handler._request_run_cached(
+            {"action": "run_cached", "hash": "abc"}, {})
+
+        self.assertEqual(responses, retval)
+        req_handler._request_agents.assert_called_once_with(
+            {"action": "run_cached", "hash": "abc"}, {})
+
+    @mock.patch("masteragent.AgentsRequest")
+    @mock.patch("masteragent.FileDistribution")
+    def test__request_distribute(self, mock_file_distribution,
+                                 mock_agents_request):
+        req_handler = self.get_req_handler()
+        distribution = mock_file_distribution.return_value
+        distribution.get_status_request.return_value = {"status": "req"}
+        distribution.get_chunk_request.side_effect = (
+            lambda fh, index: {"chunk": index})
+        distribution.get_missing_chunks.side_effect = [
+            {0: ["a", "b"], 1: ["b"]},
+            {},
+        ]
+        req_handler._request_agents = mock.Mock(side_effect=[
+            [{"agent": "a", "missing": [[0, 1]]},
+             {"agent": "b", "missing": [[0, 2]]}],
+            [{"agent": "a", "missing": []},
+             {"agent": "b", "missing": []}],
+        ])
+
+        with mock.patch("masteragent.open", create=True) as mock_open:
+            retval = req_handler._request_distribute(
+                {"source": "/src", "dest": "/dest", "chunk_size": "8"},
+                {"timeout": 10})
+
+        mock_file_distribution.assert_called_once_with("/src", 8)
+        mock_open.assert_called_once_with(distribution.source, "rb")
+        distribution.get_status_request.assert_called_once_with("/dest")
+        self.assertEqual(
+            [mock.call({"status": "req"}, {"timeout": 10})] * 2,
+            req_handler._request_agents.mock_calls)
+        fh = mock_open.return_value.__enter__.return_value
+        self.assertEqual(
+            [mock.call(fh, 0), mock.call(fh, 1)],
+            distribution.get_chunk_request.mock_calls)
+        self.assertEqual(
+            [
+                mock.call({"chunk": 0}, {}),
+                mock.call().publish(req_handler.publish_socket),
+                mock.call({"chunk": 1, "target": ["b"]}, {}),
+                mock.call().publish(req_handler.publish_socket),
+            ],
+            mock_agents_request.mock_calls)
+        self.assertEqual(
+            [{"agent": "a", "missing": []}, {"agent": "b", "missing": []}],
+            retval)
+
+    get_missing_chunks = staticmethod(
+        masteragent.FileDistribution.get_missing_chunks)
+
+    def _mock_distribution(self, mock_file_distribution):
+        distribution = mock_file_distribution.return_value
+        distribution.chunk_hashes = ["h0", "h1"]
+        distribution.get_status_request.return_value = {"status": "req"}
+        distribution.get_chunk_request.side_effect = (
+            lambda fh, index: {"chunk": index})
+        distribution.get_missing_chunks.side_effect = (
+            self.get_missing_chunks)
+        return distribution
+
+    @mock.patch("masteragent.AgentsRequest")
+    @mock.patch("masteragent.FileDistribution")
+    def test__request_distribute_target_silent(self, mock_file_distribution,
+                                               mock_agents_request):
+        req_handler = self.get_req_handler()
+        self._mock_distribution(mock_file_distribution)
+        req_handler._request_agents = mock.Mock(side_effect=[
+            [{"agent": "a", "missing": []}],
+            [{"agent": "a", "missing": []},
+             {"agent": "b", "missing": []}],
+        ])
+
+        with mock.patch("masteragent.open", create=True):
+            retval = req_handler._request_distribute(
+                {"source": "/src", "dest": "/dest", "target": "a,b"},
+                {"timeout": 10})
+
+        self.assertEqual(
+            [mock.call({"status": "req", "target": "a,b"},
+                       {"timeout": 10})] * 2,
+            req_handler._request_agents.mock_calls)
+        self.assertEqual(
+            [
+                mock.call({"chunk": 0, "target": ["b"]}, {}),
+                mock.call().publish(req_handler.publish_socket),
+                mock.call({"chunk": 1, "target": ["b"]}, {}),
+                mock.call().publish(req_handler.publish_socket),
+            ],
+            mock_agents_request.mock_calls)
+        self.assertEqual(
+            [{"agent": "a", "missing": []}, {"agent": "b", "missing": []}],
+            retval)
+
+    @mock.patch("masteragent.AgentsRequest")
+    @mock.patch("masteragent.FileDistribution")
+    def test__request_distribute_silent(self, mock_file_distribution,
+                                        mock_agents_request):
+        req_handler = self.get_req_handler()
+        self._mock_distribution(mock_file_distribution)
+        req_handler._request_agents = mock.Mock(side_effect=[
+            [{"agent": "a", "missing": [[0, 1]]},
+             {"agent": "b", "missing": []}],
+            [{"agent": "a", "missing": []}],
+            [{"agent": "a", "missing": []}],
+        ])
+
+        with mock.patch("masteragent.open", create=True):
+            retval = req_handler._request_distribute(
+                {"source": "/src", "dest": "/dest", "rounds": "2"},
+                {"timeout": 10})
+
+        self.assertEqual(3, req_handler._request_agents.call_count)
+        self.assertEqual(
+            [
+                mock.call({"chunk": 0, "target": ["a"]}, {}),
+                mock.call().publish(req_handler.publish_socket),
+            ],
+            mock_agents_request.mock_calls)
+        self.assertEqual(
+            [{"agent": "a", "missing": []},
+             {"agent": "b", "error": "No file_status response."}],
+            retval)
+
+    @mock.patch("time.time", return_value=100.0)
+    @mock.patch("masteragent.AgentsRequest")
+    def test__request_ping(self, mock_agents_request, mock_time_time):
+        req_handler = self.get_req_handler()
+
+        def request_agents(req, config):
+            config["recv_times"]["a"] = 100.03
+            return [{"agent": "a", "recv_time": 105.01, "send_time": 105.02},
+                    {"agent": "b", "error": "foo"}]
+        req_handler._request_agents = mock.Mock(side_effect=request_agents)
+
+        retval = req_handler._request_ping({"action": "ping"}, {})
+
+        self.assertAlmostEqual(5.0, retval[0]["clock_offset"])
+        self.assertAlmostEqual(0.02, retval[0]["rtt"])
+        self.assertEqual({"agent": "b", "error": "foo"}, retval[1])
+        clock_req = mock_agents_request.call_args[0][0]
+        self.assertEqual(["a"], list(clock_req["offsets"]))
+        self.assertEqual("clock", clock_req["action"])
+        self.assertTrue(clock_req["noreply"])
+        mock_agents_request.return_value.publish.assert_called_once_with(
+            req_handler.publish_socket)
+
+    @mock.patch("time.time", return_value=100.0)
+    def test__request_command(self, mock_time_time):
+        req_handler = self.get_req_handler()
+        req_handler._request_agents = mock.Mock()
+
+        req_handler._request_command(
+            {"action": "command", "start_in": "500"}, {})
+
+        req_handler._request_agents.assert_called_once_with(
+            {"action": "command", "start_at": 100.5}, {})
+
+    def test_send_outbox_acks(self):
+        req_handler = self.get_req_handler()
+        req_handler.publish_socket = mock.Mock()
+
+        req_handler.send_outbox_acks()
+        self.assertFalse(req_handler.publish_socket.send_json.called)
+
+        req_handler.server_vars.outbox_acks.receive(
+            {"req": "a", "agent": "x", "outbox_seq": 1})
+        req_handler.server_vars.outbox_acks.receive(
+            {"req": "a", "agent": "y", "outbox_seq": 2})
+        req_handler.send_outbox_acks()
+
+        self.assertEqual(
+            [{"x": [1]}, {"y": [2]}],
+            [call[1][0]["acks"] for call in
+             req_handler.publish_socket.send_json.mock_calls])
+
     def test__get_request_from_post_empty(self):
         req_handler = self.get_req_handler()
         req_handler.headers = {}
@@ -457,17 +1905,16 @@ class ModuleTestCase(unittest.TestCase):
 
         self.assertEqual(
             [
+                # Shared zmq.Context()
+                mock.call(io_threads=1),
+
                 # PUB socket
-                # zmq.Context()
-                mock.call(),
                 # context.socket(zmq.PUB)
                 mock.call().socket(zmq.PUB),
                 # socket.bind
                 mock.call().socket().bind("publish_url"),
 
                 # PULL socket
-                # zmq.Context()
-                mock.call(),
                 # context.socket(zmq.PULL)
                 mock.call().socket(zmq.PULL),
                 # socket.bind
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import argparse
+import ddt
+import mock
+import time
+import unittest
+
+import profiling
+
+
+class CountersTestCase(unittest.TestCase):
+    @mock.patch("profiling.monotonic")
+    def test_timed(self, mock_monotonic):
+        mock_monotonic.side_effect = [10.0, 10.5, 20.0, 20.1]
+        counters = profiling.Counters()
+
+        with counters.timed("foo"):
+            pass
+        with self.assertRaises(ValueError):
+            with counters.timed("foo"):
+                raise ValueError()
+
+        snapshot = counters.snapshot()
+        self.assertEqual(["foo"], list(snapshot))
+        self.assertEqual(2, snapshot["foo"]["count"])
+        self.assertAlmostEqual(0.6, snapshot["foo"]["total"])
+        self.assertAlmostEqual(0.5, snapshot["foo"]["max"])
+        self.assertAlmostEqual(0.3, snapshot["foo"]["mean"])
+
+        counters.clear()
+        self.assertEqual({}, counters.snapshot())
+
+    @mock.patch("profiling.counters")
+    def test_timed_decorator(self, mock_counters):
+        @profiling.timed("bar")
+        def func(a, b=None):
+            return a, b
+
+        self.assertEqual((1, 2), func(1, b=2))
+        mock_counters.timed.assert_called_once_with("bar")
+        self.assertEqual("func", func.__name__)
+
+
+@ddt.ddt
+class ProfilerTestCase(unittest.TestCase):
+    def test___init__(self):
+        self.assertRaises(ValueError, profiling.Profiler, "perf")
+
+    @ddt.data(
+        (None, None),
+        ("sampling", "sampling"),
+    )
+    @ddt.unpack
+    def test_from_args(self, profile, mode):
+        parser = argparse.ArgumentParser()
+        profiling.Profiler.add_arguments(parser)
+        args = parser.parse_args(["--profile", profile] if profile else [])
+
+        profiler = profiling.Profiler.from_args(args)
+
+        self.assertEqual(mode, profiler and profiler.mode)
+
+    @ddt.data(0, -1, 601, "foo")
+    def test_start_invalid(self, seconds):
+        profiler = profiling.Profiler("cprofile")
+        self.assertRaises(ValueError, profiler.start, seconds)
+
+    def test_cprofile(self):
+        profiler = profiling.Profiler("cprofile")
+
+        profiler.start(0.05)
+        profiler.start(10)
+        sorted(range(1000))
+        self.assertIn("left", profiler.get_result())
+        time.sleep(0.05)
+        result = profiler.get_result()
+
+        self.assertEqual("cprofile", result["mode"])
+        self.assertIn("function calls", result["profile"])
+        self.assertIsNone(profiler.profile)
+
+    def test_sampling(self):
+        profiler = profiling.Profiler("sampling", sample_interval=0.001)
+
+        profiler.start(0.05)
+        while "left" in profiler.get_result():
+            time.sleep(0.01)
+        result = profiler.get_result()
+
+        self.assertEqual("sampling", result["mode"])
+        self.assertIn("test_profiling.py:test_sampling", result["profile"])
+        self.assertNotIn("_sample", result["profile"])
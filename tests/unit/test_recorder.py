@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+import json
+import mock
+import unittest
+
+import recorder
+
+
+class FlightRecorderTestCase(unittest.TestCase):
+    @mock.patch("time.time")
+    def test_dump(self, mock_time_time):
+        flight_recorder = recorder.FlightRecorder(size=3)
+        self.assertEqual({"recorded": 0, "dropped": 0, "events": []},
+                         flight_recorder.dump())
+
+        for i in range(4):
+            flight_recorder.record("receive", "r%d" % (i % 2), "a", i, 0.5)
+
+        dump = flight_recorder.dump()
+        self.assertEqual(4, dump["recorded"])
+        self.assertEqual(1, dump["dropped"])
+        self.assertEqual([1, 2, 3],
+                         [event["size"] for event in dump["events"]])
+        self.assertEqual(
+            {"time": mock_time_time.return_value, "event": "receive",
+             "req": "r1", "agent": "a", "size": 1, "codec_time": 0.5},
+            dump["events"][0])
+
+    @mock.patch("time.time")
+    def test_dump_filters(self, mock_time_time):
+        mock_time_time.side_effect = [1.0, 2.0, 3.0, 4.0]
+        flight_recorder = recorder.FlightRecorder()
+        flight_recorder.record("publish", "r1", None, 10, 0.1)
+        flight_recorder.record("receive", "r1", "a", 20, 0.1)
+        flight_recorder.record("receive", "r1", "b", 30, 0.1)
+        flight_recorder.record("receive", "r2", "a", 40, 0.1)
+
+        def sizes(**filters):
+            return [event["size"] for event in
+                    flight_recorder.dump(**filters)["events"]]
+
+        self.assertEqual([20, 30, 40], sizes(event="receive"))
+        self.assertEqual([10, 20, 30], sizes(req="r1"))
+        self.assertEqual([20, 40], sizes(agent="a"))
+        self.assertEqual([30, 40], sizes(since="3"))
+        self.assertEqual([30, 40], sizes(limit="2"))
+        self.assertEqual([20, 30, 40], sizes(event="receive", limit=5))
+        self.assertEqual([20, 30, 40], sizes(event="receive", limit=4))
+        self.assertEqual([], sizes(limit=0))
+        self.assertEqual([20], sizes(req="r1", agent="a", event="receive"))
+        self.assertRaises(ValueError, flight_recorder.dump, since="now")
+        self.assertRaises(ValueError, flight_recorder.dump, limit=-1)
+
+
+class RecordingSocketTestCase(unittest.TestCase):
+    def test_send_json(self):
+        socket = mock.Mock()
+        flight_recorder = mock.Mock()
+        recording_socket = recorder.RecordingSocket(
+            socket, flight_recorder, "publish")
+
+        recording_socket.send_json({"req": "r1"}, 1)
+
+        data = json.dumps({"req": "r1"}).encode("utf-8")
+        socket.send.assert_called_once_with(data, 1)
+        flight_recorder.record.assert_called_once_with(
+            "publish", "r1", None, len(data), mock.ANY)
+
+    def test_recv_json(self):
+        data = json.dumps({"req": "r1", "agent": "a"}).encode("utf-8")
+        socket = mock.Mock(**{"recv.return_value": data})
+        flight_recorder = mock.Mock()
+        recording_socket = recorder.RecordingSocket(
+            socket, flight_recorder, "receive")
+
+        self.assertEqual({"req": "r1", "agent": "a"},
+                         recording_socket.recv_json())
+        socket.recv.assert_called_once_with(0)
+        flight_recorder.record.assert_called_once_with(
+            "receive", "r1", "a", len(data), mock.ANY)
+
+    def test_delegates(self):
+        socket = mock.Mock()
+        recording_socket = recorder.RecordingSocket(socket, None, "receive")
+
+        self.assertEqual(socket.poll.return_value,
+                         recording_socket.poll(100))
+        socket.poll.assert_called_once_with(100)
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+import ddt
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import results
+
+
+@ddt.ddt
+class ResultStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ResultStoreTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "results.db")
+
+    def get_store(self, responses, **kwargs):
+        store = results.ResultStore(self.path, **kwargs)
+        for resp in responses:
+            store.add(resp)
+        store.close()
+        return results.ResultStore(self.path)
+
+    @mock.patch("time.time")
+    def test_query(self, mock_time_time):
+        mock_time_time.side_effect = [10.0, 11.0, 12.0, 13.0]
+        store = self.get_store([
+            {"req": "r1", "agent": "a", "exit_code": 0},
+            {"req": "r1", "agent": "b", "exit_code": 1},
+            {"req": "r2", "agent": "a", "exit_code": 0},
+            {"req": "r2", "agent": "b", "exit_code": 0},
+        ], batch_size=3)
+        self.addCleanup(store.close)
+
+        page = store.query(agent="b")
+        self.assertEqual(
+            [{"id": 2, "req": "r1", "agent": "b", "time": 11.0,
+              "response": {"req": "r1", "agent": "b", "exit_code": 1}},
+             {"id": 4, "req": "r2", "agent": "b", "time": 13.0,
+              "response": {"req": "r2", "agent": "b", "exit_code": 0}}],
+            page["results"])
+        self.assertIsNone(page["next"])
+
+        self.assertEqual(
+            [[1, 2], [3]],
+            [[row["id"] for row in store.query(since="10", until="13",
+                                               limit="2", cursor=cursor)
+              ["results"]]
+             for cursor in (None, 2)])
+        self.assertEqual(2, store.query(limit=2)["next"])
+        self.assertEqual(
+            ["a"], [row["agent"] for row in
+                    store.query(req="r2", agent="a")["results"]])
+
+    def test_outbox_resends(self):
+        store = self.get_store([
+            {"req": "r1", "agent": "a", "outbox_seq": 0},
+            {"req": "r1", "agent": "a", "outbox_seq": 0},
+            {"req": "r1", "agent": "b", "outbox_seq": 0},
+            {"req": "r2", "agent": "a", "outbox_seq": 0},
+            {"req": "r2", "agent": "c"},
+            {"req": "r2", "agent": "c"},
+        ])
+        self.addCleanup(store.close)
+
+        self.assertEqual(
+            [("r1", "a"), ("r1", "b"), ("r2", "a"), ("r2", "c"),
+             ("r2", "c")],
+            [(row["req"], row["agent"])
+             for row in store.query()["results"]])
+
+    @ddt.data("0", 1001, "x")
+    def test_query_invalid_limit(self, limit):
+        store = self.get_store([])
+        self.addCleanup(store.close)
+
+        self.assertRaises(ValueError, store.query, limit=limit)
+
+    def test_add_full(self):
+        store = results.ResultStore(self.path)
+        self.addCleanup(store.close)
+
+        with mock.patch.object(store.pending, "put_nowait",
+                               side_effect=results.queue.Full):
+            store.add({"req": "r1", "agent": "a"})
+
+        self.assertEqual(1, store.dropped)
+
+
+@ddt.ddt
+class StoringSocketTestCase(unittest.TestCase):
+    @ddt.data(
+        ({"req": "r1", "agent": "a", "stdout": "x"}, True),
+        ({"req": "r1", "agent": "a", "in_progress": True}, False),
+        ({"agents": ["a"], "ack_seq": 1}, False),
+    )
+    @ddt.unpack
+    def test_recv_json(self, resp, stored):
+        socket = mock.Mock(**{"recv_json.return_value": resp})
+        store = mock.Mock()
+        storing = results.StoringSocket(socket, store)
+
+        self.assertEqual(resp, storing.recv_json(1))
+        storing.poll(10)
+
+        socket.recv_json.assert_called_once_with(1)
+        socket.poll.assert_called_once_with(10)
+        self.assertEqual(stored, store.add.called)
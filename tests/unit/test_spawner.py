@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+import mock
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import spawner
+
+
+class ModuleTestCase(unittest.TestCase):
+    @mock.patch("spawner.open", create=True)
+    def test_read_proc_io(self, mock_spawner_open):
+        mock_spawner_open.return_value.__enter__.return_value.readlines.\
+            return_value = [
+                "rchar: 10\n", "wchar: 20\n", "syscr: 1\n", "syscw: 2\n",
+                "read_bytes: 4096\n", "write_bytes: 8192\n",
+                "cancelled_write_bytes: 0\n",
+            ]
+
+        counters = spawner.read_proc_io(42)
+
+        mock_spawner_open.assert_called_once_with("/proc/42/io")
+        self.assertEqual(
+            {"rchar": 10, "wchar": 20, "syscr": 1, "syscw": 2,
+             "read_bytes": 4096, "write_bytes": 8192},
+            counters)
+
+    @mock.patch("spawner.open", create=True, side_effect=IOError)
+    def test_read_proc_io_missing(self, mock_spawner_open):
+        self.assertEqual({}, spawner.read_proc_io(42))
+
+    def test_get_returncode(self):
+        self.assertEqual(3, spawner.get_returncode(3 << 8))
+        self.assertEqual(-9, spawner.get_returncode(9))
+
+    def test_send_recv_message(self):
+        left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        read_fd, write_fd = os.pipe()
+
+        spawner.send_message(left, {"foo": "bar"}, [write_fd])
+        os.close(write_fd)
+        message, fds = spawner.recv_message(right)
+
+        self.assertEqual({"foo": "bar"}, message)
+        self.assertEqual(1, len(fds))
+        os.write(fds[0], b"hello")
+        os.close(fds[0])
+        self.assertEqual(b"hello", os.read(read_fd, 5))
+        os.close(read_fd)
+
+
+class SpawnedProcessTestCase(unittest.TestCase):
+    def test_lifecycle(self):
+        process = spawner.SpawnedProcess(0)
+
+        process._started({"id": 0, "pid": 42})
+        self.assertEqual(42, process.pid)
+        self.assertIsNone(process.poll())
+
+        process._exited({"id": 0, "returncode": 1,
+                         "rusage": {"ru_utime": 0.5}, "io": {"rchar": 1}})
+
+        self.assertEqual(1, process.poll())
+        self.assertEqual(1, process.wait())
+        returncode, rusage, io_counters = process.wait_usage()
+        self.assertEqual(0.5, rusage.ru_utime)
+        self.assertEqual({"rchar": 1}, io_counters)
+
+    def test_failed(self):
+        process = spawner.SpawnedProcess(0)
+
+        process._failed("gone")
+
+        self.assertTrue(process.started.is_set())
+        self.assertEqual("gone", process.error)
+        self.assertRaises(OSError, process.wait)
+
+
+class SpawnClientTestCase(unittest.TestCase):
+    def setUp(self):
+        super(SpawnClientTestCase, self).setUp()
+        self.client = spawner.SpawnClient()
+
+    def tearDown(self):
+        super(SpawnClientTestCase, self).tearDown()
+        self.client.close()
+
+    def test_spawn_pipes(self):
+        process = self.client.spawn(
+            ["sh", "-c", "echo out; echo err >&2; exit 3"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        self.assertEqual(b"out\n", process.stdout.read())
+        self.assertEqual(b"err\n", process.stderr.read())
+        self.assertEqual(3, process.wait())
+        self.assertTrue(process.pid)
+        returncode, rusage, io_counters = process.wait_usage()
+        self.assertGreater(rusage.ru_maxrss, 0)
+        process.stdout.close()
+        process.stderr.close()
+
+    def test_spawn_file_stderr_to_stdout(self):
+        with tempfile.TemporaryFile() as fh:
+            process = self.client.spawn(
+                ["sh", "-c", "echo $FOO; echo err >&2"],
+                stdout=fh, stderr=subprocess.STDOUT, env={"FOO": "bar"})
+            self.assertEqual(0, process.wait())
+
+            fh.seek(0)
+            self.assertEqual(b"bar\nerr\n", fh.read())
+
+    def test_spawn_error(self):
+        self.assertRaises(OSError, self.client.spawn,
+                          ["/nonexistent/command"])
+
+    def test_spawn_bad_request(self):
+        self.assertRaises(OSError, self.client.spawn, ["true"],
+                          env={"FOO": 1})
+
+        self.assertEqual(0, self.client.spawn(["true"]).wait())
+
+    def test_spawn_too_large(self):
+        self.assertRaises(ValueError, self.client.spawn,
+                          ["echo", "x" * spawner.MAX_MESSAGE_SIZE])
+
+        self.assertEqual(0, self.client.spawn(["true"]).wait())
+
+    def test_server_exited(self):
+        process = self.client.spawn(["sleep", "1"])
+
+        os.kill(self.client.server_pid, signal.SIGKILL)
+
+        self.assertRaises(OSError, process.wait)
+        self.assertRaises(OSError, self.client.spawn, ["true"])
+
+    def test_spawn_new_session(self):
+        process = self.client.spawn(
+            [sys.executable, "-c",
+             "import os; print(os.getsid(0) == os.getpid())"],
+            stdout=subprocess.PIPE, new_session=True)
+
+        self.assertEqual(b"True\n", process.stdout.read())
+        self.assertEqual(0, process.wait())
+        process.stdout.close()
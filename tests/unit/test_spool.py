@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import ddt
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import spool
+
+
+@ddt.ddt
+class ModuleTestCase(unittest.TestCase):
+    @ddt.data(
+        (None, None),
+        ("bytes=0-", (0, 9)),
+        ("bytes=2-4", (2, 4)),
+        ("bytes=5-100", (5, 9)),
+        ("bytes=-3", (7, 9)),
+        ("bytes=-30", (0, 9)),
+        ("bytes=0-1,4-5", None),
+        ("lines=1-2", None),
+    )
+    @ddt.unpack
+    def test_parse_range(self, header, expected):
+        self.assertEqual(expected, spool.parse_range(header, 10))
+
+    @ddt.data("bytes=10-", "bytes=4-2")
+    def test_parse_range_unsatisfiable(self, header):
+        self.assertRaises(ValueError, spool.parse_range, header, 10)
+
+
+@ddt.ddt
+class OutputSpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        super(OutputSpoolTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.spool = spool.OutputSpool(os.path.join(self.tmpdir, "spool"),
+                                       threshold=4)
+
+    def test_spill(self):
+        resp = {"req": "r/1", "agent": "a", "stdout": "big é",
+                "stderr": "ok", "stdout_tail": "tail!"}
+
+        self.spool.spill(resp)
+
+        self.assertEqual(
+            {"req": "r/1", "agent": "a", "stderr": "ok",
+             "stdout_ref": "/output/r%2F1/a/stdout", "stdout_bytes": 6,
+             "stdout_tail_ref": "/output/r%2F1/a/stdout_tail",
+             "stdout_tail_bytes": 5},
+            resp)
+        with self.spool.open("r/1", "a", "stdout") as fh:
+            self.assertEqual(u"big é", fh.read().decode("utf-8"))
+        self.assertRaises(IOError, self.spool.open, "r/1", "a", "stderr")
+
+    @ddt.data(
+        {"req": "..", "agent": "a"},
+        {"req": "r1", "agent": None},
+    )
+    def test_spill_invalid(self, resp):
+        resp["stdout"] = "big output"
+
+        self.spool.spill(resp)
+
+        self.assertEqual("big output", resp["stdout"])
+        self.assertFalse(os.path.exists(self.spool.path))
+
+    @ddt.data(
+        ("r1", "a", "stdin"),
+        ("r1", ".", "stdout"),
+        ("", "a", "stdout"),
+    )
+    def test_open_invalid(self, names):
+        self.assertRaises(ValueError, self.spool.open, *names)
+
+
+class SpoolingSocketTestCase(unittest.TestCase):
+    def test_recv_json(self):
+        socket = mock.Mock(**{"recv_json.return_value": {"req": "r1"}})
+        output_spool = mock.Mock()
+        spooling = spool.SpoolingSocket(socket, output_spool)
+
+        self.assertEqual({"req": "r1"}, spooling.recv_json())
+        spooling.poll(10)
+
+        output_spool.spill.assert_called_once_with({"req": "r1"})
+        socket.poll.assert_called_once_with(10)
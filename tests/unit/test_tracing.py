@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+import ddt
+import gzip
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tracing
+
+
+def write_trace(path, events, truncate=False):
+    data = "".join(json.dumps(event) + "\n" for event in events)
+    with gzip.open(path, "wt") as fh:
+        fh.write(data)
+    if truncate:
+        with open(path, "rb") as fh:
+            compressed = fh.read()
+        with open(path, "wb") as fh:
+            fh.write(compressed[:-10])
+
+
+@ddt.ddt
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        super(TraceTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "trace.gz")
+
+    def test_writer_and_socket(self):
+        socket = mock.Mock(**{"recv_json.return_value": {"req": "r1",
+                                                         "agent": "a"}})
+        writer = tracing.TraceWriter(self.path)
+        traced = tracing.TracingSocket(socket, writer)
+
+        traced.send_json({"req": "r1", "action": "command",
+                          "path": ["true"], "target": ["a"]})
+        self.assertEqual({"req": "r1", "agent": "a"}, traced.recv_json())
+        traced.poll(10)
+        writer.close()
+
+        socket.send_json.assert_called_once_with(
+            {"req": "r1", "action": "command", "path": ["true"],
+             "target": ["a"]})
+        socket.poll.assert_called_once_with(10)
+        with gzip.open(self.path, "rt") as fh:
+            events = [json.loads(line) for line in fh]
+        self.assertEqual(
+            [{"req": "r1", "action": "command", "target": ["a"]},
+             {"req": "r1", "agent": "a"}],
+            [events[0]["publish"], events[1]["receive"]])
+
+    @ddt.data(False, True)
+    def test_load(self, truncate):
+        write_trace(self.path, [
+            {"time": 10.0, "http": {"method": "GET", "path": "/ping"}},
+            {"time": 10.1, "publish": {"req": "r1", "action": "ping"}},
+            {"time": 10.3, "receive": {"req": "r1", "agent": "a"}},
+            {"time": 10.4, "receive": {"req": "other", "agent": "a"}},
+            {"time": 10.5, "publish": {"req": "r1", "action": "ping",
+                                       "replay_to": ["b"]}},
+            {"time": 10.6, "publish": {"req": "r2", "action": "ping"}},
+            {"time": 10.7, "receive": {"agents": ["a"], "ack_seq": 1}},
+        ], truncate)
+
+        trace = tracing.Trace.load(self.path)
+
+        self.assertEqual([(10.0, {"method": "GET", "path": "/ping"})],
+                         trace.http)
+        self.assertEqual(["r1", "r2"], list(trace.published["ping"]))
+        self.assertEqual(["r1"], list(trace.responses))
+        delay, resp = trace.responses["r1"][0]
+        self.assertAlmostEqual(0.2, delay)
+        self.assertEqual({"req": "r1", "agent": "a"}, resp)
+
+
+class AgentSideTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AgentSideTestCase, self).setUp()
+        trace = tracing.Trace()
+        trace.published["ping"].extend(["r1", "r2"])
+        trace.responses["r1"] = [(0.2, {"req": "r1", "agent": "a"}),
+                                 (0.4, {"req": "r1", "agent": "b"})]
+        self.push_socket = mock.Mock()
+        self.agent_side = tracing.AgentSide(
+            trace, mock.Mock(), self.push_socket, speed=2)
+
+    @mock.patch("tracing.monotonic")
+    def test_match(self, mock_monotonic):
+        mock_monotonic.side_effect = [100.0, 100.15]
+
+        self.agent_side.match({"req": "n1", "action": "ping"})
+        self.agent_side.match({"req": "n1", "action": "ping",
+                               "replay_to": ["a"]})
+        self.agent_side.match({"req": "n0", "action": "check"})
+        self.agent_side.send_due()
+
+        self.push_socket.send_json.assert_called_once_with(
+            {"req": "n1", "agent": "a"})
+        self.assertEqual(1, self.agent_side.sent)
+        self.assertEqual(1, self.agent_side.unmatched)
+        self.assertEqual([100.2], [due for due, _, _
+                                   in self.agent_side.schedule])
+        self.assertEqual(["r2"], list(self.agent_side.published["ping"]))
+
+    def test_run(self):
+        stop = threading.Event()
+        requests = [{"req": "n1", "action": "ping"}]
+
+        def recv_json():
+            return requests.pop()
+
+        def send_json(resp):
+            if resp["agent"] == "b":
+                stop.set()
+
+        self.agent_side.subscribe_socket.poll.side_effect = (
+            lambda timeout: len(requests))
+        self.agent_side.subscribe_socket.recv_json.side_effect = recv_json
+        self.push_socket.send_json.side_effect = send_json
+
+        self.agent_side.run(stop)
+
+        self.assertEqual(
+            [mock.call({"req": "n1", "agent": "a"}),
+             mock.call({"req": "n1", "agent": "b"})],
+            self.push_socket.send_json.mock_calls)
+
+
+@ddt.ddt
+class ModuleTestCase(unittest.TestCase):
+    @ddt.data(
+        ([], 50, None),
+        ([3, 1, 2], 50, 2),
+        ([3, 1, 2], 100, 3),
+        (list(range(1, 101)), 99, 99),
+    )
+    @ddt.unpack
+    def test_percentile(self, values, percent, expected):
+        self.assertEqual(expected, tracing.percentile(values, percent))
+
+    def test_send_http(self):
+        session = mock.Mock(**{"request.return_value.status_code": 400})
+
+        retval = tracing.send_http(session, "http://master", {
+            "method": "POST", "path": "/ping?timeout=10",
+            "content_type": "application/x-www-form-urlencoded",
+            "body": "target=%22a%22"})
+
+        self.assertFalse(retval[1])
+        session.request.assert_called_once_with(
+            "POST", "http://master/ping?timeout=10",
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data=b"target=%22a%22")
+
+    @mock.patch("time.sleep")
+    @mock.patch("tracing.send_http")
+    @mock.patch("tracing.monotonic")
+    def test_drive(self, mock_monotonic, mock_send_http, mock_time_sleep):
+        mock_monotonic.side_effect = [0.0, 0.0, 0.5, 2.0]
+        mock_send_http.return_value = (0.1, True)
+        trace = tracing.Trace()
+        trace.http = [(10.0, {"path": "/a"}), (12.0, {"path": "/b"})]
+
+        results, duration = tracing.drive(trace, "http://master", speed=2)
+
+        self.assertEqual([(0.1, True), (0.1, True)], results)
+        self.assertEqual(2.0, duration)
+        mock_time_sleep.assert_called_once_with(0.5)
+        self.assertEqual(
+            ["/a", "/b"],
+            [call[1][2]["path"] for call in mock_send_http.mock_calls])
+
+    @mock.patch("tracing.drive")
+    def test_replay(self, mock_drive):
+        mock_drive.return_value = ([(0.1, True), (0.3, False)], 4.0)
+        subscribe_socket = mock.Mock(**{"poll.return_value": 0})
+
+        report = tracing.replay(tracing.Trace(), "http://master",
+                                subscribe_socket, mock.Mock(), speed=4)
+
+        mock_drive.assert_called_once_with(mock.ANY, "http://master", 4, 8)
+        self.assertEqual(
+            {"requests": 2, "errors": 1, "duration": 4.0, "throughput": 0.5,
+             "latency": {"p50": 0.1, "p90": 0.3, "p99": 0.3, "p100": 0.3},
+             "responses": 0, "unmatched": 0},
+            report)
+
+    def test_drive_empty(self):
+        self.assertEqual(([], 0.0),
+                         tracing.drive(tracing.Trace(), "http://master"))
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import json
+import mock
+import os
+import tempfile
+import unittest
+import zmq
+
+import transport
+
+
+class TransportProfileTestCase(unittest.TestCase):
+    def test___init__(self):
+        profile = transport.TransportProfile(
+            io_threads="4", sndhwm="100", rcvhwm=None)
+
+        self.assertEqual(4, profile.io_threads)
+        self.assertEqual({"sndhwm": 100}, profile.options)
+
+    def test___init___unknown(self):
+        self.assertRaises(ValueError, transport.TransportProfile,
+                          foo=1, bar=2)
+
+    def _parse_args(self, args):
+        parser = argparse.ArgumentParser()
+        transport.TransportProfile.add_arguments(parser)
+        return parser.parse_args(args)
+
+    def test_from_args(self):
+        args = self._parse_args(["--io-threads", "2", "--sndhwm", "10",
+                                 "--heartbeat-ivl", "1000"])
+
+        profile = transport.TransportProfile.from_args(args)
+
+        self.assertEqual(2, profile.io_threads)
+        self.assertEqual({"sndhwm": 10, "heartbeat_ivl": 1000},
+                         profile.options)
+
+    def test_from_args_config(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.unlink, path)
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"io_threads": 4, "sndhwm": 5, "rcvhwm": 6}, fh)
+        args = self._parse_args(["--transport-config", path,
+                                 "--sndhwm", "10"])
+
+        profile = transport.TransportProfile.from_args(args)
+
+        self.assertEqual(4, profile.io_threads)
+        self.assertEqual({"sndhwm": 10, "rcvhwm": 6}, profile.options)
+
+    @mock.patch("zmq.Context")
+    def test_get_context(self, mock_zmq_context):
+        profile = transport.TransportProfile(io_threads=3)
+
+        self.assertEqual(mock_zmq_context.return_value, profile.get_context())
+        self.assertEqual(mock_zmq_context.return_value, profile.get_context())
+
+        mock_zmq_context.assert_called_once_with(io_threads=3)
+
+    @mock.patch("zmq.Context")
+    def test_socket(self, mock_zmq_context):
+        profile = transport.TransportProfile(
+            sndhwm=10, tcp_keepalive=1, reconnect_ivl=100)
+
+        socket = profile.socket(zmq.PUSH)
+
+        context = mock_zmq_context.return_value
+        context.socket.assert_called_once_with(zmq.PUSH)
+        self.assertEqual(context.socket.return_value, socket)
+        self.assertEqual(
+            [
+                mock.call(zmq.RECONNECT_IVL, 100),
+                mock.call(zmq.SNDHWM, 10),
+                mock.call(zmq.TCP_KEEPALIVE, 1),
+            ],
+            socket.setsockopt.mock_calls)
+
+
+class TopicTestCase(unittest.TestCase):
+    def test_topics(self):
+        for separators in ((", ", ": "), (",", ":")):
+            request = json.dumps({"req": "r", "action": "ping"},
+                                 separators=separators)
+            ack = json.dumps(collections.OrderedDict([
+                (transport.get_ack_key(u"ab\u00e9"), True), ("req", "r")]),
+                separators=separators)
+
+            self.assertTrue(request.startswith(transport.REQUEST_TOPIC))
+            self.assertFalse(ack.startswith(transport.REQUEST_TOPIC))
+            self.assertTrue(ack.startswith(
+                transport.get_ack_topic(u"ab\u00e9")))
+            self.assertFalse(ack.startswith(transport.get_ack_topic("a")))
+
+    def test_subscribe(self):
+        socket = mock.Mock()
+
+        transport.subscribe(socket, ["a", "b"])
+
+        self.assertEqual(
+            [mock.call(zmq.SUBSCRIBE, u'{"req"'),
+             mock.call(zmq.SUBSCRIBE, u'{"ack:a"'),
+             mock.call(zmq.SUBSCRIBE, u'{"ack:b"')],
+            socket.setsockopt_string.mock_calls)
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import heapq
+import itertools
+import json
+import math
+import sys
+import threading
+import time
+
+import requests
+import zmq
+
+import transport
+
+monotonic = getattr(time, "monotonic", time.time)
+
+# Request fields kept for published messages, bulky ones such as scripts
+# and file chunks are not needed to replay.
+PUBLISH_FIELDS = ("req", "action", "target", "selector", "noreply",
+                  "replay_to")
+
+
+class TraceWriter(object):
+    def __init__(self, path):
+        self.fh = gzip.open(path, "wt")
+        self.lock = threading.Lock()
+
+    def write(self, kind, data):
+        line = json.dumps({"time": time.time(), kind: data}) + "\n"
+        with self.lock:
+            self.fh.write(line)
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+
+
+class TracingSocket(object):
+    def __init__(self, socket, writer):
+        self.socket = socket
+        self.writer = writer
+
+    def send_json(self, obj, *args, **kwargs):
+        self.writer.write("publish", dict(
+            (key, obj[key]) for key in PUBLISH_FIELDS if key in obj))
+        return self.socket.send_json(obj, *args, **kwargs)
+
+    def recv_json(self, *args, **kwargs):
+        obj = self.socket.recv_json(*args, **kwargs)
+        self.writer.write("receive", obj)
+        return obj
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+
+class Trace(object):
+    def __init__(self):
+        # (time, {"method", "path", "content_type", "body"})
+        self.http = []
+        # Recorded request IDs by action, in publish order.
+        self.published = collections.defaultdict(collections.deque)
+        # Recorded request ID to [(delay after publish, response)].
+        self.responses = collections.defaultdict(list)
+
+    @classmethod
+    def load(cls, path):
+        trace = cls()
+        publish_times = {}
+        with gzip.open(path, "rt") as fh:
+            try:
+                for line in fh:
+                    trace.add(json.loads(line), publish_times)
+            except (EOFError, ValueError):
+                # The master was killed before closing the trace, keep the
+                # events written up to the truncated one.
+                pass
+        return trace
+
+    def add(self, event, publish_times):
+        if "http" in event:
+            self.http.append((event["time"], event["http"]))
+        elif "publish" in event:
+            req = event["publish"]
+            # Retransmits are up to the replaying master.
+            if "replay_to" not in req:
+                self.published[req.get("action")].append(req["req"])
+                publish_times[req["req"]] = event["time"]
+        elif "receive" in event:
+            resp = event["receive"]
+            sent = publish_times.get(resp.get("req"))
+            if sent is not None:
+                self.responses[resp["req"]].append(
+                    (event["time"] - sent, resp))
+
+
+class AgentSide(object):
+    POLL_INTERVAL = 100
+
+    def __init__(self, trace, subscribe_socket, push_socket, speed=1.0):
+        self.published = dict((action, collections.deque(req_ids))
+                              for action, req_ids in trace.published.items())
+        self.responses = trace.responses
+        self.subscribe_socket = subscribe_socket
+        self.push_socket = push_socket
+        self.speed = speed
+        self.schedule = []
+        self.counter = itertools.count()
+        self.sent = 0
+        self.unmatched = 0
+
+    def match(self, request):
+        # The master is deterministic, the n-th request of an action now is
+        # the n-th one of the trace.
+        if "replay_to" in request:
+            return
+        req_ids = self.published.get(request.get("action"))
+        if not req_ids:
+            self.unmatched += 1
+            return
+
+        now = monotonic()
+        for delay, resp in self.responses.get(req_ids.popleft(), []):
+            heapq.heappush(self.schedule, (
+                now + delay / self.speed, next(self.counter),
+                dict(resp, req=request["req"])))
+
+    def send_due(self):
+        now = monotonic()
+        while self.schedule and self.schedule[0][0] <= now:
+            _, _, resp = heapq.heappop(self.schedule)
+            self.push_socket.send_json(resp)
+            self.sent += 1
+
+    def run(self, stop):
+        while not stop.is_set():
+            timeout = self.POLL_INTERVAL
+            if self.schedule:
+                timeout = max(0, min(
+                    timeout, (self.schedule[0][0] - monotonic()) * 1000))
+            if self.subscribe_socket.poll(timeout):
+                self.match(self.subscribe_socket.recv_json())
+            self.send_due()
+
+
+def send_http(session, http_url, http):
+    tstart = monotonic()
+    headers = {}
+    if http.get("content_type"):
+        headers["Content-Type"] = http["content_type"]
+    try:
+        resp = session.request(
+            http["method"], http_url + http["path"], headers=headers,
+            data=http.get("body", "").encode("latin-1") or None)
+        ok = resp.status_code == 200
+    except requests.exceptions.RequestException:
+        ok = False
+    return monotonic() - tstart, ok
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(percent / 100. * len(values))) - 1)]
+
+
+def drive(trace, http_url, speed=1.0, workers=8):
+    if not trace.http:
+        return [], 0.0
+    session = requests.Session()
+    first = trace.http[0][0]
+    tstart = monotonic()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = []
+        for recorded, http in trace.http:
+            delay = tstart + (recorded - first) / speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(send_http, session, http_url,
+                                           http))
+        results = [future.result() for future in futures]
+    return results, monotonic() - tstart
+
+
+def replay(trace, http_url, subscribe_socket, push_socket, speed=1.0,
+           workers=8):
+    agent_side = AgentSide(trace, subscribe_socket, push_socket, speed)
+    stop = threading.Event()
+    thread = threading.Thread(target=agent_side.run, args=(stop,))
+    thread.daemon = True
+    thread.start()
+    try:
+        results, duration = drive(trace, http_url, speed, workers)
+    finally:
+        stop.set()
+        thread.join()
+
+    latencies = [latency for latency, _ in results]
+    return {
+        "requests": len(results),
+        "errors": len([ok for _, ok in results if not ok]),
+        "duration": duration,
+        "throughput": len(results) / duration if duration else None,
+        "latency": dict(("p%d" % percent, percentile(latencies, percent))
+                        for percent in (50, 90, 99, 100)),
+        "responses": agent_side.sent,
+        "unmatched": agent_side.unmatched,
+    }
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Replay the agent side of a masteragent --trace file "
+                    "against a fresh masteragent and report its latency "
+                    "and throughput")
+    parser.add_argument("trace", help="Trace file written by masteragent")
+    parser.add_argument(
+        "--http-url", default="http://localhost:8080",
+        help="HTTP URL of the masteragent")
+    parser.add_argument(
+        "--subscribe-url", default="tcp://localhost:1234",
+        help="ZMQ publish URL of the masteragent to subscribe to")
+    parser.add_argument(
+        "--push-url", default="tcp://localhost:1235",
+        help="ZMQ pull URL of the masteragent to push responses to")
+    parser.add_argument(
+        "--speed", type=float, default=1.0,
+        help="Replay speed, 2 replays twice as fast as recorded")
+    parser.add_argument(
+        "--workers", type=int, default=8,
+        help="Maximum number of concurrent HTTP requests")
+    parser.add_argument(
+        "--join-wait", type=float, default=0.5,
+        help="Seconds to let the subscription settle before replaying")
+    transport.TransportProfile.add_arguments(parser)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    trace = Trace.load(args.trace)
+
+    transport_profile = transport.TransportProfile.from_args(args)
+    subscribe_socket = transport_profile.socket(zmq.SUB)
+    subscribe_socket.connect(args.subscribe_url)
+    subscribe_socket.setsockopt_string(zmq.SUBSCRIBE, u"")
+    push_socket = transport_profile.socket(zmq.PUSH)
+    push_socket.connect(args.push_url)
+    time.sleep(args.join_wait)
+
+    report = replay(trace, args.http_url.rstrip("/"), subscribe_socket,
+                    push_socket, args.speed, args.workers)
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+import collections
+import json
+import zmq
+
+
+# Agents subscribe to requests and to the outbox acknowledgements meant for
+# them only, the publisher drops those of other agents.
+REQUEST_TOPIC = u'{"req"'
+
+
+def get_ack_key(agent_id):
+    # First key of an acknowledgement, its JSON encoding is the topic.
+    return u"ack:%s" % agent_id
+
+
+def get_ack_topic(agent_id):
+    return u"{" + json.dumps(get_ack_key(agent_id))
+
+
+def subscribe(subscribe_socket, agent_ids):
+    subscribe_socket.setsockopt_string(zmq.SUBSCRIBE, REQUEST_TOPIC)
+    for agent_id in agent_ids:
+        subscribe_socket.setsockopt_string(zmq.SUBSCRIBE,
+                                           get_ack_topic(agent_id))
+
+
+class TransportProfile(object):
+    # Profile key: (ZMQ socket option, help)
+    SOCKET_OPTIONS = collections.OrderedDict([
+        ("sndhwm", ("SNDHWM", "Send high-water mark, in messages")),
+        ("rcvhwm", ("RCVHWM", "Receive high-water mark, in messages")),
+        ("linger", ("LINGER", "Linger period on close, in ms")),
+        ("tcp_keepalive", ("TCP_KEEPALIVE",
+                           "Enable (1) or disable (0) TCP keepalive")),
+        ("tcp_keepalive_idle", ("TCP_KEEPALIVE_IDLE",
+                                "TCP keepalive idle time, in seconds")),
+        ("tcp_keepalive_intvl", ("TCP_KEEPALIVE_INTVL",
+                                 "TCP keepalive probe interval, in seconds")),
+        ("tcp_keepalive_cnt", ("TCP_KEEPALIVE_CNT",
+                               "Number of TCP keepalive probes")),
+        ("reconnect_ivl", ("RECONNECT_IVL", "Reconnect interval, in ms")),
+        ("reconnect_ivl_max", ("RECONNECT_IVL_MAX",
+                               "Maximum reconnect backoff interval, in ms")),
+        ("heartbeat_ivl", ("HEARTBEAT_IVL",
+                           "ZMTP heartbeat interval, in ms")),
+        ("heartbeat_timeout", ("HEARTBEAT_TIMEOUT",
+                               "ZMTP heartbeat timeout, in ms")),
+        ("heartbeat_ttl", ("HEARTBEAT_TTL",
+                           "ZMTP heartbeat TTL announced to peers, in ms")),
+    ])
+
+    def __init__(self, io_threads=1, **options):
+        unknown = set(options) - set(self.SOCKET_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown transport options: %s." %
+                             ", ".join(sorted(unknown)))
+
+        self.io_threads = int(io_threads)
+        self.options = dict((key, int(value))
+                            for key, value in options.items()
+                            if value is not None)
+        self.context = None
+
+    @classmethod
+    def add_arguments(cls, parser):
+        group = parser.add_argument_group("transport")
+        group.add_argument(
+            "--transport-config",
+            help="JSON file with transport options, command line options "
+                 "override it")
+        group.add_argument(
+            "--io-threads", type=int,
+            help="Number of ZMQ I/O threads of the shared context")
+        for key, (_, help_) in cls.SOCKET_OPTIONS.items():
+            group.add_argument("--%s" % key.replace("_", "-"), type=int,
+                               help=help_)
+
+    @classmethod
+    def from_args(cls, args):
+        config = {}
+        if args.transport_config:
+            with open(args.transport_config) as fh:
+                config.update(json.load(fh))
+
+        for key in ["io_threads"] + list(cls.SOCKET_OPTIONS):
+            value = getattr(args, key)
+            if value is not None:
+                config[key] = value
+
+        return cls(**config)
+
+    def get_context(self):
+        if self.context is None:
+            self.context = zmq.Context(io_threads=self.io_threads)
+        return self.context
+
+    def socket(self, socket_type):
+        socket = self.get_context().socket(socket_type)
+        for key, value in sorted(self.options.items()):
+            option = getattr(zmq, self.SOCKET_OPTIONS[key][0], None)
+            if option is None:
+                # Not supported by the libzmq we are running with.
+                continue
+            socket.setsockopt(option, value)
+        return socket